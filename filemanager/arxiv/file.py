@@ -4,13 +4,16 @@
 
 import os.path
 import re
+from stat import S_ISREG
 from datetime import datetime
 from pytz import UTC
 from hashlib import md5
 from base64 import b64encode
+from typing import Optional
 from arxiv.base import logging
 
 from filemanager.arxiv.file_type import guess, _is_tex_type, name
+from filemanager.utilities.type_cache import TypeCache
 
 logger = logging.getLogger(__name__)
 
@@ -24,15 +27,59 @@ class File:
     to be displayed to the submitter.
     """
 
-    def __init__(self, filepath: str, base_dir: str) -> None:
+    __slots__ = ('__filepath', '__base_dir', '__type_cache', '__description',
+                 '__removed', '__type', '__stat', '__dir_entry')
+
+    def __init__(self, filepath: str, base_dir: str,
+                 type_cache: Optional[TypeCache] = None,
+                 stat: Optional[os.stat_result] = None) -> None:
         self.__filepath = filepath
         self.__base_dir = base_dir
+        self.__type_cache = type_cache
         self.__description = ''
         self.__removed = 0
-        self.__type = self.initialize_type()
-        self.__size = os.path.getsize(self.filepath)
-        mtime = os.path.getmtime(filepath)
-        self.__modified_datetime = datetime.fromtimestamp(mtime, tz=UTC)
+        # Type and stat information are only looked up when first needed.
+        self.__type: Optional[str] = None
+        self.__stat = stat
+        self.__dir_entry: Optional[os.DirEntry] = None
+
+    @classmethod
+    def from_dir_entry(cls, entry: os.DirEntry, base_dir: str,
+                       type_cache: Optional[TypeCache] = None) -> 'File':
+        """
+        Create a File from an entry returned by :func:`os.scandir`.
+
+        The stat information cached on the entry is used instead of
+        stat'ing the file again.
+        """
+        file = cls(entry.path, base_dir, type_cache)
+        file.__dir_entry = entry
+        return file
+
+    def _stat(self) -> os.stat_result:
+        """Stat the file once and remember the result."""
+        if self.__stat is None:
+            if self.__dir_entry is not None:
+                self.__stat = self.__dir_entry.stat()
+            else:
+                self.__stat = os.stat(self.__filepath)
+        return self.__stat
+
+    def _restat(self) -> os.stat_result:
+        """
+        Stat the file again, since it may have changed after it was first
+        stat'ed (the previous result is kept if the file is gone).
+        """
+        try:
+            self.__stat = os.stat(self.__filepath)
+        except OSError:
+            pass
+        return self._stat()
+
+    @property
+    def stat(self) -> os.stat_result:
+        """Result of stat'ing the file (looked up once)."""
+        return self._stat()
 
     @property
     def name(self) -> str:
@@ -48,8 +95,11 @@ class File:
     @property
     def dir(self) -> str:
         """Directory which contains the file. This is only used for files."""
-        if os.path.isfile(self.filepath):
-            return os.path.dirname(self.filepath)
+        try:
+            if S_ISREG(self._stat().st_mode):
+                return os.path.dirname(self.filepath)
+        except OSError:
+            pass
 
         return ''
 
@@ -93,6 +143,8 @@ class File:
     def filepath(self, path: str) -> None:
         """The file name WITH complete path/directory in filesystem."""
         self.__filepath = path
+        self.__stat = None
+        self.__dir_entry = None
 
     @property
     def public_filepath(self) -> str:
@@ -100,10 +152,21 @@ class File:
         ppath = self.filepath
         return ppath.replace(self.base_dir + '/', "")
 
-    def initialize_type(self):
+    def initialize_type(self) -> str:
+        """
+        Guess file type, unless the type cache knows it already.
+
+        Directories are of type ``'directory'``.
+        """
         if self.dir:
-            """Guess file type."""
-            self.__type = guess(self.__filepath)
+            if self.__type_cache is not None:
+                stat = self._stat()
+                self.__type = self.__type_cache.get(self.__filepath, stat)
+                if self.__type is None:
+                    self.__type = guess(self.__filepath)
+                    self.__type_cache.set(self.__filepath, self.__type, stat)
+            else:
+                self.__type = guess(self.__filepath)
             return self.__type
         elif self.dir == '' and self.filepath == os.path.join(self.base_dir, 'anc'):
             return 'directory'
@@ -113,11 +176,9 @@ class File:
     @property
     def type(self) -> str:
         """The file type."""
-        if self.__type:
-            """Use existing type setting."""
-            return self.__type
-        else:
-            self.initialize_type()
+        if self.__type is None:
+            self.__type = self.initialize_type()
+        return self.__type
 
     @type.setter
     def type(self, type: str) -> None:
@@ -182,18 +243,17 @@ class File:
     @property
     def size(self) -> int:
         """Return size of file entity."""
-        return self.__size
+        # Doing this at call time, since the file may be rewritten after the
+        # File is instantiated.
+        return self._restat().st_size
 
     @property
     def modified_datetime(self) -> str:
         """Return modified datetime of file entity."""
         # Doing this at call time, since the modified time may change after
         # the File is instantiated.
-        logger.debug('Get modified_datetime')
-        if os.path.exists(self.filepath):
-            mt = os.path.getmtime(self.filepath)
-            self.__modified_datetime = datetime.fromtimestamp(mt, tz=UTC)
-        return self.__modified_datetime.isoformat()
+        mtime = self._restat().st_mtime
+        return datetime.fromtimestamp(mtime, tz=UTC).isoformat()
 
     @property
     def removed(self) -> int:
@@ -7,7 +7,10 @@
 import os
 import os.path
 import re
-from typing import Tuple
+from stat import S_ISREG
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+from arxiv.base.globals import get_application_config
 
 # TeX types
 TEX_types = ['TYPE_LATEX',
@@ -85,7 +88,9 @@ type_priorities = [
     'TYPE_README',
     'TYPE_TEXAUX',
     'TYPE_ABS',
-    'TYPE_INCLUDE'
+    'TYPE_INCLUDE',
+    # Not known to the legacy system; added last to keep existing priorities
+    'TYPE_XZ'
 ]
 
 #type_priorities = {}
@@ -132,6 +137,7 @@ type_name['TYPE_COMPRESSED'] = 'UNIX-compressed'
 type_name['TYPE_ZIP'] = 'ZIP-compressed'
 type_name['TYPE_GZIPPED'] = 'GZIP-compressed'
 type_name['TYPE_BZIP2'] = 'BZIP2-compressed'
+type_name['TYPE_XZ'] = 'XZ-compressed'
 type_name['TYPE_MULTI_PART_MIME'] = 'MULTI_PART_MIME'
 type_name['TYPE_TAR'] = 'TAR archive'
 type_name['TYPE_IGNORE'] = ' user defined IGNORE'
@@ -141,330 +147,457 @@ type_name['TYPE_ABS'] = 'abstract'
 type_name['TYPE_INCLUDE'] = ' keep'
 
 
-# Select bewteen PDFLATEX and LATEX2e types.
-def _type_of_latex2e(file, count: int) -> Tuple[str, str, str]:
-    """Determine whether file is PDFLATEX or LATEX2e."""
-    limit = count + 5
-
-    # Rewind to beginning of file
-    file.seek(0, 0)
-
-    line_no = 1
-    for line in file:
-        if re.search(rb'^[^%]*\\includegraphics[^%]*\.'
-                     + rb'(?:pdf|png|gif|jpg)\s?\}', line, re.IGNORECASE) \
-                or (line_no < limit and re.search(rb'^[^%]*\\pdfoutput(?:\s+)?=(?:\s+)?1', line)):
-            return 'TYPE_PDFLATEX', '', ''
-        line_no += 1
-    return 'TYPE_LATEX2e', '', ''
-
-# Internal type routines. These routines are core of type guessing logic.
-
-def guess_file_type(filepath: str) -> Tuple[str, str, str]:
-    """Guess the file type of filename.
-    :type filepath: object
-    """
-
-    # check whether file exists (new)
-    if not os.path.isfile(filepath):
-        return 'TYPE_FAILED', '', ''
-
-    # Currently the following type identification relies on the extension
-    # to identify the type without inspecting content of file.
-
-    # arXxiv's special command file
-    if re.search(r'(^|/)00README\.XXX$', filepath):
-        return "TYPE_README", '', ''
+# Tables used by the type guessing logic. Everything is compiled once at
+# import time since guess_file_type() is called for every file in an upload.
 
+# File names that determine the type on their own.
+_SPECIAL_FILE_NAMES = {
+    # arXiv's special command file
+    '00README.XXX': 'TYPE_README',
     # Ignore tmp files created by (unpatched) dvihps, in top dir
-    if re.search(r'(^|/)(head|body)\.tmp$', filepath):
-        return 'TYPE_ALWAYS_IGNORE', '', ''
-
+    'head.tmp': 'TYPE_ALWAYS_IGNORE',
+    'body.tmp': 'TYPE_ALWAYS_IGNORE',
     # Missing font error is fatal error
-    if re.search(r'(^|/)missfont\.log$', filepath):
-        return 'TYPE_ABORT', '', ''
+    'missfont.log': 'TYPE_ABORT',
+}
 
+# Extensions that determine the type on their own (case insensitive).
+_EXTENSION_TYPES_NOCASE = {
     # Auxillary TeX Files
-    if re.search(r'\.(sty|cls|mf|\d*pk|bbl|bst|tfm|ax|def|log|hrfldf|cfg'
-                 + r'|clo|inx|end|fgx|tbx|rtx|rty|toc)$',
-                 filepath, re.IGNORECASE):
-        return 'TYPE_TEXAUX', '', ''
-
+    'sty': 'TYPE_TEXAUX', 'cls': 'TYPE_TEXAUX', 'mf': 'TYPE_TEXAUX',
+    'bbl': 'TYPE_TEXAUX', 'bst': 'TYPE_TEXAUX', 'tfm': 'TYPE_TEXAUX',
+    'ax': 'TYPE_TEXAUX', 'def': 'TYPE_TEXAUX', 'log': 'TYPE_TEXAUX',
+    'hrfldf': 'TYPE_TEXAUX', 'cfg': 'TYPE_TEXAUX', 'clo': 'TYPE_TEXAUX',
+    'inx': 'TYPE_TEXAUX', 'end': 'TYPE_TEXAUX', 'fgx': 'TYPE_TEXAUX',
+    'tbx': 'TYPE_TEXAUX', 'rtx': 'TYPE_TEXAUX', 'rty': 'TYPE_TEXAUX',
+    'toc': 'TYPE_TEXAUX',
+    'nb': 'TYPE_NOTEBOOK',
+    'inp': 'TYPE_INPUT',
+}
+
+# Extensions that determine the type on their own (case sensitive).
+_EXTENSION_TYPES = {
     # Abstract
-    if re.search(r'\.abs$', filepath):
-        return 'TYPE_ABS', '', ''
-
+    'abs': 'TYPE_ABS',
     # Ignore xfig files
-    if re.search(r'\.fig$', filepath):
-        return 'TYPE_IGNORE', '', ''
+    'fig': 'TYPE_IGNORE',
+    'html': 'TYPE_HTML',
+    'htm': 'TYPE_HTML',
+    'cry': 'TYPE_ENCRYPTED',
+}
+
+# Packed font files (.pk, .300pk, ...) are TeX auxiliary files too.
+_PK_EXTENSION = re.compile(r'\d*pk', re.IGNORECASE)
+
+# Extensions that distinguish the various ZIP based formats.
+_ZIP_EXTENSION_TYPES = {
+    'jar': 'TYPE_JAR',
+    'odt': 'TYPE_ODF',
+    'docx': 'TYPE_DOCX',
+    'xlsx': 'TYPE_XLSX',
+}
+
+# Number of bytes read from the start of a file for the magic number checks.
+# Covers the 8 byte signatures, the POSIX tar 'ustar' marker at offset 257
+# and the first kilobyte searched for PDF/MAC markers.
+_HEADER_SIZE = 1024
+
+SCAN_BYTE_BUDGET = 8 * 1024 * 1024
+"""Default number of bytes the line scan may read before giving up."""
+
+
+def _get_scan_byte_budget() -> Optional[int]:
+    """Line scan budget from the ``TYPE_SCAN_BYTE_BUDGET`` setting."""
+    budget = int(get_application_config().get('TYPE_SCAN_BYTE_BUDGET',
+                                              SCAN_BYTE_BUDGET))
+    # Zero (or less) scans entire files
+    return budget if budget > 0 else None
+
+
+# Lines longer than this are cut off; the rest of the line is skipped.
+_MAX_LINE_LENGTH = 1024 * 1024
+
+# Postscript fonts are detected by a marker at the 1st or 7th byte of a line
+# (see _PS_FONT). The longest possible match is 6 + 2 + 26 bytes, so this
+# much lookback into preceding lines is enough to find any match.
+_PS_FONT_WINDOW = 34
+# Prefixed to the lookback when it does not begin at the start of the file.
+# Keeps '^' from matching at the (arbitrary) start of the window.
+_PS_FONT_NO_LINE_START = b'\x00' * 8
+
+_MAC_MARKER = re.compile(rb'#!/bin/csh -f\r#|(\r|^)begin \d{1,4}\s+\S.*\r[^\n]')
+
+# Line scan patterns
+_MULTI_PART_MIME = re.compile(rb'(^|\r)Content-type: ', re.IGNORECASE)
+_PS_FONT = re.compile(rb'^(......)?%!(PS-AdobeFont-1\.|FontType1|PS-Adobe-3\.0 Resource-Font)',
+                      re.MULTILINE | re.DOTALL)
+_PS_PC_FIRST_LINE = re.compile(b'^%*\004%!')
+_TEX_FORMAT = re.compile(rb'^\r?%&([^\s\n]+)')
+_HTML = re.compile(rb'<html[>\s]', re.IGNORECASE)
+_LATEX = re.compile(rb'(^|\r)\s*\\documentstyle')
+_LATEX2E = re.compile(rb'(^|\r)\s*\\documentclass')
+_TEX_HINT = re.compile(rb'(^|\r)\s*(\\font|\\magnification|\\input|\\def|\\special|'
+                       + rb'\\baselineskip|\\begin)')
+_AMSTEX = re.compile(rb'\\input\s+amstex')
+_TEX_PRIORITY_HINT = re.compile(rb'(^|\r)\s*\\(end|bye)(\s|$)')
+_TEX_PRIORITY2_HINT = re.compile(rb'\\(end|bye)(\s|$)')
+_TEX_MAC = re.compile(rb'(\\input *(harv|lanl)mac)|(\\input\s+phyzzx)')
+_BIBTEX = re.compile(rb'(^|\r)@(book|article|inbook|unpublished){', re.IGNORECASE)
+_UUENCODED = re.compile(rb'^begin \d{1,4}\s+[^\s]+\r?$')
+_TRAILING_CR = re.compile(b'\r$')
+_INCLUDEGRAPHICS = re.compile(rb'^[^%]*\\includegraphics[^%]*\.'
+                              + rb'(?:pdf|png|gif|jpg)\s?\}', re.IGNORECASE)
+_PDFOUTPUT = re.compile(rb'^[^%]*\\pdfoutput(?:\s+)?=(?:\s+)?1')
+
+# TODO: This was meant to strip TeX comments but has always been handed to
+# bytes.replace() as a literal. Kept as-is so type guesses do not change.
+_COMMENT_LITERAL = rb'\%[^\r]*'
+
+
+def _scan_lines(file: BinaryIO, byte_budget: Optional[int]) -> Iterator[bytes]:
+    """
+    Iterate over the lines of file using bounded time and memory.
 
-    if re.search(r'\.nb$', filepath, re.IGNORECASE):
-        return 'TYPE_NOTEBOOK', '', ''
+    Lines longer than ``_MAX_LINE_LENGTH`` are cut off at that length (the
+    line terminator is kept) and the remainder is skipped without being held
+    in memory. Iteration stops once ``byte_budget`` bytes have been read.
+    """
+    remaining = byte_budget
+    while remaining is None or remaining > 0:
+        line = file.readline(_MAX_LINE_LENGTH)
+        if not line:
+            return
+        consumed = len(line)
+        if len(line) == _MAX_LINE_LENGTH and not line.endswith(b'\n'):
+            while remaining is None or consumed < remaining:
+                rest = file.readline(_MAX_LINE_LENGTH)
+                consumed += len(rest)
+                if not rest:
+                    break
+                if rest.endswith(b'\n'):
+                    line += b'\n'
+                    break
+        if remaining is not None:
+            remaining -= consumed
+        yield line
+
+
+def _is_pdflatex_hint(line: bytes, line_no: int, limit: int) -> bool:
+    """Check whether line indicates PDFLaTeX source."""
+    return b'\\' in line \
+        and (_INCLUDEGRAPHICS.search(line) is not None
+             or (line_no < limit and _PDFOUTPUT.search(line) is not None))
 
-    if re.search(r'\.inp$', filepath, re.IGNORECASE):
-        return 'TYPE_INPUT', '', ''
 
-    if re.search(r'\.html?$', filepath):
-        return 'TYPE_HTML', '', ''
+# Select bewteen PDFLATEX and LATEX2e types.
+def _type_of_latex2e(lines: Iterator[bytes], count: int, seen_hint: bool) \
+        -> Tuple[str, str, str]:
+    """
+    Determine whether file is PDFLATEX or LATEX2e.
 
-    if re.search(r'\.cry$', filepath):
-        return 'TYPE_ENCRYPTED', '', ''
+    Called from the line scan once ``\\documentclass`` is found on line
+    ``count``. Lines up to and including ``count`` have already been checked
+    by the caller (``seen_hint``), so we only continue with the remaining
+    ``lines`` of the scan.
+    """
+    if seen_hint:
+        return 'TYPE_PDFLATEX', '', ''
 
-    # Check for zero size file size
-    if os.stat(filepath).st_size == 0:
-        return 'TYPE_IGNORE', '', ''
+    limit = count + 5
+    line_no = count + 1
+    for line in lines:
+        if _is_pdflatex_hint(line, line_no, limit):
+            return 'TYPE_PDFLATEX', '', ''
+        line_no += 1
+    return 'TYPE_LATEX2e', '', ''
 
-    # Checks requiring content inspection
+# Internal type routines. These routines are core of type guessing logic.
+
+def _guess_by_name(filename: str) -> Optional[str]:
+    """Guess type using file name and extension alone."""
+    if filename in _SPECIAL_FILE_NAMES:
+        return _SPECIAL_FILE_NAMES[filename]
+
+    _, dot, ext = filename.rpartition('.')
+    if not dot:
+        return None
+    if ext in _EXTENSION_TYPES:
+        return _EXTENSION_TYPES[ext]
+    lower_ext = ext.lower()
+    if lower_ext in _EXTENSION_TYPES_NOCASE:
+        return _EXTENSION_TYPES_NOCASE[lower_ext]
+    if _PK_EXTENSION.fullmatch(ext):
+        return 'TYPE_TEXAUX'
+    return None
 
-    # Check for compressed formats (compressed,gzip,bzips)
-    # Need to inspect first 8 input_bytes of file
-    fd = open(filepath, "rb")
-    input_bytes = fd.read(8)
-    fd.close()
+
+def _guess_by_header(filename: str, header: bytes) -> Optional[str]:
+    """Guess type using magic numbers at the start of the file."""
+    magic = header[0:8]
 
     # Compressed
-    if input_bytes[0] == 0x1F and input_bytes[1] == 0x9D:
-        return 'TYPE_COMPRESSED', '', ''
-    if input_bytes[0] == 0x1F and input_bytes[1] == 0x8B:
-        return 'TYPE_GZIPPED', '', ''
-    if input_bytes[0] == 0x42 and input_bytes[1] == 0x5A \
-            and input_bytes[2] == 0x68 and input_bytes[3] > 0x2F:
-        return 'TYPE_BZIP2', '', ''
+    if magic[0:2] == b'\x1f\x9d':
+        return 'TYPE_COMPRESSED'
+    if magic[0:2] == b'\x1f\x8b':
+        return 'TYPE_GZIPPED'
+    if magic[0:3] == b'BZh' and magic[3:4] > b'\x2f':
+        return 'TYPE_BZIP2'
+    if magic[0:6] == b'\xfd7zXZ\x00':
+        return 'TYPE_XZ'
 
     # POSIX tarfiles: look for the string 'ustar' at position 257
     # (There used to be additional code to detect non-POSIX tar files
     # which is not detected with above, no longer necessary)
-    file = open(filepath, "rb")
-    file.seek(257, 0)
-    tar_test = file.read(5)
-
-    if tar_test == b'ustar':
-        return 'TYPE_TAR', '', ''
+    if header[257:262] == b'ustar':
+        return 'TYPE_TAR'
 
     # DVI
-    if input_bytes[0] == 0xF7 and input_bytes[1] == 2:
-        return 'TYPE_DVI', '', ''
+    if magic[0:2] == b'\xf7\x02':
+        return 'TYPE_DVI'
 
-    if input_bytes[0:4] == b'GIF8':
-        return 'TYPE_IMAGE', '', ''
+    if magic[0:4] == b'GIF8':
+        return 'TYPE_IMAGE'
 
     # PNG IMAGE
-    if input_bytes[0:8] == b'\211PNG\r\n\032\n':
-        return 'TYPE_IMAGE', '', ''
+    if magic[0:8] == b'\211PNG\r\n\032\n':
+        return 'TYPE_IMAGE'
 
     # TIFF IMAGE
     # (big endian and little endian)
     # should really test b3 and b4 also, see https://en.wikipedia.org/wiki/List_of_file_signatures
-    if re.search(r'\.tif$', filepath):
-        if input_bytes[0] == 0x4D and input_bytes[1] == 0x4D:
-            return 'TYPE_IMAGE', '', ''
-        if input_bytes[0] == 0x49 and input_bytes[1] == 0x49:
-            return 'TYPE_IMAGE', '', ''
+    if filename.endswith('.tif') and magic[0:2] in (b'MM', b'II'):
+        return 'TYPE_IMAGE'
 
     # JPEG IMAGE
     # 2015-11: not sure about b4==0xEE, perhaps should add b4==0xDB || b4==0xE1
-    if input_bytes[0] == 0xFF and input_bytes[1] == 0xD8 and input_bytes[2] == 0xFF and \
-            (input_bytes[3] == 0xE0 or input_bytes[4] == 0xEE):
-        return 'TYPE_IMAGE', '', ''
+    if magic[0:3] == b'\xff\xd8\xff' \
+            and (magic[3:4] == b'\xe0' or magic[4:5] == b'\xee'):
+        return 'TYPE_IMAGE'
 
     # MPEG IMAGE
     # 2015-11: other seqs for MPEG, and certainly other movie types missing
-    if input_bytes[0] == 0x0 and input_bytes[1] == 0x0 \
-            and input_bytes[2] == 0x1 and input_bytes[3] == 0xB3:
-        return 'TYPE_ANIM', '', ''
+    if magic[0:4] == b'\x00\x00\x01\xb3':
+        return 'TYPE_ANIM'
 
     # Related formats: JAR, ODF,DOCX,XLSX,ZIP
-    option1 = b'PK\003\004'
-    option2 = b'PK00PK\003\004'
-
-    if (input_bytes[0:4] == option1) or (input_bytes[0:8] == option2):
-        if re.search(r'\.jar$', filepath, re.IGNORECASE):
-            return 'TYPE_JAR', '', ''
-        if re.search(r'\.odt$', filepath, re.IGNORECASE):
-            return 'TYPE_ODF', '', ''
-        if re.search(r'\.docx$', filepath, re.IGNORECASE):
-            return 'TYPE_DOCX', '', ''
-        if re.search(r'\.xlsx$', filepath, re.IGNORECASE):
-            return 'TYPE_XLSX', '', ''
-        return 'TYPE_ZIP', '', ''
+    if magic[0:4] == b'PK\003\004' or magic[0:8] == b'PK00PK\003\004':
+        _, dot, ext = filename.rpartition('.')
+        if dot and ext.lower() in _ZIP_EXTENSION_TYPES:
+            return _ZIP_EXTENSION_TYPES[ext.lower()]
+        return 'TYPE_ZIP'
 
     # RAR
-    option = b'Rar!'
-    if option == input_bytes[0:4]:
-        return 'TYPE_RAR', '', ''
+    if magic[0:4] == b'Rar!':
+        return 'TYPE_RAR'
 
     # DOS EPS
     #:0  belong          0xC5D0D3C6      DOS EPS Binary File
     # ->4 long            >0              Postscript starts at byte %d
-    if input_bytes[0] == 0xC5 and input_bytes[1] == 0xD0 \
-            and input_bytes[2] == 0xD3 and input_bytes[3] == 0xC6:
-        return 'TYPE_DOS_EPS', '', ''
+    if magic[0:4] == b'\xc5\xd0\xd3\xc6':
+        return 'TYPE_DOS_EPS'
 
-    # Fetch a chunck of data from file
-    file.seek(0, 0)
-    kilo = file.read(1024)
+    # Inspect the first kilobyte
+    if b'%PDF-' in header:
+        return 'TYPE_PDF'
 
-    if re.search(b'%PDF-', kilo):
-        return 'TYPE_PDF', '', ''
+    if _MAC_MARKER.search(header):
+        return 'TYPE_MAC'
 
-    if re.search(rb'#!/bin/csh -f\r#|(\r|^)begin \d{1,4}\s+\S.*\r[^\n]', kilo):
-        return 'TYPE_MAC', '', ''
+    return None
 
-    set = 0  # debugging
+
+def _guess_by_content(file: BinaryIO, byte_budget: Optional[int]) \
+        -> Tuple[str, str, str]:
+    """Scan file line by line looking for a wide variety of type indicators."""
 
     # Keep track of TeX files
     maybe_tex = 0
     maybe_tex_priority = 0
     maybe_tex_priority2 = 0
+    maybe_pdflatex = False
+
+    # Tail of the lines seen so far, for Postscript font detection
+    lookback = b""
 
-    # Scan file line by line looking for a wide variety of type indicators
-    file.seek(0, 0)
+    lines = _scan_lines(file, byte_budget)
     line_no = 1
-    accum = b""
-    for line in file:
-        #     if line_no <= 10:
-        # print("Line: " + str(line_no) + " : " + str(line))
-        # Ignore
-        if line_no <= 10 and re.search(rb'%auto-ignore', line):
-            return 'TYPE_IGNORE', '', ''
-        # TeXinfo
-        if line_no <= 10 and re.search(rb'\\input texinfo', line):
-            return 'TYPE_TEXINFO', '', ''
-        # Mult part document
-        if line_no <= 40 and re.search(rb'(^|\r)Content-type: ', line, re.IGNORECASE):
-            return 'TYPE_MULTI_PART_MIME', '', ''
-        # LaTeX2e/PDFLaTeX
-        if line[0:6] == '%!TEX ' and line_no == 1:
-            # TODO investigate reset of file pointer - understand what is going on
-            _type_of_latex2e(file, line_no)
-
-        # Accumulate what we've already seen
-        accum += line
-        # Match strings starting at either 1st or 7th byte. Use $accum
-        # to build string of file to this point as the preceding 6 chars
-        # may include \n
-        once = 0
-        if re.search(rb'PS-AdobeFont-1\.', accum):
-            if once:
-                print("ACCUM: " + str(accum[0:200]) + "\n")
-                once += 1
-
-        # Postscript Font
-        if line_no <= 7 and \
-                re.search(rb'^(......)?%!(PS-AdobeFont-1\.|FontType1|PS-Adobe-3\.0 Resource-Font)',
-                          accum, re.MULTILINE | re.DOTALL):
-            return 'TYPE_PS_FONT', '', ''
-
-        # Postscript
-        if re.search(b'^%!', line) and line_no == 1:
-            return 'TYPE_POSTSCRIPT', '', ''
-
-        # TODO MUST Test this adjusted regex
-        if ((line_no == 1 and re.search(b'(^%*\004%!)|(.*%!PS-Adobe)', line))
-                or (line_no <= 10 and re.search(rb'^%!PS', line) and maybe_tex == 0)):
-            return 'TYPE_PS_PC', '', ''
-
-        # LaTeX and MAC TeX
-        if line_no <= 12 and re.search(rb'^\r?%&([^\s\n]+)', line):
-            match = re.search(rb'^\r?%&([^\s\n]+)', line)
-            latex_type = ''
-            if match is not None:
-                latex_type = re.search(rb'^\r?%&([^\s\n]+)', line).group(1)
-            if (latex_type == 'latex209' or latex_type == 'biglatex'
-                    or latex_type == 'latex' or latex_type == 'LaTeX'):
-                return 'TYPE_LATEX', str(latex_type), ''
-            else:
+    for line in lines:
+        if line_no <= 40:
+            if line_no <= 10:
+                # Ignore
+                if b'%auto-ignore' in line:
+                    return 'TYPE_IGNORE', '', ''
+                # TeXinfo
+                if b'\\input texinfo' in line:
+                    return 'TYPE_TEXINFO', '', ''
+            # Mult part document
+            if _MULTI_PART_MIME.search(line):
+                return 'TYPE_MULTI_PART_MIME', '', ''
+
+        # Postscript Font. Match strings starting at either 1st or 7th byte.
+        # Use lookback to include the end of preceding lines as the preceding
+        # 6 chars may include \n
+        if line_no <= 7:
+            if _PS_FONT.search(lookback + line[:_PS_FONT_WINDOW]):
+                return 'TYPE_PS_FONT', '', ''
+            lookback += line[-_PS_FONT_WINDOW:]
+            if len(lookback) > _PS_FONT_WINDOW or len(line) > _PS_FONT_WINDOW:
+                lookback = _PS_FONT_NO_LINE_START + lookback[-_PS_FONT_WINDOW:]
+
+        if line_no == 1:
+            # Postscript
+            if line.startswith(b'%!'):
+                return 'TYPE_POSTSCRIPT', '', ''
+            # TODO MUST Test this adjusted regex
+            # (was '(^%*\004%!)|(.*%!PS-Adobe)', the second alternative is a
+            # plain substring test and does not need to backtrack)
+            if _PS_PC_FIRST_LINE.search(line) or b'%!PS-Adobe' in line:
+                return 'TYPE_PS_PC', '', ''
+
+        if line_no <= 12:
+            if line_no <= 10 and maybe_tex == 0 and line.startswith(b'%!PS'):
+                return 'TYPE_PS_PC', '', ''
+
+            # LaTeX and MAC TeX
+            match = _TEX_FORMAT.search(line)
+            if match:
+                latex_type = match.group(1)
+                # TODO: latex_type is bytes so this comparison never matches
+                # and we always report TYPE_TEX_MAC. Preserved from legacy code.
+                if (latex_type == 'latex209' or latex_type == 'biglatex'
+                        or latex_type == 'latex' or latex_type == 'LaTeX'):
+                    return 'TYPE_LATEX', str(latex_type), ''
                 return 'TYPE_TEX_MAC', str(latex_type), ''
 
-        # HTML
-        if line_no <= 10 and re.search(rb'<html[>\s]', line, re.IGNORECASE):
-            return 'TYPE_HTML', '', ''
-
-        # Include
-        if line_no <= 10 and re.search(rb'%auto-include', line):
-            return 'TYPE_INCLUDE', '', ''
-
-        # All subsequent checks have lines with '%' in them chopped.
-        #  if we need to look for a % then do it earlier!
-        orig = line
-        line = line.replace(rb'\%[^\r]*', b'')
-        # if line.replace(b'\%[^\r]*', b''):
-        if line != orig:
-            print("ORIG: " + str(orig))
-            print("New: ", str(line))
-        if re.search(rb'%[^\r]*', line):
-            #print("Found commented lineA" + str(line) + '\n')
-            line = line.replace(rb'\%[^\r]*', b'')
-            #print("Found commented lineB" + str(line) + '\n')
-
-        # LaTeX
-        if re.search(rb'(^|\r)\s*\\documentstyle', line):
-            return 'TYPE_LATEX', '', ''
-        # LaTeX2e/PDFLaTeX
-        if re.search(rb'(^|\r)\s*\\documentclass', line):
-            return _type_of_latex2e(file, line_no)
-
-        if re.search(rb'(^|\r)\s*(\\font|\\magnification|\\input|\\def|\\special|'
-                     + rb'\\baselineskip|\\begin)', line):
-            maybe_tex = 1
-            match = re.search(rb'(^|\r)\s*(\\font|\\magnification|\\input|\\def|'
-                              + rb'\\special|\\baselineskip|\\begin)',
-                              line).group(2)
-            if set == 0:
-                print("Set HINT TYPE_TEX 0 (line:[" + str(line_no) + "]\n" + str(match))
-                set = 1
-            if re.search(rb'\\input\s+amstex', line):
-                return 'TYPE_TEX_priority', '', ''
-        # Partianl Hint
-        if re.search(rb'(^|\r)\s*\\(end|bye)(\s|$)', line):
-            maybe_tex_priority = 1
-        # Partial Hint
-        if re.search(rb'\\(end|bye)(\s|$)', line):
-            maybe_tex_priority2 = 1
-
-        if re.search(rb'(\\input *(harv|lanl)mac)|(\\input\s+phyzzx)', line):
-            return 'TYPE_TEX_MAC', '', ''
+            if line_no <= 10:
+                # HTML
+                if _HTML.search(line):
+                    return 'TYPE_HTML', '', ''
+                # Include
+                if b'%auto-include' in line:
+                    return 'TYPE_INCLUDE', '', ''
+
+        if b'\\' in line:
+            # Remember PDFLaTeX indicators in case we run into \documentclass
+            if not maybe_pdflatex:
+                maybe_pdflatex = _is_pdflatex_hint(line, line_no, line_no + 1)
+
+            # All subsequent checks have lines with '%' in them chopped.
+            #  if we need to look for a % then do it earlier!
+            if _COMMENT_LITERAL in line:
+                line = line.replace(_COMMENT_LITERAL, b'')
+
+            # LaTeX
+            if _LATEX.search(line):
+                return 'TYPE_LATEX', '', ''
+            # LaTeX2e/PDFLaTeX
+            if _LATEX2E.search(line):
+                return _type_of_latex2e(lines, line_no, maybe_pdflatex)
+
+            if _TEX_HINT.search(line):
+                maybe_tex = 1
+                if _AMSTEX.search(line):
+                    return 'TYPE_TEX_priority', '', ''
+            # Partial Hint
+            if _TEX_PRIORITY_HINT.search(line):
+                maybe_tex_priority = 1
+            # Partial Hint
+            if _TEX_PRIORITY2_HINT.search(line):
+                maybe_tex_priority2 = 1
+
+            if _TEX_MAC.search(line):
+                return 'TYPE_TEX_MAC', '', ''
 
         # MetaFont
-        if re.search(rb'beginchar\(', line):
+        if b'beginchar(' in line:
             return 'TYPE_MF', '', ''
 
         # BibTeX
-        if re.search(rb'(^|\r)@(book|article|inbook|unpublished){', line, re.IGNORECASE):
+        if b'@' in line and _BIBTEX.search(line):
             return 'TYPE_BIBTEX', '', ''
 
         # Make some decisions using partial hints we've seen already
         # TeX,PC,UUENCODED
-        if re.search(rb'^begin \d{1,4}\s+[^\s]+\r?$', line):
+        if line.startswith(b'begin ') and _UUENCODED.search(line):
             if maybe_tex_priority:
                 return 'TYPE_TEX_priority', '', ''
             if maybe_tex:
-                print("Set TYPE_TEX 1\n")
                 return 'TYPE_TEX', '', ''
-            if re.search(b'\r$', line):
+            if _TRAILING_CR.search(line):
                 return 'TYPE_PC', '', ''
             return 'TYPE_UUENCODED', '', ''
 
-        if re.search(b'paper deliberately replaced by what little', line):
+        if b'paper deliberately replaced by what little' in line:
             return 'TYPE_ALWAYS_IGNORE', '', ''
         line_no += 1
 
-    # cleanup
-    file.close()
-
     # last chance guesses
     if maybe_tex_priority:
         return 'TYPE_TEX_priority', '', ''
     if maybe_tex_priority2:
         return 'TYPE_TEX_priority2', '', ''
     if maybe_tex:
-        print("Set TYPE_TEX 2\n")
         return 'TYPE_TEX', '', ''
 
     # Failed type identification
     return 'TYPE_FAILED', '', ''
 
 
+def guess_file_type(filepath: str,
+                    byte_budget: Optional[int] = SCAN_BYTE_BUDGET) \
+        -> Tuple[str, str, str]:
+    """
+    Guess the file type of filename.
+
+    Rules based on the file name are applied first. The remaining rules
+    inspect content: magic numbers are checked against a single header read
+    and the rest of the file is scanned line by line at most once.
+
+    Parameters
+    ----------
+    filepath : str
+        Path of file to inspect.
+    byte_budget : int or None
+        Maximum number of bytes read by the line scan. When the budget runs
+        out the guess is made from the hints seen so far. ``None`` scans the
+        entire file.
+
+    Returns
+    -------
+    tuple
+        Internal type (``TYPE_*``), TeX format, and error message.
+    """
+
+    # check whether file exists (new)
+    try:
+        stat = os.stat(filepath)
+    except (OSError, ValueError):
+        return 'TYPE_FAILED', '', ''
+    if not S_ISREG(stat.st_mode):
+        return 'TYPE_FAILED', '', ''
+
+    # Currently the following type identification relies on the extension
+    # to identify the type without inspecting content of file.
+    filename = os.path.basename(filepath)
+    file_type = _guess_by_name(filename)
+    if file_type:
+        return file_type, '', ''
+
+    # Check for zero size file size
+    if stat.st_size == 0:
+        return 'TYPE_IGNORE', '', ''
+
+    # Checks requiring content inspection
+    with open(filepath, 'rb') as file:
+        header = file.read(_HEADER_SIZE)
+        file_type = _guess_by_header(filename, header)
+        if file_type:
+            return file_type, '', ''
+
+        file.seek(0, 0)
+        return _guess_by_content(file, byte_budget)
+
+
 def is_tex_type(type: str) -> bool:
     """Check of type is TeX file."""
     if type in TEX_types:
@@ -499,7 +632,8 @@ def get_type_priority(type: str) -> int:
 def guess(filepath: str) -> str:
     """Return a cleaned up version of the internal file type minus
     TYPE prefix and lower cased."""
-    (type, tex_format, error) = guess_file_type(filepath)
+    (type, tex_format, error) = guess_file_type(filepath,
+                                                _get_scan_byte_budget())
     # Type returned does not include TYPE_ prefix
 
     if type.startswith('TYPE_'):
@@ -508,6 +642,24 @@ def guess(filepath: str) -> str:
     return type.lower()
 
 
+def guess_from_header(filename: str, header: bytes) -> Optional[str]:
+    """
+    Guess the type of a file from its name and first bytes alone.
+
+    Used for content that is not (yet) in a file, such as an upload stream.
+    Returns the same cleaned up type as :func:`guess`, or ``None`` if the
+    type can only be determined by scanning the content.
+    """
+    type = _guess_by_name(filename)
+    if not type:
+        if not header:
+            return None
+        type = _guess_by_header(filename, header[:_HEADER_SIZE])
+        if not type:
+            return None
+    return type[len('TYPE_'):].lower()
+
+
 def name(type: str) -> str:
     """Return the cleaned up type of the file."""
     if not type.startswith('TYPE_'):
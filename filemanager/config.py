@@ -47,5 +47,62 @@ ARXIV_LIBRARY_URL = os.environ.get('ARXIV_LIBRARY_URL',
 # Need to set maximum allowed upload
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024
 
+# Limits on the content unpacked from an upload: size of each file, total
+# size and number of files and directories.
+MAX_UNPACKED_FILE_SIZE = int(os.environ.get('MAX_UNPACKED_FILE_SIZE',
+                                            64 * 1024 * 1024))
+MAX_UNPACKED_SIZE = int(os.environ.get('MAX_UNPACKED_SIZE', 512 * 1024 * 1024))
+MAX_UNPACKED_MEMBERS = int(os.environ.get('MAX_UNPACKED_MEMBERS', 10000))
+
+# Number of bytes of a file read to guess its type from its content (0 reads
+# entire files).
+TYPE_SCAN_BYTE_BUDGET = int(os.environ.get('TYPE_SCAN_BYTE_BUDGET',
+                                           8 * 1024 * 1024))
+
+# Number of threads decompressing the members of zip archives.
+UNZIP_THREADS = int(os.environ.get('UNZIP_THREADS',
+                                   min(4, os.cpu_count() or 1)))
+
 UPLOAD_BASE_DIRECTORY = os.environ.get('UPLOAD_BASE_DIRECTORY',
                                        '/tmp/filemanagment/submissions')
+
+# Unpack uploaded tar archives as they are read, instead of saving them to
+# the workspace first.
+STREAM_UPLOAD_ARCHIVES = os.environ.get('STREAM_UPLOAD_ARCHIVES', '1')
+
+# Keep a copy of each uploaded archive in the workspace removed directory.
+RETAIN_UPLOAD_ARCHIVES = os.environ.get('RETAIN_UPLOAD_ARCHIVES', '1')
+
+# Generate the content package (GET /<upload_id>/content) as it is sent,
+# instead of writing it to the workspace first.
+STREAM_CONTENT_PACKAGE = os.environ.get('STREAM_CONTENT_PACKAGE', '0')
+
+# gzip compression level (0-9) of the content package, and number of threads
+# compressing it.
+CONTENT_COMPRESSLEVEL = int(os.environ.get('CONTENT_COMPRESSLEVEL', 9))
+CONTENT_COMPRESS_THREADS = int(os.environ.get('CONTENT_COMPRESS_THREADS',
+                                              min(4, os.cpu_count() or 1)))
+
+# Assemble the content package from gzip members compressed (and cached in
+# the workspace) per file, so that only changed files are compressed again.
+# The package is then a multi-member gzip stream.
+CONTENT_PACKAGE_CACHE = os.environ.get('CONTENT_PACKAGE_CACHE', '0')
+
+# Make the content package (and so its checksum) reproducible: members are
+# sorted, have no owner, normalized permissions and the SOURCE_DATE_EPOCH
+# modification time (seconds since the epoch).
+REPRODUCIBLE_CONTENT_PACKAGE = os.environ.get('REPRODUCIBLE_CONTENT_PACKAGE',
+                                              '0')
+SOURCE_DATE_EPOCH = int(os.environ.get('SOURCE_DATE_EPOCH', 0))
+
+# Unpack and check uploaded files in a subprocess with limits on CPU time
+# (seconds), address space and size of files written (bytes) and wall-clock
+# time (seconds). Each server process keeps a pool of up to SANDBOX_WORKERS
+# worker subprocesses.
+SANDBOX_UPLOADS = os.environ.get('SANDBOX_UPLOADS', '0')
+SANDBOX_WORKERS = int(os.environ.get('SANDBOX_WORKERS', os.cpu_count() or 1))
+SANDBOX_CPU_SECONDS = int(os.environ.get('SANDBOX_CPU_SECONDS', 120))
+SANDBOX_MEMORY = int(os.environ.get('SANDBOX_MEMORY', 2 * 1024 * 1024 * 1024))
+SANDBOX_OUTPUT_SIZE = int(os.environ.get('SANDBOX_OUTPUT_SIZE',
+                                         512 * 1024 * 1024))
+SANDBOX_TIMEOUT = int(os.environ.get('SANDBOX_TIMEOUT', 300))
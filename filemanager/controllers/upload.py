@@ -342,6 +342,33 @@ def client_delete_all_files(upload_id: str) -> Response:
     return response_data, status_code, {}
 
 
+def _upload_summary(upload_db_data: Upload,
+                    upload_workspace: 'filemanager.process.upload.Upload') \
+        -> Response:
+    """Respond to an upload request with the upload summary saved in the DB."""
+    # Upload action itself has very simple response
+    headers = {'Location': url_for('upload_api.upload_files',
+                                   upload_id=upload_db_data.upload_id)}
+
+    status_code = status.HTTP_201_CREATED
+
+    response_data = {
+        'upload_id': upload_db_data.upload_id,
+        'upload_total_size': upload_workspace.total_upload_size,
+        'created_datetime': upload_db_data.created_datetime,
+        'modified_datetime': upload_db_data.modified_datetime,
+        'start_datetime': upload_db_data.lastupload_start_datetime,
+        'completion_datetime': upload_db_data.lastupload_completion_datetime,
+        'files': json.loads(upload_db_data.lastupload_file_summary),
+        'errors': json.loads(upload_db_data.lastupload_logs),
+        'upload_status': upload_db_data.lastupload_upload_status,
+        'workspace_state': upload_db_data.state,
+        'lock_state': upload_db_data.lock
+    }
+    logger.info("%s: Generating upload summary.", upload_db_data.upload_id)
+    return response_data, status_code, headers
+
+
 def upload(upload_id: int, file: FileStorage, archive: str,
            user: auth_domain.User, ancillary: bool = False) -> Response:
     """Upload individual files or compressed archive. Unpack and add
@@ -465,12 +492,23 @@ def upload(upload_id: int, file: FileStorage, archive: str,
             logger.info("%s: Upload files to existing "
                         "workspace: file='%s'", upload_db_data.upload_id, file.filename)
 
-            # Keep track of how long processing upload_db_data takes
-            start_datetime = datetime.now(UTC)
-
             # Create Upload object
             upload_workspace = filemanager.process.upload.Upload(upload_id)
 
+            # Clients (browser retries especially) often send the same upload
+            # again. If the workspace is still in the state that upload left
+            # it in, report the summary saved last time.
+            if upload_db_data.lastupload_file_summary is not None \
+                    and upload_db_data.lastupload_logs is not None \
+                    and upload_workspace.is_repeated_upload(file, ancillary=ancillary):
+                logger.info("%s: Upload is identical to last upload: "
+                            "file='%s'. Returning saved summary.",
+                            upload_db_data.upload_id, file.filename)
+                return _upload_summary(upload_db_data, upload_workspace)
+
+            # Keep track of how long processing upload_db_data takes
+            start_datetime = datetime.now(UTC)
+
             # Process upload_db_data
             upload_workspace.process_upload(file, ancillary=ancillary)
 
@@ -521,27 +559,7 @@ def upload(upload_id: int, file: FileStorage, archive: str,
             # or maybe just report errors like:
             #    logger.info(f"{upload_db_data.upload_id}: Finished processing ...")
 
-            # Upload action itself has very simple response
-            headers = {'Location': url_for('upload_api.upload_files',
-                                           upload_id=upload_db_data.upload_id)}
-
-            status_code = status.HTTP_201_CREATED
-
-            response_data = {
-                'upload_id': upload_db_data.upload_id,
-                'upload_total_size': upload_workspace.total_upload_size,
-                'created_datetime': upload_db_data.created_datetime,
-                'modified_datetime': upload_db_data.modified_datetime,
-                'start_datetime': upload_db_data.lastupload_start_datetime,
-                'completion_datetime': upload_db_data.lastupload_completion_datetime,
-                'files': json.loads(upload_db_data.lastupload_file_summary),
-                'errors': json.loads(upload_db_data.lastupload_logs),
-                'upload_status': upload_db_data.lastupload_upload_status,
-                'workspace_state': upload_db_data.state,
-                'lock_state': upload_db_data.lock
-            }
-            logger.info("%s: Generating upload summary.", upload_db_data.upload_id)
-            return response_data, status_code, headers
+            return _upload_summary(upload_db_data, upload_workspace)
 
     except IOError as e:
         logger.error("%s: File upload_db_data request failed "
@@ -599,21 +617,9 @@ def upload_summary(upload_id: int) -> Response:
         else:
             logger.info("%s: Upload summary request.", upload_db_data.upload_id)
 
-            # Create Upload object
-            upload_workspace = filemanager.process.upload.Upload(upload_id)
-            file_list = upload_workspace.create_file_list()
-
-            details_list = []
-            for fileObj in file_list:
-                file_details = {
-                    'name': fileObj.name,
-                    'public_filepath': fileObj.public_filepath,
-                    'size': fileObj.size,
-                    'type': fileObj.type_string,
-                    'modified_datetime': fileObj.modified_datetime
-                }
-                if not fileObj.removed:
-                    details_list.append(file_details)
+            # Read-only view of upload workspace
+            upload_workspace = filemanager.process.upload.UploadView(upload_id)
+            details_list = upload_workspace.manifest.summary()
 
             status_code = status.HTTP_200_OK
             response_data = {
@@ -911,15 +917,16 @@ def check_upload_content_exists(upload_id: int) -> Response:
         raise NotFound(UPLOAD_NOT_FOUND)
 
     logger.info("%s: Upload content summary request.", upload_id)
-    upload_workspace = filemanager.process.upload.Upload(upload_id)
+    upload_workspace = filemanager.process.upload.UploadView(upload_id)
 
     # This will potentially build content package if it does not exist
     checksum = upload_workspace.content_checksum()
     modified = ''
     size = 0
 
-    # Double check package exists
-    if upload_workspace.content_package_exists:
+    # Double check package exists (a streamed package is never written)
+    if not upload_workspace.stream_content_package \
+            and upload_workspace.content_package_exists:
         modified = upload_workspace.content_package_modified
         size = upload_workspace.content_package_size
         return {}, status.HTTP_200_OK, {'ETag': checksum,
@@ -941,13 +948,17 @@ def get_upload_content(upload_id: int) -> Response:
 
     if upload_db_data is None:
         raise NotFound(UPLOAD_NOT_FOUND)
-    upload_workspace = filemanager.process.upload.Upload(upload_id)
-    checksum = upload_workspace.content_checksum()
+    upload_workspace = filemanager.process.upload.UploadView(upload_id)
+    if upload_workspace.stream_content_package:
+        # The checksum of a streamed package is only known up front if it
+        # was generated before; otherwise it is cached as the package is sent.
+        checksum = upload_workspace.cached_content_checksum()
+    else:
+        checksum = upload_workspace.content_checksum()
     filepointer = upload_workspace.get_content()
-    headers = {
-        "Content-disposition": f"filename={filepointer.name}",
-        'ETag': checksum
-    }
+    headers = {"Content-disposition": f"filename={filepointer.name}"}
+    if checksum is not None:
+        headers['ETag'] = checksum
     return filepointer, status.HTTP_200_OK, headers
 
 
@@ -968,7 +979,7 @@ def check_upload_file_content_exists(upload_id: int, public_file_path: str) -> R
 
     try:
 
-        upload_workspace = filemanager.process.upload.Upload(upload_id)
+        upload_workspace = filemanager.process.upload.UploadView(upload_id)
 
         # file exists
         if upload_workspace.content_file_exists(public_file_path):
@@ -1037,7 +1048,7 @@ def get_upload_file_content(upload_id: int, public_file_path: str) -> Response:
 
     try:
 
-        upload_workspace = filemanager.process.upload.Upload(upload_id)
+        upload_workspace = filemanager.process.upload.UploadView(upload_id)
 
         # Returns path if file exists
         if upload_workspace.content_file_exists(public_file_path):
@@ -1107,7 +1118,7 @@ def check_upload_source_log_exists(upload_id: int) -> Response:
         raise NotFound(UPLOAD_NOT_FOUND)
 
     logger.info("%s: Test for source log.", upload_id)
-    upload_workspace = filemanager.process.upload.Upload(upload_id)
+    upload_workspace = filemanager.process.upload.UploadView(upload_id)
 
     checksum = upload_workspace.source_log_checksum
     size = upload_workspace.source_log_size
@@ -1139,7 +1150,7 @@ def get_upload_source_log(upload_id: int) -> Response:
     if upload_db_data is None:
         raise NotFound(UPLOAD_NOT_FOUND)
 
-    upload_workspace = filemanager.process.upload.Upload(upload_id)
+    upload_workspace = filemanager.process.upload.UploadView(upload_id)
 
     checksum = upload_workspace.source_log_checksum
     size = upload_workspace.source_log_size
@@ -1,15 +1,25 @@
 """Provides functions that sanitizes :class:`.Upload."""
 
+import fcntl
+import functools
 import os
 import re
 from datetime import datetime
 from pytz import UTC
 import shutil
 import tarfile
+import tempfile
+import threading
+import time
+import zlib
+import lzma
 import logging
-from hashlib import md5
+from hashlib import md5, sha256
 from base64 import b64encode
 import io
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional, Tuple
 
 from werkzeug.exceptions import BadRequest, NotFound, SecurityError
 from werkzeug.datastructures import FileStorage
@@ -17,7 +27,16 @@ from werkzeug.utils import secure_filename
 
 from arxiv.base.globals import get_application_config
 from filemanager.arxiv.file import File as File
-from filemanager.utilities.unpack import unpack_archive
+from filemanager.arxiv.file_type import guess_from_header
+from filemanager.utilities.unpack import ARCHIVE_TYPES, DIRECTORY_MODE, \
+    FILE_MODE, check_directory, unpack_file, unpack_stream
+from filemanager.utilities.type_cache import TypeCache
+from filemanager.utilities.upload_size import UnpackBudget
+from filemanager.utilities.manifest import Manifest, file_checksum
+from filemanager.utilities import sandbox
+from filemanager.utilities.content_package import ContentStream, generate, \
+    generate_cached, load_checksum, save_checksum, DEFAULT_COMPRESSLEVEL, \
+    DEFAULT_COMPRESS_THREADS, READ_SIZE
 
 UPLOAD_FILE_EMPTY = 'file payload is zero length'
 UPLOAD_DELETE_FILE_FAILED = 'unable to delete file'
@@ -25,6 +44,14 @@ UPLOAD_DELETE_ALL_FILE_FAILED = 'unable to delete all file'
 UPLOAD_FILE_NOT_FOUND = 'file not found'
 UPLOAD_WORKSPACE_NOT_FOUND = 'workspcae not found'
 
+STREAM_HEADER_SIZE = 4096
+"""Bytes read from the start of an upload to check if it can be streamed."""
+
+DIGEST_CHUNK_SIZE = 1024 * 1024
+"""Bytes of an upload read at a time to calculate its digest."""
+
+_workspace_locks = threading.local()
+
 
 def _get_base_directory() -> str:
     config = get_application_config()
@@ -32,10 +59,68 @@ def _get_base_directory() -> str:
                       '/tmp/filemanagment/submissions')
 
 
-class Upload:
-    """Handle uploaded files: unzipping, putting in the right place, doing
-various file checks that might cause errors to be displayed to the
-submitter."""
+def _get_config_flag(key: str, default: bool) -> bool:
+    """Get a boolean setting, which may come from the environment."""
+    value = get_application_config().get(key, default)
+    if isinstance(value, str):
+        return value.strip().lower() not in ('', '0', 'false', 'no', 'off')
+    return bool(value)
+
+
+def _held_workspace_locks() -> set:
+    """Upload ids of the workspaces whose lock the current thread holds."""
+    if not hasattr(_workspace_locks, 'held'):
+        _workspace_locks.held = set()
+    return _workspace_locks.held
+
+
+def _with_workspace_lock(method: Callable) -> Callable:
+    """Run an :class:`Upload` method holding the workspace lock."""
+    @functools.wraps(method)
+    def locked_method(self: 'Upload', *args, **kwargs):
+        with self.workspace_lock():
+            return method(self, *args, **kwargs)
+    return locked_method
+
+
+def _scan_tree(top: str) \
+        -> Iterator[Tuple[List[os.DirEntry], List[os.DirEntry]]]:
+    """
+    Walk directory tree like :func:`os.walk`, but yield directory entries.
+
+    For each directory (top-down, in the same order as :func:`os.walk`)
+    yields the :class:`os.DirEntry` objects of its subdirectories and files,
+    so that callers can reuse the stat information cached on them.
+    """
+    pending = [top]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as scan:
+                entries = list(scan)
+        except OSError:
+            continue
+        directories = []
+        files = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            (directories if is_dir else files).append(entry)
+        yield directories, files
+        # Do not follow symbolic links to directories (like os.walk)
+        pending.extend(reversed([entry.path for entry in directories
+                                 if not entry.is_symlink()]))
+
+
+class UploadView:
+    """
+    Read-only view of an upload workspace.
+
+    Unlike :class:`Upload`, creating a view has no side effects: it does not
+    create workspace directories, attach a source log handler or scan the
+    source directory. Use it for requests that only inspect the workspace.
+    """
 
     SOURCE_PREFIX = 'src'
     """The name of the source directory within the upload workspace."""
@@ -46,9 +131,24 @@ submitter."""
     ANCILLARY_PREFIX = 'anc'
     """The directory within source directory where ancillary files are kept."""
 
+    PACKAGE_CACHE_PREFIX = 'package_cache'
+    """The directory where compressed content package members are cached."""
+
+    TYPE_CACHE_FILENAME = 'type_cache.json'
+    """The name of the file type cache within the upload workspace."""
+
+    MANIFEST_FILENAME = 'manifest.json'
+    """The name of the file manifest within the upload workspace."""
+
+    CONTENT_CHECKSUM_FILENAME = 'content_checksum.json'
+    """The name of the content package checksum within the upload workspace."""
+
+    LOCK_FILENAME = 'workspace.lock'
+    """The name of the lock file within the upload workspace."""
+
     def __init__(self, upload_id: int):
         """
-        Initialize Upload object.
+        Initialize read-only view of an upload workspace.
 
         Parameters
         ----------
@@ -57,6 +157,608 @@ submitter."""
 
         """
         self.__upload_id = upload_id
+        self.__type_cache = None
+        self.__manifest = None
+        self.__scan: Optional[Tuple[int, float]] = None
+
+    @property
+    def upload_id(self) -> int:
+        """Return upload identifier.
+
+        The unique identifier for upload.
+
+        """
+        return self.__upload_id
+
+    def resolve_public_file_path(self, public_file_path: str) -> File:
+        """
+        Resolve a relative file path to a arXiv File object.
+
+        Note: We are being very cautious here and spending most of this routine
+        checking for deviant relevant file paths.
+
+        Returns
+        -------
+        Null if file does not exist.
+        Otherwise returns fully qualified path to content file.
+
+        """
+        # Sanitize file name
+        filename = secure_filename(public_file_path)
+
+        # Our UI will never attempt to delete a file path containing components that attempt
+        # to escape out of workspace and this would be removed by secure_filename().
+        # This error must be propagated to wider notification level beyond source log.
+        if re.search(r'^/|^\.\./|\.\./', public_file_path):
+            # should never start with '/' or '../' or contain '..' anywhere in path.
+            message = f"SECURITY WARNING: file to delete contains illegal constructs: '{public_file_path}'"
+            self.log(message)
+            raise SecurityError(message)
+
+        # Secure filename should not change length of valid file path (but it will
+        # mess with directory slashes '/')
+        # TODO: Come up with better file path checker. We allow subdirectories
+        # TODO: and secure_filename strips them (/ => _)
+        # The length of file path should not change (need to check secure_filename)
+        # so if length changes generate warning.
+        if len(public_file_path) != len(filename):
+            message = f"SECURITY WARNING: sanitized file is different length: '{filename}' <=> '{public_file_path}'"
+            self.log(message)
+            raise SecurityError(message)
+
+        # Resolve relative path of file to filesystem
+        source_directory = self.get_source_directory()
+        file_path = os.path.join(source_directory, filename)
+
+        # secure_filename will eliminate '/' making paths to subdirectories
+        # impossible to resolve. Make assumption we caught bad actors with checks above.
+
+        # Check if original path might be subdirectory.
+        # We've made it past serious threat checks above.
+        if not os.path.exists(file_path) and re.search(r'_', filename) and re.search(r'/', public_file_path):
+            if len(filename) == len(public_file_path):
+                # May be issue of directory delimiter converted to '_'
+                # Check if raw path exists
+                check_path = os.path.join(source_directory, public_file_path)
+                if os.path.exists(check_path):
+                    self.log(f"Path appears to be valid and contain "
+                             + f"subdirectory: '{public_file_path}' <=> '{filename}'")
+                    # TODO: Can someone hurt us here? Is it now safe to use original
+                    # TODO: path or should I edit 'secure' path. I believe what I'm doing is ok.
+                    file_path = check_path
+                    filename = public_file_path
+
+        # We have a file path that exists
+        if os.path.exists(file_path):
+            # Build arguments for File object
+            file_obj = File(file_path, source_directory, self.type_cache)
+            return file_obj
+        else:
+            return None
+
+    def get_upload_directory(self) -> str:
+        """
+        Get top level workspace directory for submission."
+
+        Returns
+        -------
+        str
+            Top level directory path for upload workspace.
+        """
+
+        root_path = _get_base_directory()
+        upload_directory = os.path.join(root_path, str(self.upload_id))
+        return upload_directory
+
+    def get_source_directory(self) -> str:
+        """Return directory where source files get deposited."""
+        return os.path.join(self.get_upload_directory(), self.SOURCE_PREFIX)
+
+    def get_removed_directory(self) -> str:
+        """Get directory where source archive files get moved when unpacked."""
+        return os.path.join(self.get_upload_directory(), self.REMOVED_PREFIX)
+
+    def get_package_cache_directory(self) -> str:
+        """Get directory where compressed content package members are cached."""
+        return os.path.join(self.get_upload_directory(),
+                            self.PACKAGE_CACHE_PREFIX)
+
+    @property
+    def type_cache(self) -> TypeCache:
+        """Cache of detected file types for files in the source directory."""
+        if self.__type_cache is None:
+            cache_path = os.path.join(self.get_upload_directory(),
+                                      self.TYPE_CACHE_FILENAME)
+            self.__type_cache = TypeCache(cache_path,
+                                          self.get_source_directory())
+        return self.__type_cache
+
+    @property
+    def manifest(self) -> Manifest:
+        """
+        Index of files in the source directory, as saved by :class:`Upload`.
+
+        Views only read the manifest. If the workspace does not have one,
+        it is not :attr:`Manifest.loaded` and has no entries.
+        """
+        if self.__manifest is None:
+            manifest_path = os.path.join(self.get_upload_directory(),
+                                         self.MANIFEST_FILENAME)
+            self.__manifest = Manifest(manifest_path,
+                                       self.get_source_directory())
+        return self.__manifest
+
+    def reload_sidecars(self) -> None:
+        """Forget the manifest and type cache, so that they are read again."""
+        self.__manifest = None
+        self.__type_cache = None
+        self.__scan = None
+
+    def _scan_source_directory(self) -> Tuple[int, float]:
+        """
+        Stat the files in the source directory, for lack of a manifest.
+
+        Returns
+        -------
+        tuple
+            Total size of the files, and the newest modification time of the
+            files and directories (as seconds since the epoch), which is
+            the modification time a manifest rebuilt by :class:`Upload`
+            would have.
+        """
+        if self.__scan is None:
+            source_directory = self.get_source_directory()
+            size = 0
+            modified = 0.0
+            if os.path.isdir(source_directory):
+                modified = os.stat(source_directory).st_mtime
+            for directories, files in _scan_tree(source_directory):
+                for is_file, entries in ((False, directories), (True, files)):
+                    for entry in entries:
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        modified = max(modified, stat.st_mtime)
+                        if is_file:
+                            size += stat.st_size
+            self.__scan = (size, modified)
+        return self.__scan
+
+    def get_upload_source_log_path(self):
+        """Generate path for upload source log."""
+        return os.path.join(self.get_upload_directory(), 'source.log')
+
+    def log(self, message: str):
+        """Views do not write to the upload source log."""
+
+    @property
+    def total_upload_size(self) -> int:
+        """Total size of client's uploaded content, from the manifest."""
+        if not self.manifest.loaded:
+            return self._scan_source_directory()[0]
+        return self.manifest.total_size
+
+    # Content package routines
+
+    def get_content_path(self) -> str:
+        """
+        Get the path for the packed content tarball.
+
+        Note that the tarball itself may or may not exist yet.
+        """
+        return os.path.join(self.get_upload_directory(),
+                            f'{self.upload_id}.tar.gz')
+
+    def pack_content(self) -> str:
+        """
+        Pack the entire source directory into a tarball.
+
+        The checksum of the tarball is computed as it is written, and cached
+        along with the modification time of the tarball.
+        """
+        content_path = self.get_content_path()
+        modified = self.last_modified
+        options = self._content_options()
+        stream = ContentStream(self._generate_content(options), content_path)
+        # Write to a temporary file and rename so that concurrent downloads
+        # never see a partially written tarball.
+        tmp_path = f'{content_path}.{os.getpid()}.tmp'
+        try:
+            with stream, open(tmp_path, 'wb') as package:
+                shutil.copyfileobj(stream, package, READ_SIZE)
+            os.replace(tmp_path, content_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        save_checksum(self.get_content_checksum_path(), modified,
+                      stream.checksum, stream.size,
+                      os.stat(content_path).st_mtime_ns, options)
+        return content_path
+
+    @property
+    def last_modified(self):
+        """The time of the most recent change to a file in the workspace."""
+        if not self.manifest.loaded:
+            return datetime.fromtimestamp(self._scan_source_directory()[1],
+                                          tz=UTC)
+        return self.manifest.modified
+
+    def get_content(self) -> io.BytesIO:
+        """
+        Get a file-pointer for the packed content tarball.
+
+        If the content package is streamed (see
+        :attr:`stream_content_package`) it is generated as it is read.
+        """
+        if self.stream_content_package:
+            return self.stream_content()
+        if not os.path.exists(self.get_content_path()):
+            self.pack_content()
+        return open(self.get_content_path(), 'rb')
+
+    @property
+    def stream_content_package(self) -> bool:
+        """
+        Whether the content package is generated as it is sent.
+
+        Set with ``STREAM_CONTENT_PACKAGE``. The package is then never
+        written to the workspace, and its checksum is cached once it has
+        been generated in full.
+        """
+        return _get_config_flag('STREAM_CONTENT_PACKAGE', False)
+
+    def get_content_checksum_path(self) -> str:
+        """Get the path of the cached content package checksum."""
+        return os.path.join(self.get_upload_directory(),
+                            self.CONTENT_CHECKSUM_FILENAME)
+
+    def cached_content_checksum(self) -> Optional[str]:
+        """
+        Checksum of the generated content package, if known.
+
+        The cached checksum is only used while no file in the workspace has
+        changed since the package was generated, with the same options.
+        """
+        return load_checksum(self.get_content_checksum_path(),
+                             self.last_modified,
+                             options=self._content_options())
+
+    def stream_content(self) -> ContentStream:
+        """
+        Generate the content package as it is read.
+
+        The checksum of the package is cached once it has been read to the
+        end.
+        """
+        checksum_path = self.get_content_checksum_path()
+        modified = self.last_modified
+        options = self._content_options()
+
+        def cache_checksum(checksum: str, size: int) -> None:
+            save_checksum(checksum_path, modified, checksum, size,
+                          options=options)
+
+        return ContentStream(self._generate_content(options),
+                             self.get_content_path(), cache_checksum)
+
+    def _content_options(self) -> dict:
+        """
+        Configured options that the content package depends on.
+
+        With ``CONTENT_PACKAGE_CACHE`` set, the package is assembled from
+        compressed members cached per file (see
+        :func:`filemanager.utilities.content_package.generate_cached`). With
+        ``REPRODUCIBLE_CONTENT_PACKAGE`` set, the package only depends on the
+        names and contents of the files, and all members have the
+        ``SOURCE_DATE_EPOCH`` modification time.
+        """
+        config = get_application_config()
+        source_date_epoch = None
+        if _get_config_flag('REPRODUCIBLE_CONTENT_PACKAGE', False):
+            source_date_epoch = int(config.get('SOURCE_DATE_EPOCH', 0))
+        return {
+            'compresslevel': int(config.get('CONTENT_COMPRESSLEVEL',
+                                            DEFAULT_COMPRESSLEVEL)),
+            'cached': _get_config_flag('CONTENT_PACKAGE_CACHE', False),
+            'source_date_epoch': source_date_epoch
+        }
+
+    def _generate_content(self, options: dict) -> Iterator[bytes]:
+        """Generate the content package with the given options."""
+        threads = int(get_application_config().get('CONTENT_COMPRESS_THREADS',
+                                                    DEFAULT_COMPRESS_THREADS))
+        if options['cached']:
+            return generate_cached(self.get_source_directory(),
+                                   self.get_package_cache_directory(),
+                                   options['compresslevel'], threads,
+                                   options['source_date_epoch'])
+        return generate(self.get_source_directory(), options['compresslevel'],
+                        threads, options['source_date_epoch'])
+
+    @property
+    def content_package_exists(self) -> bool:
+        return os.path.exists(self.get_content_path())
+
+    @property
+    def content_package_modified(self) -> datetime:
+        return datetime.fromtimestamp(
+            os.path.getmtime(self.get_content_path()),
+            tz=UTC
+        )
+
+    @property
+    def content_package_size(self) -> int:
+        return os.path.getsize(self.get_content_path())
+
+    @property
+    def content_package_stale(self) -> bool:
+        return self.last_modified > self.content_package_modified
+
+    def content_checksum(self) -> str:
+        """Return b64-encoded MD5 hash of the packed content tarball.
+
+        Triggers building content package when pre-existing package is not found or stale
+        relative to source files (or was built with other options). The
+        checksum is cached when the package is built, so that it need not be
+        read again. A streamed package is generated (but not kept) when its
+        checksum is not cached."""
+        if self.stream_content_package:
+            checksum = self.cached_content_checksum()
+            if checksum is None:
+                with self.stream_content() as stream:
+                    while stream.read(READ_SIZE):
+                        pass
+                checksum = stream.checksum
+            return checksum
+
+        content_path = self.get_content_path()
+        checksum_path = self.get_content_checksum_path()
+        options = self._content_options()
+        checksum = None
+        try:
+            package = os.stat(content_path)
+        except FileNotFoundError:
+            package = None
+        if package is not None and self.last_modified \
+                <= datetime.fromtimestamp(package.st_mtime, tz=UTC):
+            checksum = load_checksum(checksum_path, self.last_modified,
+                                     package.st_mtime_ns, options)
+        if checksum is None:
+            # Missing or stale, packed with other options, or packed before
+            # checksums were cached
+            self.pack_content()
+            package = os.stat(content_path)
+            checksum = load_checksum(checksum_path, self.last_modified,
+                                     package.st_mtime_ns, options)
+        if checksum is None:
+            # The checksum could not be cached
+            hash_md5 = md5()
+            with open(content_path, "rb") as f:
+                for chunk in iter(lambda: f.read(READ_SIZE), b""):
+                    hash_md5.update(chunk)
+            checksum = b64encode(hash_md5.digest()).decode('utf-8')
+        return checksum
+
+    # Content file routines
+
+    def content_file_path(self, public_file_path: str) -> str:
+        """
+        Return the absolute path of content file given relative pointer.
+
+        Returns
+        -------
+        Null if file does not exist.
+        """
+        file_obj = self.resolve_public_file_path(public_file_path)
+
+        if file_obj is not None:
+            return file_obj.filepath
+        else:
+            return ""
+
+    def content_file_exists(self, public_file_path: str) -> bool:
+        """
+        Indicate whether files exists.
+
+        Parameters
+        ----------
+        public_file_path : str
+            Relative path of file in upload workspace.
+
+        Returns
+        -------
+        True if file exists, False otherwise.
+
+        """
+
+        file_obj = self.resolve_public_file_path(public_file_path)
+
+        if file_obj is not None:
+            return os.path.exists(file_obj.filepath)
+        else:
+            return False
+
+    def content_file_size(self, public_file_path: str) -> int:
+        """
+        Return size of specified file.
+
+        Parameters
+        ----------
+        public_file_path
+
+        Returns
+        -------
+
+        """
+        file_obj = self.resolve_public_file_path(public_file_path)
+
+        if file_obj is not None:
+            return file_obj.size
+        else:
+            return 0
+
+
+    def content_file_checksum(self, public_file_path: str) -> str:
+        """
+        Generic routine to calculate checksum for arbitrary file argument.
+
+        Parameters
+        ----------
+        filepath: str
+            Path to file we want to generate checksum for.
+
+        Returns
+        -------
+        Returns Null string if file does not exist otherwise
+        return b64-encoded MD5 hash of the specified file.
+
+        """
+
+        file_obj = self.resolve_public_file_path(public_file_path)
+
+        if file_obj is not None:
+            checksum = self.manifest.cached_checksum(file_obj)
+            if checksum is None:
+                checksum = file_checksum(file_obj.filepath)
+            return checksum
+        else:
+            return ""
+
+    def content_file_pointer(self, public_file_path: str) -> io.BytesIO:
+        """
+        Open specified file and return file pointer.
+
+        Parameters
+        ----------
+        filepath : str
+
+        Returns
+        -------
+        File pointer or Null string when filepath does not exist.
+
+        """
+
+        file_obj = self.resolve_public_file_path(public_file_path)
+
+        if file_obj is not None and os.path.exists(file_obj.filepath):
+            return open(file_obj.filepath, 'rb')
+        else:
+            return ""
+
+    def content_file_last_modified(self, public_file_path: str) -> datetime:
+        """
+        Return last modified time for specified file/package.
+        Parameters
+        ----------
+        filepath
+
+        Returns
+        -------
+
+        """
+        file_obj = self.resolve_public_file_path(public_file_path)
+
+        print(f"File modified: {file_obj.modified_datetime}")
+        dt = datetime.utcfromtimestamp(os.path.getmtime(file_obj.filepath))
+        print(f"New File modified: {dt}")
+        return datetime.utcfromtimestamp(os.path.getmtime(file_obj.filepath))
+
+    # Source log methods
+
+    @property
+    def source_log_exists(self) -> bool:
+        """
+        Indicate whether source log exists.
+
+        Returns
+        -------
+        True if source log file exists, otherwise returns False.
+
+        """
+        source_log_path = self.get_upload_source_log_path()
+
+        return os.path.exists(source_log_path)
+
+    @property
+    def source_log_size(self) -> int:
+        """
+        Return size of source log.
+
+        Returns
+        -------
+        Size in bytes.
+
+        """
+        source_log_path = self.get_upload_source_log_path()
+        return os.path.getsize(source_log_path)
+
+    @property
+    def source_log_last_modofied(self) -> str:
+        """
+        Last modified date of source log (UTC).
+
+        Returns
+        -------
+
+        """
+        source_log_path = self.get_upload_source_log_path()
+        return datetime.utcfromtimestamp(os.path.getmtime(source_log_path))
+
+    @property
+    def source_log_checksum(self) -> str:
+        """
+        Return checksum for source log.
+
+        Returns
+        -------
+        Returns Null string if file does not exist otherwise
+        return b64-encoded MD5 hash of the specified file.
+
+        """
+
+        source_log_path = self.get_upload_source_log_path()
+
+        if os.path.exists(source_log_path):
+            hash_md5 = md5()
+            with open(source_log_path, "rb") as f:
+                for chunk in iter(lambda: f.read(4096), b""):
+                    hash_md5.update(chunk)
+            return b64encode(hash_md5.digest()).decode('utf-8')
+        else:
+            return ""
+
+    def source_log_file_pointer(self) -> io.BytesIO:
+        """Get a file-pointer for source log."""
+
+        source_log_path = self.get_upload_source_log_path()
+        print(f"SOURCE LOG PATH: {source_log_path}")
+        if os.path.exists(source_log_path):
+            return open(source_log_path, 'rb')
+        else:
+            return ""
+
+
+class Upload(UploadView):
+    """Handle uploaded files: unzipping, putting in the right place, doing
+various file checks that might cause errors to be displayed to the
+submitter."""
+
+    def __init__(self, upload_id: int):
+        """
+        Initialize Upload object.
+
+        Parameters
+        ----------
+        upload_id : int
+            Unique identifier for submission workspace.
+
+        """
+        super().__init__(upload_id)
+
+        # manifest that has been rebuilt if it was not saved
+        self.__checked_manifest: Optional[Manifest] = None
 
         self.__warnings = []
         self.__errors = []
@@ -65,6 +767,13 @@ submitter."""
         # total client upload workspace source directory size (in bytes)
         self.__total_upload_size = 0
 
+        # limits on the content unpacked from archives in this upload
+        self.__unpack_budget = UnpackBudget()
+
+        # (file, ancillary, digest) of the upload digested last
+        self.__upload_digest: Optional[Tuple[FileStorage, bool,
+                                             Optional[str]]] = None
+
         self.__log = ''
         self.create_upload_workspace()
         self.create_upload_log()
@@ -72,6 +781,11 @@ submitter."""
         # not upload or delete files. Those requests update total size.
         self.calculate_client_upload_size()
 
+    @property
+    def unpack_budget(self) -> UnpackBudget:
+        """Size limits on the content unpacked from this upload."""
+        return self.__unpack_budget
+
     # Files
 
     def has_files(self) -> bool:
@@ -201,15 +915,6 @@ submitter."""
         """Get list of upload errors."""
         return self.__errors
 
-    @property
-    def upload_id(self) -> int:
-        """Return upload identifier.
-
-        The unique identifier for upload.
-
-        """
-        return self.__upload_id
-
     def remove_file(self, file: File, msg: str) -> bool:
         """
         Remove file from source directory.
@@ -250,10 +955,12 @@ submitter."""
 
         # Add reason for removal to File object
         file.remove(msg)
+        self.manifest.mark_removed(file.public_filepath)
 
         # We won't recalculate size here because we know total size will be
         # recalculated after all file checks (uses this routine) are complete.
 
+    @_with_workspace_lock
     def remove_workspace(self) -> bool:
         """Remove upload workspace. This request completely removes the upload
         workspace directory. No backup is made here (system backups may have files
@@ -274,97 +981,32 @@ submitter."""
         # Let's stash a copy of the source.log file (if it exists)
         log_path = os.path.join(self.get_upload_directory(), 'source.log')
 
-        if os.path.exists(log_path):
-            # Does directory exist to stash log
-            deleted_workspace_logs = os.path.join(_get_base_directory(),
-                                                  'deleted_workspace_logs')
-            if not os.path.exists(deleted_workspace_logs):
-                # Create the directory for deleted workspace logs
-                os.makedirs(deleted_workspace_logs, 0o755)
-
-            # Since every source log has the same filename we will prefix
-            # upload identifier to log.
-            padded_id = '{0:07d}'.format(self.__upload_id)
-            new_filename = padded_id + "_source.log"
-            deleted_log_path = os.path.join(deleted_workspace_logs, new_filename)
-            self.log(f"Move '{log_path} to '{deleted_log_path}'.")
-            self.log(f"Delete workspace '{workspace_directory}'.")
-            if not shutil.move(log_path, deleted_log_path):
-                self.log('Saving source.log failed.')
-                return False
-
-        # Now blow away the workspace
-        if os.path.exists(workspace_directory):
-            shutil.rmtree(workspace_directory)
-
-        return True
-
-    def resolve_public_file_path(self, public_file_path: str) -> File:
-        """
-        Resolve a relative file path to a arXiv File object.
-
-        Note: We are being very cautious here and spending most of this routine
-        checking for deviant relevant file paths.
-
-        Returns
-        -------
-        Null if file does not exist.
-        Otherwise returns fully qualified path to content file.
-
-        """
-        # Sanitize file name
-        filename = secure_filename(public_file_path)
-
-        # Our UI will never attempt to delete a file path containing components that attempt
-        # to escape out of workspace and this would be removed by secure_filename().
-        # This error must be propagated to wider notification level beyond source log.
-        if re.search(r'^/|^\.\./|\.\./', public_file_path):
-            # should never start with '/' or '../' or contain '..' anywhere in path.
-            message = f"SECURITY WARNING: file to delete contains illegal constructs: '{public_file_path}'"
-            self.log(message)
-            raise SecurityError(message)
-
-        # Secure filename should not change length of valid file path (but it will
-        # mess with directory slashes '/')
-        # TODO: Come up with better file path checker. We allow subdirectories
-        # TODO: and secure_filename strips them (/ => _)
-        # The length of file path should not change (need to check secure_filename)
-        # so if length changes generate warning.
-        if len(public_file_path) != len(filename):
-            message = f"SECURITY WARNING: sanitized file is different length: '{filename}' <=> '{public_file_path}'"
-            self.log(message)
-            raise SecurityError(message)
-
-        # Resolve relative path of file to filesystem
-        source_directory = self.get_source_directory()
-        file_path = os.path.join(source_directory, filename)
-
-        # secure_filename will eliminate '/' making paths to subdirectories
-        # impossible to resolve. Make assumption we caught bad actors with checks above.
+        if os.path.exists(log_path):
+            # Does directory exist to stash log
+            deleted_workspace_logs = os.path.join(_get_base_directory(),
+                                                  'deleted_workspace_logs')
+            if not os.path.exists(deleted_workspace_logs):
+                # Create the directory for deleted workspace logs
+                os.makedirs(deleted_workspace_logs, 0o755)
 
-        # Check if original path might be subdirectory.
-        # We've made it past serious threat checks above.
-        if not os.path.exists(file_path) and re.search(r'_', filename) and re.search(r'/', public_file_path):
-            if len(filename) == len(public_file_path):
-                # May be issue of directory delimiter converted to '_'
-                # Check if raw path exists
-                check_path = os.path.join(source_directory, public_file_path)
-                if os.path.exists(check_path):
-                    self.log(f"Path appears to be valid and contain "
-                             + f"subdirectory: '{public_file_path}' <=> '{filename}'")
-                    # TODO: Can someone hurt us here? Is it now safe to use original
-                    # TODO: path or should I edit 'secure' path. I believe what I'm doing is ok.
-                    file_path = check_path
-                    filename = public_file_path
+            # Since every source log has the same filename we will prefix
+            # upload identifier to log.
+            padded_id = '{0:07d}'.format(self.upload_id)
+            new_filename = padded_id + "_source.log"
+            deleted_log_path = os.path.join(deleted_workspace_logs, new_filename)
+            self.log(f"Move '{log_path} to '{deleted_log_path}'.")
+            self.log(f"Delete workspace '{workspace_directory}'.")
+            if not shutil.move(log_path, deleted_log_path):
+                self.log('Saving source.log failed.')
+                return False
 
-        # We have a file path that exists
-        if os.path.exists(file_path):
-            # Build arguments for File object
-            file_obj = File(file_path, source_directory)
-            return file_obj
-        else:
-            return None
+        # Now blow away the workspace
+        if os.path.exists(workspace_directory):
+            shutil.rmtree(workspace_directory)
+
+        return True
 
+    @_with_workspace_lock
     def client_remove_file(self, public_file_path: str) -> bool:
         """Delete a single file.
 
@@ -451,6 +1093,8 @@ submitter."""
 
             if shutil.move(file_path, removed_path):
                 self.log(f"Moved file from {file_path} to {removed_path}")
+                self.manifest.discard(os.path.relpath(file_path, src_directory))
+                self.manifest.save()
                 return True
             else:
                 self.log(f"*** FAILED to remove file '{file_path}'/{clean_public_path} ***")
@@ -463,6 +1107,7 @@ submitter."""
             self.log(f"File to delete not found: '{public_file_path}' '{filename}'")
             raise NotFound(UPLOAD_FILE_NOT_FOUND)
 
+    @_with_workspace_lock
     def client_remove_all_files(self) -> bool:
         """Delete all files uploaded by client from specified workspace.
 
@@ -495,23 +1140,11 @@ submitter."""
                 self.log(f"Error while removing all files: '{rme}'")
                 raise
 
+        self.manifest.clear()
+
         # Recalculate total upload workspace source directory size
         self.calculate_client_upload_size()
 
-    def get_upload_directory(self) -> str:
-        """
-        Get top level workspace directory for submission."
-
-        Returns
-        -------
-        str
-            Top level directory path for upload workspace.
-        """
-
-        root_path = _get_base_directory()
-        upload_directory = os.path.join(root_path, str(self.upload_id))
-        return upload_directory
-
     def create_upload_directory(self):
         """Create the base directory for upload workarea"""
 
@@ -535,14 +1168,6 @@ submitter."""
 
         return upload_directory
 
-    def get_source_directory(self) -> str:
-        """Return directory where source files get deposited."""
-        return os.path.join(self.get_upload_directory(), self.SOURCE_PREFIX)
-
-    def get_removed_directory(self) -> str:
-        """Get directory where source archive files get moved when unpacked."""
-        return os.path.join(self.get_upload_directory(), self.REMOVED_PREFIX)
-
     def get_ancillary_directory(self) -> str:
         """
         Get directory where ancillary files are stored.
@@ -552,6 +1177,7 @@ submitter."""
         path = os.path.join(self.get_source_directory(), self.ANCILLARY_PREFIX)
         if not os.path.exists(path):
             os.mkdir(path)
+            os.chmod(path, DIRECTORY_MODE)
         return path
 
     def create_upload_workspace(self):
@@ -578,9 +1204,87 @@ submitter."""
 
         return base_dir
 
-    def get_upload_source_log_path(self):
-        """Generate path for upload source log."""
-        return os.path.join(self.get_upload_directory(), 'source.log')
+    @property
+    def manifest(self) -> Manifest:
+        """
+        Index of files in the source directory.
+
+        The manifest is built from the source directory the first time it is
+        needed for a workspace that does not have one yet.
+        """
+        manifest = super().manifest
+        if manifest is not self.__checked_manifest:
+            self.__checked_manifest = manifest
+            if not manifest.loaded:
+                self.rebuild_manifest()
+        # Rebuilding the manifest takes the workspace lock, which reads the
+        # manifest again
+        return super().manifest
+
+    @contextmanager
+    def workspace_lock(self) -> Iterator[None]:
+        """
+        Hold the workspace lock while changing the workspace.
+
+        Requests that change a workspace (and its manifest) run one at a
+        time. Once the lock is taken, the manifest and type cache are read
+        again, so that changes saved by an earlier request are not lost.
+        The lock may be taken again by a thread that already holds it.
+        """
+        upload_id = str(self.upload_id)
+        held = _held_workspace_locks()
+        if upload_id in held:
+            yield
+            return
+
+        lock_path = os.path.join(self.get_upload_directory(),
+                                 self.LOCK_FILENAME)
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            held.add(upload_id)
+            try:
+                self.reload_sidecars()
+                # Read the manifest before the workspace changes, so that
+                # it is compared with the source directory as it is now
+                super().manifest
+                yield
+            finally:
+                held.discard(upload_id)
+
+    @_with_workspace_lock
+    def rebuild_manifest(self) -> None:
+        """Rebuild the file manifest and save it to the workspace."""
+        # Not self.manifest, which would check the manifest again
+        manifest = super().manifest
+        self.__checked_manifest = manifest
+        source_directory = self.get_source_directory()
+        files = []
+        # Directory modification times also reflect files that were removed
+        modified = 0.0
+        if os.path.isdir(source_directory):
+            modified = os.stat(source_directory).st_mtime
+        for directories, entries in _scan_tree(source_directory):
+            for directory in directories:
+                try:
+                    modified = max(modified, directory.stat().st_mtime)
+                except OSError:
+                    pass
+            files.extend(File.from_dir_entry(entry, source_directory,
+                                             self.type_cache)
+                         for entry in entries)
+        manifest.rebuild(files, modified)
+        manifest.save()
+        self.type_cache.save()
+
+    @_with_workspace_lock
+    def content_file_checksum(self, public_file_path: str) -> str:
+        """Calculate checksum for a file, saving it in the manifest."""
+        file_obj = self.resolve_public_file_path(public_file_path)
+        if file_obj is None:
+            return ""
+        checksum = self.manifest.checksum(file_obj)
+        self.manifest.save()
+        return checksum
 
     def create_upload_log(self):
         """Create a source log to record activity for this upload."""
@@ -603,6 +1307,158 @@ submitter."""
         """Write message to upload log."""
         self.__log.info(message)
 
+    def _upload_filename(self, file: FileStorage) -> str:
+        """Sanitized name of an uploaded file."""
+        basename = os.path.basename(file.filename)
+
+        # Sanitize file name before saving it
+        filename = secure_filename(basename)
+        print('.', filename)
+
+        if basename != filename:
+            self.log(f'Secured filename: {filename} (basename + )')
+        return filename
+
+    def upload_digest(self, file: FileStorage, ancillary: bool = False) \
+            -> Optional[str]:
+        """
+        Calculate a digest identifying an upload.
+
+        The digest covers the content of the upload, its (sanitized) name
+        and whether it goes to the ancillary directory, since these together
+        determine what processing the upload does to the workspace.
+
+        Parameters
+        ----------
+        file : :class:`FileStorage`
+            Uploaded file. Its stream is left where it was.
+        ancillary : bool
+            If ``True``, file is to be deposited in the ancillary directory.
+
+        Returns
+        -------
+        str
+            Hex SHA-256 digest, or ``None`` if the upload cannot be read
+            more than once.
+        """
+        if self.__upload_digest is not None \
+                and self.__upload_digest[:2] == (file, ancillary):
+            return self.__upload_digest[2]
+
+        stream = file.stream
+        digest = None
+        if stream.seekable():
+            filename = secure_filename(os.path.basename(file.filename))
+            hash_sha256 = sha256(f'{filename}\0{ancillary}\0'.encode('utf-8'))
+            position = stream.tell()
+            for chunk in iter(lambda: stream.read(DIGEST_CHUNK_SIZE), b''):
+                hash_sha256.update(chunk)
+            stream.seek(position)
+            digest = hash_sha256.hexdigest()
+        self.__upload_digest = (file, ancillary, digest)
+        return digest
+
+    def is_repeated_upload(self, file: FileStorage,
+                           ancillary: bool = False) -> bool:
+        """
+        Check whether an upload is identical to the one processed last.
+
+        Processing such an upload again would leave the workspace as it is,
+        as long as nothing else has changed the workspace since.
+
+        Parameters
+        ----------
+        file : :class:`FileStorage`
+            Uploaded file.
+        ancillary : bool
+            If ``True``, file is to be deposited in the ancillary directory.
+
+        Returns
+        -------
+        bool
+            ``True`` if the upload has the same digest (see
+            :meth:`upload_digest`) as the upload that produced the current
+            state of the workspace.
+        """
+        recorded = self.manifest.upload_digest
+        return recorded is not None \
+            and self.upload_digest(file, ancillary) == recorded
+
+    def stream_upload(self, file: FileStorage, ancillary: bool = False) \
+            -> bool:
+        """
+        Unpack an uploaded tar archive without depositing it first.
+
+        Members are extracted as the archive is read from the upload, so the
+        archive is neither written to nor read back from the source
+        directory. A copy is kept in the removed directory, unless
+        ``RETAIN_UPLOAD_ARCHIVES`` is disabled. Disable streaming altogether
+        with ``STREAM_UPLOAD_ARCHIVES``.
+
+        Parameters
+        ----------
+        file : :class:`FileStorage`
+            Uploaded file.
+        ancillary : bool
+            If ``True``, archive is unpacked in the ancillary directory.
+
+        Returns
+        -------
+        bool
+            ``False`` if the upload is not a tar archive (possibly gzipped
+            or xz compressed) that can be streamed, in which case it has not
+            been touched.
+        """
+        stream = file.stream
+        if not _get_config_flag('STREAM_UPLOAD_ARCHIVES', True) \
+                or not stream.seekable():
+            return False
+
+        # Peek at the start of the upload (the tar header, for compressed
+        # content once decompressed) to see if it is a tar archive.
+        position = stream.tell()
+        header = stream.read(STREAM_HEADER_SIZE)
+        stream.seek(position)
+
+        filename = os.path.basename(file.filename)
+        file_type = guess_from_header(secure_filename(filename), header)
+        if file_type == 'gzipped':
+            try:
+                header = zlib.decompressobj(16 + zlib.MAX_WBITS) \
+                    .decompress(header, tarfile.BLOCKSIZE)
+            except zlib.error:
+                return False
+        elif file_type == 'xz':
+            try:
+                header = lzma.LZMADecompressor(lzma.FORMAT_XZ) \
+                    .decompress(header, tarfile.BLOCKSIZE)
+            except lzma.LZMAError:
+                return False
+        elif file_type != 'tar':
+            return False
+        if header[257:262] != b'ustar':
+            return False
+
+        filename = self._upload_filename(file)
+        if ancillary:  # Put the files in the ancillary directory.
+            target_directory = self.get_ancillary_directory()
+        else:  # Put the files in the source directory
+            target_directory = self.get_source_directory()
+        public_filepath = os.path.relpath(
+            os.path.join(target_directory, filename),
+            self.get_source_directory())
+
+        self.log(f"***** unpack {file_type} {filename} to dir: {target_directory}")
+        if _get_config_flag('RETAIN_UPLOAD_ARCHIVES', True):
+            copy_path = os.path.join(self.get_removed_directory(), filename)
+            with open(copy_path, 'wb') as copy:
+                unpack_stream(self, stream, public_filepath, target_directory,
+                              copy)
+            self.log(f"Removed packed file {filename}")
+        else:
+            unpack_stream(self, stream, public_filepath, target_directory)
+        return True
+
     def deposit_upload(self, file: FileStorage, ancillary: bool = False) \
             -> str:
         """
@@ -622,14 +1478,7 @@ submitter."""
             Full path of archive file.
 
         """
-        basename = os.path.basename(file.filename)
-
-        # Sanitize file name before saving it
-        filename = secure_filename(basename)
-        print('.', filename)
-
-        if basename != filename:
-            self.log(f'Secured filename: {filename} (basename + )')
+        filename = self._upload_filename(file)
 
         if ancillary:  # Put the file in the ancillary directory.
             src_directory = self.get_ancillary_directory()
@@ -637,367 +1486,668 @@ submitter."""
             src_directory = self.get_source_directory()
 
         upload_path = os.path.join(src_directory, filename)
+        # Replace rather than overwrite an existing file, which may be hard
+        # linked from the removed directory.
+        if os.path.isfile(upload_path):
+            os.remove(upload_path)
         file.save(upload_path)
         if os.stat(upload_path).st_size == 0:
             # Might be a good to delete zero length file we just deposited
             # in upload workspace.
             os.remove(upload_path)
             raise BadRequest(UPLOAD_FILE_EMPTY)
+        os.chmod(upload_path, FILE_MODE)
+        self.manifest.add(File(upload_path, self.get_source_directory(),
+                               self.type_cache))
         return upload_path
 
-    def check_files(self) -> None:
+    def _add_checked_file(self, fpath: str, warnings: list,
+                          errors: list) -> File:
         """
-        This is the main loop that goes through the list of files and performs
-        a long list of checks that depend on file type, extension, and sometimes file name.
+        Add a checked file to the :class:`Upload` workspace.
+
+        Since filenames may change during handling (e.g. rename files with
+        illegal characters), we do not want to add them to the workspace
+        (including their warnings and errors) until the final filename is
+        known.
+        """
+        # Since the filename may have changed, we re-instantiate
+        # the File to get the most accurate representation.
+        obj = File(fpath, self.get_source_directory(), self.type_cache)
+
+        # Add all files to upload file list as this will hold
+        # information about handling of file (removed)
+        self.add_file(obj)
+        self.manifest.add(obj, checked=True, errors=errors)
+
+        # Add warnings and errors collected above, using the most
+        # up-to-date filename.
+        for msg in warnings:
+            self.add_warning(obj.public_filepath, msg)
+        for msg in errors:
+            self.add_error(obj.public_filepath, msg)
+        return obj
+
+    def _add_unchanged_file(self, obj: File) -> bool:
+        """
+        Add a file checked by an earlier upload to the :class:`Upload`.
+
+        The results of the earlier checks are taken from the manifest.
+        Warnings describe what was done to the file at the time, so only
+        errors are carried forward.
 
         Returns
         -------
-        None
+        bool
+            ``False`` if the file has not been checked or has changed since.
         """
+        entry = self.manifest.checked(obj)
+        if entry is None:
+            return False
+
+        # Keep the type cache entry, so that it is not pruned
+        obj.type = entry['type']
+        self.type_cache.set(obj.filepath, obj.type, obj.stat)
+
+        self.add_file(obj)
+        for msg in entry['errors']:
+            self.add_error(obj.public_filepath, msg)
+        return True
+
+    def process_source_files(self) -> None:
+        """
+        Unpack, check and list the files in the source directory.
+
+        Every file is visited once. Archives are unpacked and the extracted
+        files and directories are visited in turn. Other files are checked
+        (see :meth:`check_file`), which adds them to the list of files and to
+        the manifest used for size accounting. Deposited and unpacked files
+        and directories already have their final permissions.
+
+        Only files added or changed since the last upload are unpacked and
+        checked. Files that were checked before keep their earlier results.
 
+        Returns
+        -------
+        None
+        """
         self.log('\n******** Check Files *****\n\n')
 
         source_directory = self.get_source_directory()
-
-        # Since filenames may change during handling (e.g. rename files with
-        # illegal characters), we do not want to add them to the workspace
-        # (including their warnings and errors) until the final filename is
-        # known. We need to do this in several places, hence a function for
-        # convenience.
-        def _add_file(fpath: str, warnings: list, errors: list) -> File:
-            """Add a file to the :class:`Upload` workspace."""
-            # Since the filename may have changed, we re-instantiate
-            # the File to get the most accurate representation.
-            obj = File(fpath, source_directory)
-
-            # Add all files to upload file list as this will hold
-            # information about handling of file (removed)
-            self.add_file(obj)
-
-            # Add warnings and errors collected above, using the most
-            # up-to-date filename.
-            for msg in warnings:
-                self.add_warning(obj.public_filepath, msg)
-            for msg in errors:
-                self.add_error(obj.public_filepath, msg)
-            return obj
-
-        for root_directory, directories, files in os.walk(source_directory):
-            for directory in directories:
-                # Need to decide whether we need to do anything to directories
-                # in the meantime get rid of lint warning
-                path = os.path.join(root_directory, directory)
-                obj = File(path, source_directory)
-                # self.log(f'{directory} [{obj.type}] in {obj.filepath}')
-
-            for file in files:
-                # Hold these until we're done with the file, since file names
-                # can change here.
-                _warnings = []
-                _errors = []
-
-                file_path = os.path.join(root_directory, file)
-                obj = File(file_path, source_directory)
-
-                # Convert this to debugging
-                # print("  File is : " + file + " Size: " + str(
-                #    obj.size) + " File is type: " + obj.type + ":" + obj.type_string + '\n')
-
-                file_type = obj.type
-                file_name = obj.name
-                file_size = obj.size
-
-                # Update file timestamps
-
-                # Remove zero length files
-                if obj.size == 0:
-                    msg = obj.name + " is empty (size is zero)"
-                    # self.add_warning(obj.public_filepath, msg)
-                    _warnings.append(msg)
-                    obj = _add_file(file_path, _warnings, _errors)
-                    self.remove_file(obj, f"Removed {obj.name} [file is empty]")
+        visited = set()
+
+        def _visit_directory(path: str) -> bool:
+            """Check a directory."""
+            visited.add(path)
+            obj = File(path, source_directory, self.type_cache)
+            self.log(f'{obj.name} [{obj.type}] in {obj.filepath}')
+            return check_directory(self, obj)
+
+        def _visit_file(obj: File) -> None:
+            """Unpack or check a file and everything unpacked from it."""
+            pending = deque([obj])
+            while pending:
+                obj = pending.popleft()
+                visited.add(obj.filepath)
+                extracted = unpack_file(self, obj)
+
+                # Unpacked archives have been moved out of the way
+                if os.path.exists(obj.filepath):
+                    # Create log entry containing file, type, dir
+                    self.log(f'{obj.name} \t[{obj.type}] in {obj.dir}')
+                    self.check_file(obj)
+
+                # Archive members may overwrite files visited already, so
+                # they are always (re)visited. Members that left an earlier
+                # file unchanged keep its results, unless they are archives
+                # (which report problems unpacking them as warnings).
+                for path in extracted:
+                    if os.path.isdir(path):
+                        _visit_directory(path)
+                    elif os.path.isfile(path):
+                        member = File(path, source_directory, self.type_cache)
+                        if member.type not in ARCHIVE_TYPES \
+                                and self._add_unchanged_file(member):
+                            visited.add(path)
+                        else:
+                            pending.append(member)
+
+        unchanged = []
+        for directories, files in _scan_tree(source_directory):
+            for entry in list(directories):
+                if entry.path not in visited \
+                        and not _visit_directory(entry.path):
+                    # Do not descend into removed directory
+                    directories.remove(entry)
+
+            for entry in files:
+                if entry.path in visited:
                     continue
+                obj = File.from_dir_entry(entry, source_directory,
+                                          self.type_cache)
+                if self.manifest.checked(obj) is not None:
+                    # Wait until we know that no archive overwrites it
+                    unchanged.append(obj)
+                else:
+                    _visit_file(obj)
+
+        for obj in unchanged:
+            if obj.filepath in visited or not os.path.exists(obj.filepath):
+                continue
+            if not self._add_unchanged_file(obj):
+                _visit_file(obj)
+
+        # Keep only the most recent result for files that were replaced by
+        # archive members.
+        latest = {}
+        for file in self.get_files():
+            latest.pop(file.filepath, None)
+            latest[file.filepath] = file
+        self.__files = list(latest.values())
+
+        # Every file has been visited, so anything else in the cache is stale
+        self.type_cache.save(prune=True)
+
+    def process_files(self, upload_path: Optional[str] = None) -> bool:
+        """
+        Unpack and check the files added by an upload.
 
-                # Remove 10240 byte all-null files (bad user tar attempts?)
-                # Check of file is 10240 bytes and all are zero
-
-                # Rename Windows file names
-                if re.search(r'^[A-Za-z]:\\', file_name):
-                    # Rename using basename
-                    new_name = re.sub(r'^[A-Za-z]:\\(.*\\)?', '', file_name)
-                    new_file_path = os.path.join(root_directory, new_name)
-                    msg = 'Renaming ' + file_name + ' to ' + new_name + '.'
-                    _warnings.append(msg)
-                    os.rename(file_path, new_file_path)
-                    # fix up local data
-                    file_name = new_name
-                    file_path = new_file_path
-
-                # Keep an eye out for special ancillary 'anc' directory
-                anc_dir = os.path.join(self.get_source_directory(),
-                                       self.ANCILLARY_PREFIX)
-                if file_path.startswith(anc_dir):
-                    statinfo = os.stat(file_path)
-                    kilos = statinfo.st_size
-                    warn = "Ancillary file " + file_name + " (" + str(kilos) + ')'
-                    ##self.add_warning(warn)
-                    obj.type = 'ancillary'
-                    # We are done at this point - we do not inspect ancillary files
-                    ##continue
-
-                # Basic file checks
-
-                # Attempt to rename filenames containing illegal characters
-
-                # Filename contains illegal characters+,-,/,=,
-                if re.search(r'[^\w\+\-\.\=\,]', file_name):
-                    # Translate bad characters
-                    new_file_name = re.sub(r'[^\w\+\-\.\=\,]', '_', file_name)
-                    _warnings.append(
-                        "We only accept file names containing the characters: "
-                        "a-z A-Z 0-9 _ + - . , ="
-                    )
-                    _warnings.append(
-                        f'Attempting to rename {file_name} to {new_file_name}.'
-                    )
-                    # Do the renaming
-                    new_file_path = os.path.join(root_directory, new_file_name)
-                    try:
-                        os.rename(file_path, new_file_path)
-                    except os.error:
-                        _warnings.append(f'Unable to rename {file_name}')
-
-                    # fix up local data
-                    file_name = new_file_name
-                    file_path = new_file_path
-
-                # Filename starts with hyphen
-                if file_name.startswith('-'):
-                    # Replace dash (-) with underscore
-                    new_file_name = re.sub('^-', '_', file_name)
-                    _warnings.append(
-                        'We do not accept files starting with a hyphen. '
-                        f'Attempting to rename {file_name} to {new_file_name}.'
-                    )
-                    # Do the renaming
-                    new_file_path = os.path.join(root_directory, new_file_name)
-                    try:
-                        os.rename(file_path, new_file_path)
-                    except os.error:
-                        _warnings.append(f'Unable to rename {file_name}')
-                    # fix up local data
-                    file_name = new_file_name
-                    file_path = new_file_path
-
-                # Filename starts with dot (.)
-                if file_name.startswith('.'):
-                    obj = _add_file(file_path, _warnings, _errors)
-
-                    # Remove files starting with dot
-                    msg = 'Removed hidden file'
-                    # self.add_warning(msg)
-                    self.remove_file(obj, msg)
+        Parameters
+        ----------
+        upload_path : str
+            Path of the deposited file, if the upload was deposited.
 
-                    continue
+        Returns
+        -------
+        bool
+            ``True`` if the whole source directory was processed (see
+            :meth:`process_source_files`), ``False`` if only a single file
+            was checked (see :meth:`process_single_file`).
+        """
+        # A single file that is not an archive does not affect the rest of
+        # the source directory.
+        if upload_path is not None and self.process_single_file(upload_path):
+            return False
 
-                # Following checks can only occur once in current file
-                # all are tied together with if / elif
-
-                # TeX: Remove hyperlink styles espcrc2 and lamuphys
-                if re.search(r'^(espcrc2|lamuphys)\.sty$', file_name):
-                    obj = _add_file(file_path, _warnings, _errors)
-                    # TeX: styles that conflict with internal hypertex package
-                    print("Found hyperlink-compatible package\n")
-                    # TODO: Check the error/warning messaging for this check.
-                    self.remove_file(obj, msg)
-                    _warnings.append(
-                        '   -- instead using hypertex-compatible local version'
-                    )
-                elif re.search(r'^(espcrc2|lamuphys)\.tex$', file_name):
-                    # TeX: source files that conflict with internal hypertex package
-                    # I'm not sure why this is just a warning
-                    _warnings.append(
-                        f"Possible submitter error. Unwanted '{file_name}'"
-                    )
-                elif file_name == 'uufiles' or file_name == 'core' or file_name == 'splread.1st':
-                    obj = _add_file(file_path, _warnings, _errors)
-                    # Remove these files
-                    msg = 'File not allowed.'
-                    self.remove_file(obj, msg)
-                elif re.search(r'^xxx\.(rsrc$|finfo$|cshrc$|nfs)', file_name) \
-                        or re.search(r'\.[346]00gf$', file_name) \
-                        or (re.search(r'\.desc$', file_name) and file_size < 10):
-                    obj = _add_file(file_path, _warnings, _errors)
-                    # Remove these files
-                    msg = 'File not allowed.'
-                    self.remove_file(obj, msg)
-                elif re.search(r'(.*)\.bib$', file_name, re.IGNORECASE):
-                    obj = _add_file(file_path, _warnings, _errors)
-                    # TeX: Remove bib file since we do not run BibTeX
-                    # TODO: Generate bib warning bib()??
-                    msg = 'Removing ' + file_name \
-                          + ". Please upload .bbl file instead."
-                    self.remove_file(obj, msg)
-                elif re.search(r'^(10pt\.rtx|11pt\.rtx|12pt\.rtx|aps\.rtx|'
-                               + r'revsymb\.sty|revtex4\.cls|rmp\.rtx)$',
-                               file_name):
-                    obj = _add_file(file_path, _warnings, _errors)
-                    # TeX: submitter is including file already included
-                    # in TeX Live release
-                    # TODO: get revtex() warning message ???
-                    self.remove_file(obj, msg)
-                elif re.search(r'^diagrams\.(sty|tex)$', file_name):
-                    obj = _add_file(file_path, _warnings, _errors)
-                    # TeX: diagrams package contains a time bomb and stops
-                    # working after a specified date. Use internal version
-                    # with time bomb disable.
-
-                    # TODO: get diagrams warning
-                    msg = ''
-                    self.remove_file(obj, msg)
-                elif file_name == 'aa.dem':
-                    obj = _add_file(file_path, _warnings, _errors)
-                    # TeX: Check for aa.dem
-                    # This is demo file that authors seem to include with
-                    # their submissions.
-                    self.remove_file(obj, msg)
-                    _warnings.append(
-                        f'REMOVING {file_name} on the assumption that it is '
-                        'the example file for the Astronomy and Astrophysics '
-                        'macro package aa.cls.'
-                    )
-                elif re.search(r'(.+)\.(log|aux|blg|dvi|ps|pdf)$', file_name,
-                               re.IGNORECASE):
-                    # TeX: Check for TeX processed output files (log, aux,
-                    # blg, dvi, ps, pdf, etc.)
-                    # Detect naming conflict, warn, remove offending files.
-                    # Check if certain source files exist
-                    filebase, file_extension = os.path.splitext(file_name)
-                    tex_file = os.path.join(root_directory, filebase, '.tex')
-                    upper_case_tex_file = os.path.join(root_directory, filebase, '.TEX')
-                    if os.path.exists(tex_file) or os.path.exists(upper_case_tex_file):
-                        self.add_file(obj)  # Adding to preserve behavior.
-                        # Potential conflict / corruption by including TeX
-                        # generated files in submission
-                        _warnings.append(' REMOVING $fn due to name conflict')
-                        self.remove_file(obj, msg)
-                elif re.search(r'[^\w\+\-\.\=\,]', file_name):
-                    # File name contains unwanted bad characters - this is an Error
-                    # We attempted to fix file_names with bad characters at
-                    # beginning of this routine
-                    _errors.append(
-                        f'Filename "{file_name}" contains unwanted bad '
-                        'character "$&", only allowed are '
-                        'a-z A-Z 0-9 _ + - . , ='
-                    )
-                elif re.search(r'([\.\-]t?[ga]?z)$', file_name):
-                    # Fix filename
-                    new_file_name = re.sub(r'([\.\-]t?[ga]?z)$', '', file_name,
-                                           re.IGNORECASE)
-                    new_file_path = os.path.join(root_directory, new_file_name)
-                    try:
-                        os.rename(file_path, new_file_path)
-                        msg = "Renaming '" + file_name + "' to '" \
-                              + new_file_name + "'."
-                        _warnings.append(msg)
-                        file_name = new_file_name
-                        file_path = new_file_path
-                    except os.error:
-                        _warnings.append(f'Unable to rename {file_name}')
-                elif file_name.endswith('.doc') and type == 'failed':
-                    obj = _add_file(file_path, _warnings, _errors)
-                    # Doc warning
-                    # TODO: Get doc warning from message class
-                    msg = ''
-                    # TODO: need to log error
-                    _errors.append(msg)
-                    self.remove_file(obj, msg)
-
-                # Finished basic file checks
-
-                # We are done if file was marked as removed,
-                # otherwise continue with additional type checks below
-                if obj.removed:
-                    print("File was removed -- skipping to next file\n")
-                    continue
+        # Unpack upload archive (if necessary), check files and build
+        # list of files in a single pass over the source directory.
+        self.process_source_files()
+        return True
+
+    def process_files_in_sandbox(self, upload_path: Optional[str] = None) \
+            -> bool:
+        """
+        Unpack and check the files added by an upload in a subprocess.
+
+        Does the same as :meth:`process_files`, but in a subprocess with
+        limits on CPU time, memory, output file size and wall-clock time
+        (see :mod:`filemanager.utilities.sandbox`), so that a pathological
+        upload cannot tie up the server process. Warnings, errors and the
+        list of files are taken back from the subprocess; the manifest and
+        type cache are read again from the workspace.
+
+        If the subprocess fails or is stopped, the files it may have left
+        behind unchecked are moved out of the source directory (see
+        :meth:`remove_unchecked_files`) and an error is added to the upload.
+
+        Parameters
+        ----------
+        upload_path : str
+            Path of the deposited file, if the upload was deposited.
 
-                # Placeholder for future checks/notes
+        Returns
+        -------
+        bool
+            ``True`` if the whole source directory was processed.
+        """
+        # The subprocess picks up the workspace from here
+        self.manifest.save()
+        self.type_cache.save()
+        try:
+            results = sandbox.run(_process_files_in_subprocess,
+                                  self.upload_id, upload_path)
+        except sandbox.SandboxError as error:
+            self.log(f'Processing upload in sandbox failed: {error.message}')
+            self.add_error('', 'Processing of the upload was stopped: it '
+                               f'{error.message}.')
+            self.remove_unchecked_files()
+            return False
 
-                # TeX: Files that indicate user error
-                # TODO: Investigate missfont.log error - possibly move handling here
+        self.reload_sidecars()
+        self.__warnings.extend(results['warnings'])
+        self.__errors.extend(results['errors'])
+        source_directory = self.get_source_directory()
+        self.__files = []
+        for filepath, file_type, removed in results['files']:
+            obj = File(filepath, source_directory, self.type_cache)
+            obj.type = file_type
+            if removed:
+                obj.remove(removed)
+            self.__files.append(obj)
+        return results['processed_source_files']
+
+    def remove_unchecked_files(self) -> None:
+        """
+        Move everything in the source directory to the removed directory.
 
-                # TODO: diagrams detection script (does not exist in legacy system)
-                # TeX: Detect various diagrams files where user changes name
-                # of package. Implement at some point - just thinking of this
-                # given recent failures.
+        Used when processing an upload failed part way, which leaves files
+        in the source directory that were not checked. They are kept in a
+        ``failed-<time>`` directory under the removed directory, and the
+        workspace is left empty.
+        """
+        source_directory = self.get_source_directory()
+        failed_directory = os.path.join(self.get_removed_directory(),
+                                        f'failed-{time.time():.6f}')
+        self.log(f"Move unchecked files to '{failed_directory}'")
+        os.rename(source_directory, failed_directory)
+        os.makedirs(source_directory, 0o755)
+
+        self.reload_sidecars()
+        self.manifest.clear()
+        self.manifest.save()
+        self.__files = []
 
-                # Check for individual types if/elif/else
+    def process_single_file(self, path: str) -> bool:
+        """
+        Check a deposited file that is not an archive.
 
-                # TeX: If dvi file is present we ask for TeX source
-                #   Do we need to do this is TeX was also included???????
-                if file_type == 'dvi':
-                    msg = file_name + ' is a TeX-produced DVI file. ' \
-                          + ' Please submit the TeX source instead.'
-                    _errors.append(msg)
+        The file list is made up of the new file and the files checked by
+        earlier uploads, as recorded in the manifest, so that the rest of
+        the source directory does not need to be visited.
 
-                # Clean up any html
-                elif file_type == 'html':
-                    pass
+        Parameters
+        ----------
+        path : str
+            Full path of the deposited file.
 
-                # Postscript - must check and clean up postscript
-                #   unmacify, check_ps, ???
-                elif file_type == 'postscript' \
-                        or (file_type == 'failed' \
-                            and re.search(r'\.e?psi?$', file_name, re.IGNORECASE)):
-                    pass
+        Returns
+        -------
+        bool
+            ``False`` if the file may be an archive, or the manifest has
+            files that have not been checked, in which case nothing is done.
+        """
+        source_directory = self.get_source_directory()
+        obj = File(path, source_directory, self.type_cache)
+        if obj.type in ARCHIVE_TYPES:
+            return False
+        if self.manifest.paths(checked=False) != [obj.public_filepath]:
+            return False
 
-                # TeX: Check form of source for latex and latex2e
-                elif file_type == 'latex' or file_type == 'latex2e':
-                    pass
+        self.log('\n******** Check Files *****\n\n')
 
-                # TeX: Check for image types that are not accepted
-                elif file_type == 'image' \
-                        and re.search(r'\.(pcx|bmp|wmf|opj|pct|tiff?)$',
-                                      file_name, re.IGNORECASE):
-                    pass
+        # The ancillary directory may have just been created
+        directory = os.path.dirname(path)
+        if directory != source_directory:
+            self.log(f'{os.path.basename(directory)} [directory] in {directory}')
+
+        # Create log entry containing file, type, dir
+        self.log(f'{obj.name} \t[{obj.type}] in {obj.dir}')
+        self.check_file(obj)
+
+        # The checked file may have been renamed over an earlier file
+        checked = {file.public_filepath for file in self.get_files()}
+        for public_filepath in self.manifest.paths(checked=True):
+            if public_filepath in checked:
+                continue
+            entry = self.manifest.entry(public_filepath)
+            other = File(os.path.join(source_directory, public_filepath),
+                         source_directory, self.type_cache)
+            other.type = entry['type']
+            self.add_file(other)
+            for msg in entry['errors']:
+                self.add_error(public_filepath, msg)
+
+        self.type_cache.save()
+        return True
 
-                # Uuencode file: decode uuencoded file
-                elif file_type == 'uuencoded':
-                    pass
+    def check_files(self) -> None:
+        """
+        This is the main loop that goes through the list of files and performs
+        a long list of checks that depend on file type, extension, and sometimes file name.
 
-                # File types we don't accept
+        Returns
+        -------
+        None
+        """
 
-                # RAR
-                elif file_type == 'rar':
-                    msg = "We do not support 'rar' files. Please use 'zip' or 'tar'."
-                    _errors.append(msg)
+        self.log('\n******** Check Files *****\n\n')
 
-                # unmacify files of type PC and MAC
-                elif file_type == 'pc' or file_type == 'mac':
-                    pass
+        source_directory = self.get_source_directory()
 
-                # Repair files of type PS_PC
-                elif file_type == 'ps_pc':
-                    # TODO: Implenent repair_ps
-                    pass
+        for directories, files in _scan_tree(source_directory):
+            for entry in files:
+                self.check_file(File.from_dir_entry(entry, source_directory,
+                                                    self.type_cache))
 
-                # Repair dos eps
-                elif file_type == 'dos_eps':
-                    # TODO: Implement repair_dos_eps
-                    pass
+    def check_file(self, obj: File) -> None:
+        """
+        Perform the checks that depend on file type, extension and name.
 
-                # TeX: If file is identified as core TeX type then we need to
-                # unmacify
-                # check if file contains raw postscript
-                elif obj.is_tex_type:
-                    # TODO: Implement unmacify
-                    print(f'File {obj.name} is TeX type. Needs further inspection. ***')
-                    self.unmacify(file_name)
-                    self.extract_uu(file_name, file_type)
-                    pass
+        The file may be renamed or removed, and is added to the list of files
+        in the upload (along with any warnings and errors) under its final
+        name.
+
+        Parameters
+        ----------
+        obj : :class:`File`
+            File in the source directory to check.
+
+        Returns
+        -------
+        None
+        """
+        # Hold these until we're done with the file, since file names
+        # can change here.
+        _warnings = []
+        _errors = []
+
+        file_path = obj.filepath
+        root_directory = os.path.dirname(file_path)
+
+        # The file is added back to the manifest under its final name
+        # once checks are complete
+        self.manifest.discard(obj.public_filepath)
+
+        # Convert this to debugging
+        # print("  File is : " + file + " Size: " + str(
+        #    obj.size) + " File is type: " + obj.type + ":" + obj.type_string + '\n')
+
+        file_type = obj.type
+        file_name = obj.name
+        file_size = obj.size
+
+        # Update file timestamps
+
+        # Remove zero length files
+        if obj.size == 0:
+            msg = obj.name + " is empty (size is zero)"
+            # self.add_warning(obj.public_filepath, msg)
+            _warnings.append(msg)
+            obj = self._add_checked_file(file_path, _warnings, _errors)
+            self.remove_file(obj, f"Removed {obj.name} [file is empty]")
+            return
+
+        # Remove 10240 byte all-null files (bad user tar attempts?)
+        # Check of file is 10240 bytes and all are zero
+
+        # Rename Windows file names
+        if re.search(r'^[A-Za-z]:\\', file_name):
+            # Rename using basename
+            new_name = re.sub(r'^[A-Za-z]:\\(.*\\)?', '', file_name)
+            new_file_path = os.path.join(root_directory, new_name)
+            msg = 'Renaming ' + file_name + ' to ' + new_name + '.'
+            _warnings.append(msg)
+            os.rename(file_path, new_file_path)
+            # fix up local data
+            file_name = new_name
+            file_path = new_file_path
+
+        # Keep an eye out for special ancillary 'anc' directory
+        anc_dir = os.path.join(self.get_source_directory(),
+                               self.ANCILLARY_PREFIX)
+        if file_path.startswith(anc_dir):
+            statinfo = os.stat(file_path)
+            kilos = statinfo.st_size
+            warn = "Ancillary file " + file_name + " (" + str(kilos) + ')'
+            ##self.add_warning(warn)
+            obj.type = 'ancillary'
+            # We are done at this point - we do not inspect ancillary files
+            ##continue
+
+        # Basic file checks
+
+        # Attempt to rename filenames containing illegal characters
+
+        # Filename contains illegal characters+,-,/,=,
+        if re.search(r'[^\w\+\-\.\=\,]', file_name):
+            # Translate bad characters
+            new_file_name = re.sub(r'[^\w\+\-\.\=\,]', '_', file_name)
+            _warnings.append(
+                "We only accept file names containing the characters: "
+                "a-z A-Z 0-9 _ + - . , ="
+            )
+            _warnings.append(
+                f'Attempting to rename {file_name} to {new_file_name}.'
+            )
+            # Do the renaming
+            new_file_path = os.path.join(root_directory, new_file_name)
+            try:
+                os.rename(file_path, new_file_path)
+            except os.error:
+                _warnings.append(f'Unable to rename {file_name}')
+
+            # fix up local data
+            file_name = new_file_name
+            file_path = new_file_path
+
+        # Filename starts with hyphen
+        if file_name.startswith('-'):
+            # Replace dash (-) with underscore
+            new_file_name = re.sub('^-', '_', file_name)
+            _warnings.append(
+                'We do not accept files starting with a hyphen. '
+                f'Attempting to rename {file_name} to {new_file_name}.'
+            )
+            # Do the renaming
+            new_file_path = os.path.join(root_directory, new_file_name)
+            try:
+                os.rename(file_path, new_file_path)
+            except os.error:
+                _warnings.append(f'Unable to rename {file_name}')
+            # fix up local data
+            file_name = new_file_name
+            file_path = new_file_path
+
+        # Filename starts with dot (.)
+        if file_name.startswith('.'):
+            obj = self._add_checked_file(file_path, _warnings, _errors)
+
+            # Remove files starting with dot
+            msg = 'Removed hidden file'
+            # self.add_warning(msg)
+            self.remove_file(obj, msg)
+
+            return
+
+        # Following checks can only occur once in current file
+        # all are tied together with if / elif
+
+        # TeX: Remove hyperlink styles espcrc2 and lamuphys
+        if re.search(r'^(espcrc2|lamuphys)\.sty$', file_name):
+            obj = self._add_checked_file(file_path, _warnings, _errors)
+            # TeX: styles that conflict with internal hypertex package
+            print("Found hyperlink-compatible package\n")
+            # TODO: Check the error/warning messaging for this check.
+            self.remove_file(obj, msg)
+            _warnings.append(
+                '   -- instead using hypertex-compatible local version'
+            )
+        elif re.search(r'^(espcrc2|lamuphys)\.tex$', file_name):
+            # TeX: source files that conflict with internal hypertex package
+            # I'm not sure why this is just a warning
+            _warnings.append(
+                f"Possible submitter error. Unwanted '{file_name}'"
+            )
+        elif file_name == 'uufiles' or file_name == 'core' or file_name == 'splread.1st':
+            obj = self._add_checked_file(file_path, _warnings, _errors)
+            # Remove these files
+            msg = 'File not allowed.'
+            self.remove_file(obj, msg)
+        elif re.search(r'^xxx\.(rsrc$|finfo$|cshrc$|nfs)', file_name) \
+                or re.search(r'\.[346]00gf$', file_name) \
+                or (re.search(r'\.desc$', file_name) and file_size < 10):
+            obj = self._add_checked_file(file_path, _warnings, _errors)
+            # Remove these files
+            msg = 'File not allowed.'
+            self.remove_file(obj, msg)
+        elif re.search(r'(.*)\.bib$', file_name, re.IGNORECASE):
+            obj = self._add_checked_file(file_path, _warnings, _errors)
+            # TeX: Remove bib file since we do not run BibTeX
+            # TODO: Generate bib warning bib()??
+            msg = 'Removing ' + file_name \
+                  + ". Please upload .bbl file instead."
+            self.remove_file(obj, msg)
+        elif re.search(r'^(10pt\.rtx|11pt\.rtx|12pt\.rtx|aps\.rtx|'
+                       + r'revsymb\.sty|revtex4\.cls|rmp\.rtx)$',
+                       file_name):
+            obj = self._add_checked_file(file_path, _warnings, _errors)
+            # TeX: submitter is including file already included
+            # in TeX Live release
+            # TODO: get revtex() warning message ???
+            self.remove_file(obj, msg)
+        elif re.search(r'^diagrams\.(sty|tex)$', file_name):
+            obj = self._add_checked_file(file_path, _warnings, _errors)
+            # TeX: diagrams package contains a time bomb and stops
+            # working after a specified date. Use internal version
+            # with time bomb disable.
+
+            # TODO: get diagrams warning
+            msg = ''
+            self.remove_file(obj, msg)
+        elif file_name == 'aa.dem':
+            obj = self._add_checked_file(file_path, _warnings, _errors)
+            # TeX: Check for aa.dem
+            # This is demo file that authors seem to include with
+            # their submissions.
+            self.remove_file(obj, msg)
+            _warnings.append(
+                f'REMOVING {file_name} on the assumption that it is '
+                'the example file for the Astronomy and Astrophysics '
+                'macro package aa.cls.'
+            )
+        elif re.search(r'(.+)\.(log|aux|blg|dvi|ps|pdf)$', file_name,
+                       re.IGNORECASE):
+            # TeX: Check for TeX processed output files (log, aux,
+            # blg, dvi, ps, pdf, etc.)
+            # Detect naming conflict, warn, remove offending files.
+            # Check if certain source files exist
+            filebase, file_extension = os.path.splitext(file_name)
+            tex_file = os.path.join(root_directory, filebase, '.tex')
+            upper_case_tex_file = os.path.join(root_directory, filebase, '.TEX')
+            if os.path.exists(tex_file) or os.path.exists(upper_case_tex_file):
+                self.add_file(obj)  # Adding to preserve behavior.
+                # Potential conflict / corruption by including TeX
+                # generated files in submission
+                _warnings.append(' REMOVING $fn due to name conflict')
+                self.remove_file(obj, msg)
+        elif re.search(r'[^\w\+\-\.\=\,]', file_name):
+            # File name contains unwanted bad characters - this is an Error
+            # We attempted to fix file_names with bad characters at
+            # beginning of this routine
+            _errors.append(
+                f'Filename "{file_name}" contains unwanted bad '
+                'character "$&", only allowed are '
+                'a-z A-Z 0-9 _ + - . , ='
+            )
+        elif re.search(r'([\.\-]t?[ga]?z)$', file_name):
+            # Fix filename
+            new_file_name = re.sub(r'([\.\-]t?[ga]?z)$', '', file_name,
+                                   re.IGNORECASE)
+            new_file_path = os.path.join(root_directory, new_file_name)
+            try:
+                os.rename(file_path, new_file_path)
+                msg = "Renaming '" + file_name + "' to '" \
+                      + new_file_name + "'."
+                _warnings.append(msg)
+                file_name = new_file_name
+                file_path = new_file_path
+            except os.error:
+                _warnings.append(f'Unable to rename {file_name}')
+        elif file_name.endswith('.doc') and type == 'failed':
+            obj = self._add_checked_file(file_path, _warnings, _errors)
+            # Doc warning
+            # TODO: Get doc warning from message class
+            msg = ''
+            # TODO: need to log error
+            _errors.append(msg)
+            self.remove_file(obj, msg)
+
+        # Finished basic file checks
+
+        # We are done if file was marked as removed,
+        # otherwise continue with additional type checks below
+        if obj.removed:
+            print("File was removed -- skipping to next file\n")
+            return
+
+        # Placeholder for future checks/notes
+
+        # TeX: Files that indicate user error
+        # TODO: Investigate missfont.log error - possibly move handling here
+
+        # TODO: diagrams detection script (does not exist in legacy system)
+        # TeX: Detect various diagrams files where user changes name
+        # of package. Implement at some point - just thinking of this
+        # given recent failures.
+
+        # Check for individual types if/elif/else
+
+        # TeX: If dvi file is present we ask for TeX source
+        #   Do we need to do this is TeX was also included???????
+        if file_type == 'dvi':
+            msg = file_name + ' is a TeX-produced DVI file. ' \
+                  + ' Please submit the TeX source instead.'
+            _errors.append(msg)
+
+        # Clean up any html
+        elif file_type == 'html':
+            pass
+
+        # Postscript - must check and clean up postscript
+        #   unmacify, check_ps, ???
+        elif file_type == 'postscript' \
+                or (file_type == 'failed' \
+                    and re.search(r'\.e?psi?$', file_name, re.IGNORECASE)):
+            pass
+
+        # TeX: Check form of source for latex and latex2e
+        elif file_type == 'latex' or file_type == 'latex2e':
+            pass
+
+        # TeX: Check for image types that are not accepted
+        elif file_type == 'image' \
+                and re.search(r'\.(pcx|bmp|wmf|opj|pct|tiff?)$',
+                              file_name, re.IGNORECASE):
+            pass
+
+        # Uuencode file: decode uuencoded file
+        elif file_type == 'uuencoded':
+            pass
+
+        # File types we don't accept
+
+        # RAR
+        elif file_type == 'rar':
+            msg = "We do not support 'rar' files. Please use 'zip' or 'tar'."
+            _errors.append(msg)
+
+        # unmacify files of type PC and MAC
+        elif file_type == 'pc' or file_type == 'mac':
+            pass
+
+        # Repair files of type PS_PC
+        elif file_type == 'ps_pc':
+            # TODO: Implenent repair_ps
+            pass
+
+        # Repair dos eps
+        elif file_type == 'dos_eps':
+            # TODO: Implement repair_dos_eps
+            pass
+
+        # TeX: If file is identified as core TeX type then we need to
+        # unmacify
+        # check if file contains raw postscript
+        elif obj.is_tex_type:
+            # TODO: Implement unmacify
+            print(f'File {obj.name} is TeX type. Needs further inspection. ***')
+            self.unmacify(file_name)
+            self.extract_uu(file_name, file_type)
+            pass
+
+        obj = self._add_checked_file(file_path, _warnings, _errors)
+        # End of file type checks
 
-                obj = _add_file(file_path, _warnings, _errors)
-                # End of file type checks
 
     def unmacify(self, file_name: str):
         """Fix up carriage returns and newlines."""
@@ -1038,24 +2188,15 @@ submitter."""
         """
         Calculate total size of client's upload workspace source files.
 
+        The total is taken from the workspace manifest, which is saved here.
 
         Returns
         -------
 
         """
 
-        # Calculate total upload workspace source directory size.
-        source_directory = self.get_source_directory()
-
-        total_upload_size = 0
-
-        list = []
-        for root_directory, directories, files in os.walk(source_directory):
-            for file in files:
-                path = os.path.join(root_directory, file)
-                obj = File(path, source_directory)
-
-                total_upload_size += obj.size
+        # The manifest keeps track of the files in the source directory.
+        total_upload_size = self.manifest.total_size
 
         total_upload_size_kb = total_upload_size / 1024.0
         total_upload_size_kb_str = '{:.2f}'.format(total_upload_size_kb)
@@ -1064,6 +2205,9 @@ submitter."""
         # Record total submission size
         self.total_upload_size = total_upload_size
 
+        self.manifest.save()
+        self.type_cache.save()
+
     def create_file_list(self) -> list:
         """Create list of File objects with details of each file in
         upload package."""
@@ -1084,17 +2228,17 @@ submitter."""
         source_directory = self.get_source_directory()
 
         list = []
-        for root_directory, directories, files in os.walk(source_directory):
-            for directory in directories:
+        for directories, files in _scan_tree(source_directory):
+            for entry in directories:
                 # Need to decide whether we need to do anything to directories
                 # in the meantime get rid of lint warning
-                path = os.path.join(root_directory, directory)
-                obj = File(path, source_directory)
-                self.log(f'{directory} [{obj.type}] in {obj.filepath}')
+                obj = File.from_dir_entry(entry, source_directory,
+                                          self.type_cache)
+                self.log(f'{entry.name} [{obj.type}] in {obj.filepath}')
 
-            for file in files:
-                path = os.path.join(root_directory, file)
-                obj = File(path, source_directory)
+            for entry in files:
+                obj = File.from_dir_entry(entry, source_directory,
+                                          self.type_cache)
                 list.append(obj)  # silence lint error
 
                 # Create log entry containing file, type, dir
@@ -1103,6 +2247,9 @@ submitter."""
 
         self.__files = list
 
+        # Every file has been visited, so anything else in the cache is stale
+        self.type_cache.save(prune=True)
+
         return list
 
     def create_file_upload_summary(self) -> list:
@@ -1133,37 +2280,27 @@ submitter."""
                 # print("\tFile:" + fileObj.name + "\tFilePath: " + fileObj.public_filepath
                 #      + "\tRemoved: " + str(fileObj.removed) + " Size: " + str(fileObj.size))
 
-                # Collect details we would like to return to client
-                file_details = {}
-                file_details = {
-                    'name': fileObj.name,
-                    'public_filepath': fileObj.public_filepath,
-                    'size': fileObj.size,
-                    'type': fileObj.type_string,
-                    'modified_datetime': fileObj.modified_datetime
-                }
+                # Removed files are no longer in the source directory, so
+                # skip them before looking at size or modification time.
+                if fileObj.removed:
+                    continue
 
-                if not fileObj.removed:
-                    file_list.append(file_details)
+                # Collect details we would like to return to client. The
+                # manifest already has them for checked files.
+                file_details = self.manifest.details(fileObj.public_filepath)
+                if file_details is None:
+                    file_details = {
+                        'name': fileObj.name,
+                        'public_filepath': fileObj.public_filepath,
+                        'size': fileObj.size,
+                        'type': fileObj.type_string,
+                        'modified_datetime': fileObj.modified_datetime
+                    }
+                file_list.append(file_details)
 
             return file_list
         return file_list
 
-    def set_file_permissions(self) -> None:
-        """Set the file permissions for all files and directories in upload."""
-
-        # Start at directory containing source files
-        source_directory = self.get_source_directory()
-
-        # Set permissions on all directories and files
-        for root_directory, directories, files in os.walk(source_directory):
-            for file in files:
-                file_path = os.path.join(root_directory, file)
-                os.chmod(file_path, 0o664)
-            for dir in directories:
-                dir_path = os.path.join(root_directory, dir)
-                os.chmod(dir_path, 0o775)
-
     def fix_top_level_directory(self) -> None:
         """
         Eliminate single top-level directory.
@@ -1185,30 +2322,48 @@ submitter."""
             self.add_warning(entries[0], "Removing top level directory")
             single_directory = os.path.join(source_directory, entries[0])
 
-            # Save copy in removed directory
-            save_filename = os.path.join(self.get_removed_directory(),
-                                         'move_source.tar.gz')
-            with tarfile.open(save_filename, "w:gz") as tar:
-                tar.add(single_directory, arcname=os.path.sep)
-
-            # Remove existing directory
-            if os.path.exists(single_directory):
-                shutil.rmtree(single_directory)
-
-            # Replace files
-            if os.path.exists(save_filename):
-                tar = tarfile.open(save_filename)
-                # untar file into source directory
-                tar.extractall(path=source_directory)
-                tar.close()
-            else:
-                self.add_error('Failed to remove top level directory.')
-
-            # Set permissions
-            self.set_file_permissions()
-
-            # Rebuild file list
-            self.create_file_list()
+            # Save copy in removed directory. Hard links are cheap, and files
+            # in the source directory are replaced rather than rewritten, so
+            # the copy is not affected by later uploads.
+            save_directory = os.path.join(self.get_removed_directory(),
+                                          'move_source')
+            if os.path.exists(save_directory):
+                shutil.rmtree(save_directory)
+            try:
+                shutil.copytree(single_directory, save_directory,
+                                copy_function=os.link)
+            except (OSError, shutil.Error):
+                # Hard links are not supported here
+                shutil.rmtree(save_directory, ignore_errors=True)
+                shutil.copytree(single_directory, save_directory)
+
+            # Move the directory out of the way first, in case it contains
+            # an entry with the same name.
+            moving_directory = tempfile.mkdtemp(
+                dir=self.get_upload_directory())
+            try:
+                os.rename(single_directory, moving_directory)
+                for entry in os.listdir(moving_directory):
+                    os.rename(os.path.join(moving_directory, entry),
+                              os.path.join(source_directory, entry))
+                os.rmdir(moving_directory)
+            except OSError as error:
+                self.log(f'Failed to remove top level directory: {error}')
+                self.add_error(entries[0],
+                               'Failed to remove top level directory.')
+                return
+
+            # Files keep their permissions and modification times when
+            # they are moved, so only their paths need updating.
+            self.manifest.move_tree(entries[0], '')
+            self.type_cache.move_tree(entries[0], '')
+            self.manifest.save()
+            self.type_cache.save()
+            prefix = single_directory + os.sep
+            for file in self.get_files():
+                if file.filepath.startswith(prefix):
+                    file.filepath = os.path.join(source_directory,
+                                                 file.filepath[len(prefix):])
 
     def finalize_upload(self):
         """For file type checks that cannot be done until all files
@@ -1226,6 +2381,7 @@ submitter."""
         # Eliminate top directory when only single directory
         self.fix_top_level_directory()
 
+    @_with_workspace_lock
     def process_upload(self, file: FileStorage, ancillary: bool = False) \
             -> None:
         """
@@ -1265,285 +2421,62 @@ submitter."""
         #      + " Mime: " + file.mimetype + '\n')
         self.log('\n********** File Upload ************\n\n')
 
-        # Move uploaded archive/file to source directory
-        self.deposit_upload(file, ancillary=ancillary)
+        # Identify the upload before it is consumed
+        digest = self.upload_digest(file, ancillary=ancillary)
 
-        self.log('\n******** File Upload Processing *****\n\n')
+        # Sandboxed uploads are only unpacked in a subprocess
+        sandboxed = _get_config_flag('SANDBOX_UPLOADS', False)
 
-        # Unpack upload archive (if necessary). Completes minor cleanup.
-        unpack_archive(self)
+        # Unpack uploaded tar archive, or move uploaded archive/file to
+        # source directory
+        if not sandboxed and self.stream_upload(file, ancillary=ancillary):
+            upload_path = None
+        else:
+            upload_path = self.deposit_upload(file, ancillary=ancillary)
 
-        # Build list of files
-        self.create_file_list()
+        self.log('\n******** File Upload Processing *****\n\n')
 
-        # Check files
-        self.check_files()
+        if sandboxed:
+            processed_source_files = self.process_files_in_sandbox(upload_path)
+        else:
+            processed_source_files = self.process_files(upload_path)
 
         # Check total file size
         self.calculate_client_upload_size()
 
-        # Final cleanup
-        self.finalize_upload()
+        if processed_source_files:
+            # Final cleanup
+            self.finalize_upload()
+
+        # Remember which upload produced the workspace as it is now
+        self.manifest.record_upload(digest)
+        self.manifest.save()
 
         self.log('\n******** File Upload Finished *****\n\n')
 
         self.log(f'\n******** Errors: {self.has_errors()} *****\n\n')
 
-    # Content package routines
-
-    def get_content_path(self) -> str:
-        """
-        Get the path for the packed content tarball.
-
-        Note that the tarball itself may or may not exist yet.
-        """
-        return os.path.join(self.get_upload_directory(),
-                            f'{self.upload_id}.tar.gz')
-
-    def pack_content(self) -> str:
-        """Pack the entire source directory into a tarball."""
-        with tarfile.open(self.get_content_path(), "w:gz") as tar:
-            tar.add(self.get_source_directory(), arcname=os.path.sep)
-        return self.get_content_path()
-
-    @property
-    def last_modified(self):
-        """The time of the most recent change to a file in the workspace."""
-        most_recent = max(os.path.getmtime(root)
-                          for root, _, _
-                          in os.walk(self.get_source_directory()))
-        return datetime.fromtimestamp(most_recent, tz=UTC)
-
-    def get_content(self) -> io.BytesIO:
-        """Get a file-pointer for the packed content tarball."""
-        if not os.path.exists(self.get_content_path()):
-            self.pack_content()
-        return open(self.get_content_path(), 'rb')
-
-    @property
-    def content_package_exists(self) -> bool:
-        return os.path.exists(self.get_content_path())
-
-    @property
-    def content_package_modified(self) -> datetime:
-        return datetime.fromtimestamp(
-            os.path.getmtime(self.get_content_path()),
-            tz=UTC
-        )
-
-    @property
-    def content_package_size(self) -> int:
-        return os.path.getsize(self.get_content_path())
-
-    @property
-    def content_package_stale(self) -> bool:
-        return self.last_modified > self.content_package_modified
-
-    def content_checksum(self) -> str:
-        """Return b64-encoded MD5 hash of the packed content tarball.
-
-        Triggers building content package when pre-existing package is not found or stale
-        relative to source files."""
-        if not self.content_package_exists or self.content_package_stale:
-            self.pack_content()
-
-        hash_md5 = md5()
-        with open(self.get_content_path(), "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return b64encode(hash_md5.digest()).decode('utf-8')
-
-    # Content file routines
-
-    def content_file_path(self, public_file_path: str) -> str:
-        """
-        Return the absolute path of content file given relative pointer.
-
-        Returns
-        -------
-        Null if file does not exist.
-        """
-        file_obj = self.resolve_public_file_path(public_file_path)
-
-        if file_obj is not None:
-            return file_obj.filepath
-        else:
-            return ""
-
-    def content_file_exists(self, public_file_path: str) -> bool:
-        """
-        Indicate whether files exists.
-
-        Parameters
-        ----------
-        public_file_path : str
-            Relative path of file in upload workspace.
-
-        Returns
-        -------
-        True if file exists, False otherwise.
-
-        """
-
-        file_obj = self.resolve_public_file_path(public_file_path)
-
-        if file_obj is not None:
-            return os.path.exists(file_obj.filepath)
-        else:
-            return False
-
-    def content_file_size(self, public_file_path: str) -> int:
-        """
-        Return size of specified file.
-
-        Parameters
-        ----------
-        public_file_path
-
-        Returns
-        -------
-
-        """
-        file_obj = self.resolve_public_file_path(public_file_path)
-
-        if file_obj is not None:
-            return file_obj.size
-        else:
-            return 0
-
-
-    def content_file_checksum(self, public_file_path: str) -> str:
-        """
-        Generic routine to calculate checksum for arbitrary file argument.
-
-        Parameters
-        ----------
-        filepath: str
-            Path to file we want to generate checksum for.
-
-        Returns
-        -------
-        Returns Null string if file does not exist otherwise
-        return b64-encoded MD5 hash of the specified file.
-
-        """
-
-        file_obj = self.resolve_public_file_path(public_file_path)
-
-        if file_obj is not None:
-            return file_obj.checksum
-        else:
-            return ""
-
-    def content_file_pointer(self, public_file_path: str) -> io.BytesIO:
-        """
-        Open specified file and return file pointer.
-
-        Parameters
-        ----------
-        filepath : str
-
-        Returns
-        -------
-        File pointer or Null string when filepath does not exist.
-
-        """
-
-        file_obj = self.resolve_public_file_path(public_file_path)
-
-        if file_obj is not None and os.path.exists(file_obj.filepath):
-            return open(file_obj.filepath, 'rb')
-        else:
-            return ""
-
-    def content_file_last_modified(self, public_file_path: str) -> datetime:
-        """
-        Return last modified time for specified file/package.
-        Parameters
-        ----------
-        filepath
-
-        Returns
-        -------
-
-        """
-        file_obj = self.resolve_public_file_path(public_file_path)
-
-        print(f"File modified: {file_obj.modified_datetime}")
-        dt = datetime.utcfromtimestamp(os.path.getmtime(file_obj.filepath))
-        print(f"New File modified: {dt}")
-        return datetime.utcfromtimestamp(os.path.getmtime(file_obj.filepath))
-
-    # Source log methods
-
-    @property
-    def source_log_exists(self) -> bool:
-        """
-        Indicate whether source log exists.
-
-        Returns
-        -------
-        True if source log file exists, otherwise returns False.
-
-        """
-        source_log_path = self.get_upload_source_log_path()
-
-        return os.path.exists(source_log_path)
-
-    @property
-    def source_log_size(self) -> int:
-        """
-        Return size of source log.
-
-        Returns
-        -------
-        Size in bytes.
-
-        """
-        source_log_path = self.get_upload_source_log_path()
-        return os.path.getsize(source_log_path)
-
-    @property
-    def source_log_last_modofied(self) -> str:
-        """
-        Last modified date of source log (UTC).
-
-        Returns
-        -------
-
-        """
-        source_log_path = self.get_upload_source_log_path()
-        return datetime.utcfromtimestamp(os.path.getmtime(source_log_path))
-
-    @property
-    def source_log_checksum(self) -> str:
-        """
-        Return checksum for source log.
-
-        Returns
-        -------
-        Returns Null string if file does not exist otherwise
-        return b64-encoded MD5 hash of the specified file.
-
-        """
-
-        source_log_path = self.get_upload_source_log_path()
-
-        if os.path.exists(source_log_path):
-            hash_md5 = md5()
-            with open(source_log_path, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hash_md5.update(chunk)
-            return b64encode(hash_md5.digest()).decode('utf-8')
-        else:
-            return ""
-
-    def source_log_file_pointer(self) -> io.BytesIO:
-        """Get a file-pointer for source log."""
 
-        source_log_path = self.get_upload_source_log_path()
-        print(f"SOURCE LOG PATH: {source_log_path}")
-        if os.path.exists(source_log_path):
-            return open(source_log_path, 'rb')
-        else:
-            return ""
+def _process_files_in_subprocess(upload_id: int,
+                                 upload_path: Optional[str]) -> dict:
+    """Run :meth:`Upload.process_files` in a sandbox, returning results."""
+    # The server process holds the workspace lock while it waits
+    held = _held_workspace_locks()
+    held.add(str(upload_id))
+    try:
+        upload = Upload(upload_id)
+        processed_source_files = upload.process_files(upload_path)
+        upload.manifest.save()
+        upload.type_cache.save()
+    finally:
+        held.discard(str(upload_id))
+        # Workers are reused, so do not leave the source log open
+        for handler in logging.getLogger(__name__).handlers:
+            handler.close()
+    return {
+        'processed_source_files': processed_source_files,
+        'warnings': upload.get_warnings(),
+        'errors': upload.get_errors(),
+        'files': [(file.filepath, file.type, file.removed)
+                  for file in upload.get_files()]
+    }
@@ -173,11 +173,13 @@ def get_upload_content(upload_id: int) -> tuple:
     Get the upload content as a compressed tarball.
 
     Returns a stream with mimetype ``application/tar+gzip``, and an ``ETag``
-    header with the current source package checksum.
+    header with the current source package checksum (unless the package is
+    streamed and its checksum is not known yet).
     """
     data, status_code, headers = upload.get_upload_content(upload_id)
     response = send_file(data, mimetype="application/tar+gzip")
-    response.set_etag(headers.get('ETag'))
+    if 'ETag' in headers:
+        response.set_etag(headers['ETag'])
     return response
 
 @blueprint.route('/<int:upload_id>/<path:public_file_path>/content', methods=['HEAD'])
@@ -0,0 +1,422 @@
+"""Generate the content package of an upload workspace.
+
+The content package is a gzipped tar archive of the source directory, with
+the same members, in the same order, as :meth:`tarfile.TarFile.add` gives.
+:func:`generate` produces the package as a sequence of chunks, so that it
+can be sent as it is compressed instead of being written out first, and
+:class:`ContentStream` wraps those chunks as a file-like object that
+computes the checksum of the package as it is read.
+
+The gzip header carries no file name or timestamp, so generating the
+package twice from unchanged files gives the same bytes (and checksum).
+:func:`generate_cached` instead assembles the package from compressed
+members cached per file, so that only changed files are compressed again.
+
+Given a ``source_date_epoch``, the package is reproducible: members get
+that modification time, no owner and normalized permissions, so the package
+(and its checksum) only depends on the names and contents of the files.
+The checksum of a generated package is cached in a JSON sidecar file
+(:func:`save_checksum`), valid as long as the workspace is not modified and,
+for a package written to disk, the package file is not replaced.
+"""
+
+import io
+import json
+import os
+import tarfile
+import tempfile
+from base64 import b64encode
+from datetime import datetime
+from hashlib import md5, sha256
+from typing import Callable, Iterator, Optional, Tuple
+
+from arxiv.base import logging
+
+from filemanager.utilities import parallel_gzip
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 64 * 1024
+"""Size of the chunks in which member content is read."""
+
+DEFAULT_COMPRESSLEVEL = 9
+"""Same compression level as ``tarfile.open(..., 'w:gz')``."""
+
+DEFAULT_COMPRESS_THREADS = min(4, os.cpu_count() or 1)
+"""Number of threads compressing a content package."""
+
+
+def _walk(path: str, arcname: str) -> Iterator[Tuple[str, str]]:
+    """Yield paths and archive names in the order ``TarFile.add`` uses."""
+    yield path, arcname
+    if os.path.isdir(path) and not os.path.islink(path):
+        for name in sorted(os.listdir(path)):
+            yield from _walk(os.path.join(path, name),
+                             os.path.join(arcname, name))
+
+
+def _normalize(tarinfo: tarfile.TarInfo, mtime: int) -> None:
+    """Describe a member by its name and content only."""
+    tarinfo.mtime = mtime
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ''
+    if tarinfo.isdir() or tarinfo.mode & 0o111:
+        tarinfo.mode = 0o755
+    else:
+        tarinfo.mode = 0o644
+
+
+def _members(source_directory: str,
+             source_date_epoch: Optional[int] = None) \
+        -> Iterator[Tuple[str, tarfile.TarInfo, bytes]]:
+    """Yield the path, description and tar header of each archive member."""
+    # Only used to describe members (owner names, hard links) the way
+    # TarFile.add does; nothing is written to it.
+    if source_date_epoch is None:
+        describer = tarfile.TarFile(fileobj=io.BytesIO(), mode='w')
+    else:
+        # The default format and encoding differ between Python versions
+        # and hosts.
+        describer = tarfile.TarFile(fileobj=io.BytesIO(), mode='w',
+                                    format=tarfile.PAX_FORMAT,
+                                    encoding='utf-8')
+    for path, arcname in _walk(source_directory, os.path.sep):
+        if source_date_epoch is not None:
+            # Hard links depend on the file system, not the files: archive
+            # every file in full.
+            describer.inodes.clear()
+        tarinfo = describer.gettarinfo(path, arcname)
+        if tarinfo is None:
+            # Sockets, for instance, cannot be archived
+            continue
+        if source_date_epoch is not None:
+            _normalize(tarinfo, source_date_epoch)
+        yield path, tarinfo, tarinfo.tobuf(describer.format,
+                                           describer.encoding,
+                                           describer.errors)
+
+
+def _member_blocks(path: str, tarinfo: tarfile.TarInfo,
+                   header: bytes) -> Iterator[bytes]:
+    """Generate the header and (padded) content of an archive member."""
+    yield header
+    if not tarinfo.isreg():
+        return
+
+    remaining = tarinfo.size
+    with open(path, 'rb') as member:
+        while remaining:
+            chunk = member.read(min(READ_SIZE, remaining))
+            if not chunk:
+                raise OSError(f'unexpected end of data in {path}')
+            remaining -= len(chunk)
+            yield chunk
+    remainder = tarinfo.size % tarfile.BLOCKSIZE
+    if remainder:
+        yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+
+
+def _member_length(tarinfo: tarfile.TarInfo, header: bytes) -> int:
+    """Length of an archive member, with its header and padding."""
+    if not tarinfo.isreg():
+        return len(header)
+    blocks = -(-tarinfo.size // tarfile.BLOCKSIZE)
+    return len(header) + blocks * tarfile.BLOCKSIZE
+
+
+def _trailer(offset: int) -> bytes:
+    """End of archive marker, padded to a whole record."""
+    trailer = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+    remainder = (offset + len(trailer)) % tarfile.RECORDSIZE
+    if remainder:
+        trailer += tarfile.NUL * (tarfile.RECORDSIZE - remainder)
+    return trailer
+
+
+def tar_blocks(source_directory: str,
+               source_date_epoch: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Generate an (uncompressed) tar archive of a directory.
+
+    Parameters
+    ----------
+    source_directory : str
+        Directory to archive. Its members are named relative to it.
+    source_date_epoch : int
+        If given, make the archive reproducible, with this modification
+        time (in seconds since the epoch) for all members.
+
+    Returns
+    -------
+    iterator of bytes
+        Consecutive pieces of the archive.
+
+    """
+    offset = 0
+    for path, tarinfo, header in _members(source_directory,
+                                          source_date_epoch):
+        yield from _member_blocks(path, tarinfo, header)
+        offset += _member_length(tarinfo, header)
+    yield _trailer(offset)
+
+
+def generate(source_directory: str,
+             compresslevel: int = DEFAULT_COMPRESSLEVEL,
+             threads: int = 1,
+             source_date_epoch: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Generate the gzipped tar archive of a directory.
+
+    Parameters
+    ----------
+    source_directory : str
+        Directory to archive.
+    compresslevel : int
+        gzip compression level.
+    threads : int
+        Number of threads compressing the archive (see
+        :mod:`filemanager.utilities.parallel_gzip`).
+    source_date_epoch : int
+        If given, make the archive reproducible, with this modification
+        time (in seconds since the epoch) for all members.
+
+    Returns
+    -------
+    iterator of bytes
+        Consecutive pieces of the compressed archive.
+
+    """
+    return parallel_gzip.compress(
+        tar_blocks(source_directory, source_date_epoch), compresslevel, threads
+    )
+
+
+def generate_cached(source_directory: str, cache_directory: str,
+                    compresslevel: int = DEFAULT_COMPRESSLEVEL,
+                    threads: int = 1,
+                    source_date_epoch: Optional[int] = None) \
+        -> Iterator[bytes]:
+    """
+    Generate the gzipped tar archive of a directory from cached members.
+
+    Each archive member is compressed as a gzip member of its own, and kept
+    in ``cache_directory`` under a name derived from its tar header (path,
+    size, modification time, mode and owner), modification time in
+    nanoseconds and the compression level. The archive is the concatenation
+    of these gzip members (plus one for the end of archive marker), which is
+    itself a valid gzip stream. Only members that changed since the archive
+    was last generated are compressed again; unused cached members are
+    removed once the archive has been generated in full.
+
+    Parameters
+    ----------
+    source_directory : str
+        Directory to archive.
+    cache_directory : str
+        Directory in which compressed members are kept.
+    compresslevel : int
+        gzip compression level.
+    threads : int
+        Number of threads compressing a member.
+    source_date_epoch : int
+        If given, make the archive reproducible, with this modification
+        time (in seconds since the epoch) for all members.
+
+    Returns
+    -------
+    iterator of bytes
+        Consecutive pieces of the compressed archive.
+
+    """
+    os.makedirs(cache_directory, exist_ok=True)
+    used = set()
+    offset = 0
+    for path, tarinfo, header in _members(source_directory,
+                                          source_date_epoch):
+        key = sha256(header)
+        key.update(f'{os.lstat(path).st_mtime_ns} {compresslevel}'.encode())
+        segment_name = f'{key.hexdigest()}.gz'
+        segment_path = os.path.join(cache_directory, segment_name)
+        used.add(segment_name)
+        offset += _member_length(tarinfo, header)
+        try:
+            with open(segment_path, 'rb') as segment:
+                yield from iter(lambda: segment.read(READ_SIZE), b'')
+            continue
+        except FileNotFoundError:
+            pass
+
+        # Write to a temporary file and rename so that concurrent readers
+        # never see a partially written member.
+        descriptor, tmp_path = tempfile.mkstemp(dir=cache_directory,
+                                                suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'wb') as segment:
+                for chunk in parallel_gzip.compress(
+                        _member_blocks(path, tarinfo, header),
+                        compresslevel, threads):
+                    segment.write(chunk)
+                    yield chunk
+            os.replace(tmp_path, segment_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    yield from parallel_gzip.compress([_trailer(offset)], compresslevel)
+
+    for name in os.listdir(cache_directory):
+        if name not in used and not name.endswith('.tmp'):
+            try:
+                os.remove(os.path.join(cache_directory, name))
+            except FileNotFoundError:
+                pass
+
+
+class ContentStream(io.RawIOBase):
+    """
+    Read-only file-like object over generated content package chunks.
+
+    The MD5 checksum and size of the package are computed as it is read.
+    Once the last chunk has been read, ``on_complete`` is called with the
+    (b64-encoded) checksum and the size.
+    """
+
+    def __init__(self, chunks: Iterator[bytes], name: str,
+                 on_complete: Optional[Callable[[str, int], None]] = None) \
+            -> None:
+        super().__init__()
+        self.name = name
+        self.__chunks = chunks
+        self.__on_complete = on_complete
+        self.__buffer = memoryview(b'')
+        self.__position = 0
+        self.__hash = md5()
+        self.__size = 0
+        self.__checksum: Optional[str] = None
+
+    @property
+    def checksum(self) -> Optional[str]:
+        """Checksum of the package, once it has been read to the end."""
+        return self.__checksum
+
+    @property
+    def size(self) -> int:
+        """Number of bytes read so far."""
+        return self.__size
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: bytearray) -> int:
+        while self.__position == len(self.__buffer) \
+                and self.__checksum is None:
+            try:
+                chunk = next(self.__chunks)
+            except StopIteration:
+                self.__checksum = b64encode(self.__hash.digest()) \
+                    .decode('utf-8')
+                if self.__on_complete is not None:
+                    self.__on_complete(self.__checksum, self.__size)
+                break
+            self.__hash.update(chunk)
+            self.__size += len(chunk)
+            self.__buffer = memoryview(chunk)
+            self.__position = 0
+
+        count = min(len(buffer), len(self.__buffer) - self.__position)
+        buffer[:count] = self.__buffer[self.__position:self.__position + count]
+        self.__position += count
+        return count
+
+    def close(self) -> None:
+        if not self.closed:
+            # Stop the generator, closing the member being read
+            close = getattr(self.__chunks, 'close', None)
+            if close is not None:
+                close()
+        super().close()
+
+
+def load_checksum(checksum_path: str, modified: datetime,
+                  mtime_ns: Optional[int] = None,
+                  options: Optional[dict] = None) -> Optional[str]:
+    """
+    Get the cached checksum of a content package.
+
+    Parameters
+    ----------
+    checksum_path : str
+        Location of the sidecar file.
+    modified : datetime
+        Time of the most recent change to the workspace.
+    mtime_ns : int
+        Modification time (in nanoseconds) of the package file, if the
+        package was written to disk.
+    options : dict
+        Options the package must have been generated with.
+
+    Returns
+    -------
+    str
+        The cached checksum, or ``None`` if there is none, the workspace
+        (or package file) has changed since it was cached, or the package was
+        generated with other options.
+
+    """
+    try:
+        with open(checksum_path, 'r') as checksum_file:
+            data = json.load(checksum_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as error:
+        logger.warning('Ignoring unreadable content checksum %s: %s',
+                       checksum_path, error)
+        return None
+    if not isinstance(data, dict) \
+            or data.get('modified') != modified.isoformat() \
+            or (mtime_ns is not None and data.get('mtime_ns') != mtime_ns) \
+            or (options is not None and data.get('options') != options):
+        return None
+    return data.get('checksum')
+
+
+def save_checksum(checksum_path: str, modified: datetime, checksum: str,
+                  size: int, mtime_ns: Optional[int] = None,
+                  options: Optional[dict] = None) -> None:
+    """
+    Cache the checksum of a content package.
+
+    Parameters
+    ----------
+    checksum_path : str
+        Location of the sidecar file.
+    modified : datetime
+        Time of the most recent change to the workspace when the package was
+        generated.
+    checksum : str
+        b64-encoded MD5 checksum of the package.
+    size : int
+        Size of the package in bytes.
+    mtime_ns : int
+        Modification time (in nanoseconds) of the package file, if the
+        package was written to disk.
+    options : dict
+        Options the package was generated with.
+
+    """
+    # Write to a temporary file and rename so that concurrent readers never
+    # see a partially written sidecar.
+    tmp_path = f'{checksum_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w') as checksum_file:
+            json.dump({'modified': modified.isoformat(),
+                       'checksum': checksum,
+                       'size': size,
+                       'mtime_ns': mtime_ns,
+                       'options': options}, checksum_file)
+        os.replace(tmp_path, checksum_path)
+    except OSError as error:
+        logger.warning('Unable to save content checksum %s: %s',
+                       checksum_path, error)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
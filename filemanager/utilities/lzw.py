@@ -0,0 +1,194 @@
+"""Streaming decoder for files made by the Unix ``compress`` utility (.Z).
+
+Python does not support the LZW format used by ``compress``, and legacy
+submissions still arrive as ``.Z`` and ``.tar.Z`` files. :class:`LZWReader`
+decompresses such a file incrementally, so that it can be copied or read by
+:mod:`tarfile` in stream mode without holding the whole file in memory.
+
+The format is the one decoded by ``uncompress`` and ``gzip -d``: a three byte
+header (magic number and flags) followed by variable width codes, packed
+least significant bit first. Codes start out 9 bits wide and grow up to the
+maximum width given in the header. Codes are written in groups of eight, and
+the rest of a group is skipped whenever the code width changes or (in block
+mode) the table is cleared.
+"""
+
+import io
+from typing import BinaryIO, List
+
+MAGIC = b'\x1f\x9d'
+
+INIT_BITS = 9
+"""Initial code width."""
+
+MAX_BITS = 16
+"""Largest code width supported by compress."""
+
+BLOCK_MODE = 0x80
+"""Header flag: code 256 clears the table."""
+
+BITS_MASK = 0x1f
+"""Header flags holding the maximum code width."""
+
+CLEAR = 256
+"""Clears the table in block mode."""
+
+READ_SIZE = 64 * 1024
+"""Bytes of compressed input read at a time."""
+
+
+class LZWError(IOError):
+    """The compressed data is not valid."""
+
+
+class LZWReader(io.RawIOBase):
+    """Read-only stream of the data decompressed from a .Z file."""
+
+    def __init__(self, compressed: BinaryIO) -> None:
+        """
+        Start decompressing ``compressed``.
+
+        Parameters
+        ----------
+        compressed : file-like
+            Binary stream positioned at the start of the .Z header.
+
+        Raises
+        ------
+        :class:`LZWError`
+            If the stream does not start with a valid header.
+
+        """
+        super().__init__()
+        header = compressed.read(3)
+        if len(header) < 3 or header[:2] != MAGIC:
+            raise LZWError('Not in compress (.Z) format')
+        self.__max_bits = header[2] & BITS_MASK
+        self.__block_mode = bool(header[2] & BLOCK_MODE)
+        if not INIT_BITS <= self.__max_bits <= MAX_BITS:
+            raise LZWError(f'Unsupported maximum code width: '
+                           f'{self.__max_bits} bits')
+        self.__max_max_code = 1 << self.__max_bits
+
+        self.__compressed = compressed
+        self.__eof = False
+        self.__data = b''        # Compressed input not yet decoded
+        self.__position = 0      # Position in bits of next code in data
+        self.__output = bytearray()
+
+        self.__prefix = [0] * self.__max_max_code
+        self.__suffix = bytearray(range(256)) \
+            + bytearray(self.__max_max_code - 256)
+        self.__n_bits = INIT_BITS
+        self.__max_code = (1 << INIT_BITS) - 1
+        self.__free_ent = CLEAR + 1 if self.__block_mode else CLEAR
+        self.__group_codes = 0   # Codes read in current group of eight
+        self.__old_code = -1
+        self.__fin_char = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: bytearray) -> int:
+        """Decompress into ``buffer``, returning the number of bytes read."""
+        wanted = len(buffer)
+        if len(self.__output) < wanted:
+            self._decode(wanted)
+        size = min(wanted, len(self.__output))
+        buffer[:size] = self.__output[:size]
+        del self.__output[:size]
+        return size
+
+    def _available(self) -> int:
+        """Number of compressed bits read but not yet decoded."""
+        return len(self.__data) * 8 - self.__position
+
+    def _fill(self) -> None:
+        """Read more compressed input."""
+        data = self.__compressed.read(READ_SIZE)
+        if not data:
+            self.__eof = True
+        self.__data = self.__data[self.__position >> 3:] + data
+        self.__position &= 7
+
+    def _skip_group(self) -> None:
+        """Skip the rest of the current group of eight codes."""
+        if self.__group_codes:
+            skip = (8 - self.__group_codes) * self.__n_bits
+            while self._available() < skip and not self.__eof:
+                self._fill()
+            self.__position += min(skip, self._available())
+        self.__group_codes = 0
+
+    def _decode(self, wanted: int) -> None:
+        """Decode codes until there are ``wanted`` bytes of output."""
+        # Local copies for speed, since this runs for every code
+        prefix = self.__prefix
+        suffix = self.__suffix
+        output = self.__output
+        stack: List[int] = []
+
+        while len(output) < wanted:
+            if self.__free_ent > self.__max_code:
+                # Codes get wider
+                self._skip_group()
+                self.__n_bits += 1
+                if self.__n_bits == self.__max_bits:
+                    self.__max_code = self.__max_max_code
+                else:
+                    self.__max_code = (1 << self.__n_bits) - 1
+
+            n_bits = self.__n_bits
+            if self._available() < n_bits:
+                if self.__eof:
+                    # Anything left over is padding
+                    return
+                self._fill()
+                continue
+            position = self.__position
+            start = position >> 3
+            code = (int.from_bytes(self.__data[start:start + 3], 'little')
+                    >> (position & 7)) & ((1 << n_bits) - 1)
+            self.__position = position + n_bits
+            self.__group_codes = (self.__group_codes + 1) % 8
+
+            if self.__old_code == -1:
+                if code >= 256:
+                    raise LZWError('Corrupt input: invalid first code')
+                self.__old_code = self.__fin_char = code
+                output.append(code)
+                continue
+
+            if code == CLEAR and self.__block_mode:
+                self.__free_ent = CLEAR
+                self._skip_group()
+                self.__n_bits = INIT_BITS
+                self.__max_code = (1 << INIT_BITS) - 1
+                continue
+
+            in_code = code
+            if code >= self.__free_ent:
+                # Code for the string about to be added to the table
+                if code > self.__free_ent:
+                    raise LZWError('Corrupt input: invalid code')
+                stack.append(self.__fin_char)
+                code = self.__old_code
+            while code >= 256:
+                stack.append(suffix[code])
+                code = prefix[code]
+            self.__fin_char = code
+            stack.append(code)
+            stack.reverse()
+            output.extend(stack)
+            stack.clear()
+
+            if self.__free_ent < self.__max_max_code:
+                prefix[self.__free_ent] = self.__old_code
+                suffix[self.__free_ent] = self.__fin_char
+                self.__free_ent += 1
+            self.__old_code = in_code
+
+
+def open_lzw(compressed: BinaryIO) -> io.BufferedReader:
+    """Return a buffered stream of the data decompressed from a .Z file."""
+    return io.BufferedReader(LZWReader(compressed), READ_SIZE)
@@ -0,0 +1,406 @@
+"""Persistent index of the files in an upload workspace.
+
+The manifest records, for each file in the source directory, its size,
+modification time, detected type, checksum (once calculated), whether it
+has passed upload checks (and the errors found if so) and whether it has
+been removed during upload processing. It is kept up to date by
+:class:`filemanager.process.upload.Upload` as files are deposited,
+unpacked, checked and deleted, so that size totals, file lists and
+modification times can be reported without walking the source directory.
+
+The manifest also remembers the digest of the upload that produced the
+current state of the workspace, so that an identical upload can be
+recognized and need not be processed again. Any later change to the
+workspace forgets it.
+
+The manifest is stored as a JSON sidecar file in the upload workspace,
+outside of the source directory. It also records the inode and
+modification time of the source directory when it was saved. If the
+source directory has changed since (because the workspace was changed
+other than through :class:`Upload`, or a request failed before saving the
+manifest), the saved manifest is out of date and is not loaded.
+"""
+
+import json
+import os
+import time
+from base64 import b64encode
+from datetime import datetime
+from hashlib import md5
+from typing import Dict, Iterable, List, Optional
+
+from pytz import UTC
+from arxiv.base import logging
+
+from filemanager.arxiv.file import File
+from filemanager.arxiv.file_type import name
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 2
+"""Bump when the format of manifest entries changes."""
+
+
+def file_checksum(path: str) -> str:
+    """Calculate the b64-encoded MD5 hash of the file at ``path``."""
+    hash_md5 = md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(4096), b""):
+            hash_md5.update(chunk)
+    return b64encode(hash_md5.digest()).decode('utf-8')
+
+
+def _directory_identity(path: str) -> Optional[List[int]]:
+    """Inode and modification time of a directory, if it exists."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_ino, stat.st_mtime_ns]
+
+
+def _details(path: str, entry: dict) -> dict:
+    """Describe a file in the same way as :class:`File` objects do."""
+    # Same float as os.stat_result.st_mtime
+    seconds, nanoseconds = divmod(entry['mtime_ns'], 1000000000)
+    mtime = seconds + nanoseconds * 1e-9
+    return {
+        'name': os.path.basename(path),
+        'public_filepath': path,
+        'size': entry['size'],
+        'type': name(entry['type']),
+        'modified_datetime': datetime.fromtimestamp(mtime, tz=UTC).isoformat()
+    }
+
+
+class Manifest:
+    """
+    Index of the files in a workspace source directory.
+
+    Entries are keyed by public file path (relative to the source
+    directory).
+    """
+
+    def __init__(self, manifest_path: str, source_directory: str) -> None:
+        """
+        Load the manifest stored at ``manifest_path``.
+
+        Parameters
+        ----------
+        manifest_path : str
+            Location of the sidecar file.
+        source_directory : str
+            Directory that the manifest indexes.
+
+        """
+        self.__manifest_path = manifest_path
+        self.__source_directory = source_directory
+        self.__entries: Dict[str, dict] = {}
+        self.__total_size = 0
+        self.__modified = 0.0
+        self.__upload_digest: Optional[str] = None
+        self.__loaded = False
+        self.__dirty = False
+        self.load()
+
+    @property
+    def manifest_path(self) -> str:
+        """Location of the sidecar file."""
+        return self.__manifest_path
+
+    @property
+    def loaded(self) -> bool:
+        """Whether the manifest was read from an existing sidecar file."""
+        return self.__loaded
+
+    @property
+    def modified(self) -> datetime:
+        """Time of the most recent change recorded in the manifest."""
+        return datetime.fromtimestamp(self.__modified, tz=UTC)
+
+    def load(self) -> None:
+        """(Re)load entries from the sidecar file."""
+        self.__entries = {}
+        self.__total_size = 0
+        self.__modified = 0.0
+        self.__upload_digest = None
+        self.__loaded = False
+        self.__dirty = False
+        try:
+            with open(self.__manifest_path, 'r') as manifest_file:
+                data = json.load(manifest_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as error:
+            logger.warning('Ignoring unreadable manifest %s: %s',
+                           self.__manifest_path, error)
+            return
+
+        if not isinstance(data, dict) \
+                or data.get('version') != MANIFEST_VERSION \
+                or not isinstance(data.get('entries'), dict):
+            return
+        if data.get('source') != _directory_identity(self.__source_directory):
+            logger.info('Manifest %s is out of date', self.__manifest_path)
+            return
+        self.__entries = data['entries']
+        self.__total_size = sum(entry['size']
+                                for entry in self.__entries.values()
+                                if not entry['removed'])
+        self.__modified = data.get('modified', 0.0)
+        self.__upload_digest = data.get('upload_digest')
+        self.__loaded = True
+
+    @property
+    def upload_digest(self) -> Optional[str]:
+        """Digest of the upload that produced the current workspace state."""
+        return self.__upload_digest
+
+    def record_upload(self, digest: Optional[str]) -> None:
+        """
+        Remember the digest of the upload that was just processed.
+
+        Parameters
+        ----------
+        digest : str
+            Digest of the upload, or ``None`` if it is not known.
+
+        """
+        if digest != self.__upload_digest:
+            self.__upload_digest = digest
+            self.__dirty = True
+
+    def _touch(self) -> None:
+        """Record that the manifest (and so the workspace) has changed."""
+        self.__modified = max(time.time(), self.__modified)
+        self.__upload_digest = None
+        self.__dirty = True
+
+    def _set(self, path: str, entry: dict) -> None:
+        """Store an entry, keeping the total size up to date."""
+        self._pop(path)
+        self.__entries[path] = entry
+        if not entry['removed']:
+            self.__total_size += entry['size']
+
+    def _pop(self, path: str) -> Optional[dict]:
+        """Remove an entry, keeping the total size up to date."""
+        entry = self.__entries.pop(path, None)
+        if entry is not None and not entry['removed']:
+            self.__total_size -= entry['size']
+        return entry
+
+    def add(self, file: File, checked: bool = False,
+            errors: Iterable[str] = ()) -> None:
+        """
+        Add or replace the entry for ``file``.
+
+        Parameters
+        ----------
+        file : :class:`File`
+            File in the source directory.
+        checked : bool
+            Whether the file has been through upload checks.
+        errors : list
+            Errors found by the checks.
+
+        """
+        stat = file.stat
+        entry = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'type': file.type,
+            'checksum': None,
+            'checked': checked,
+            'errors': list(errors),
+            'removed': False
+        }
+        previous = self.__entries.get(file.public_filepath)
+        if previous is not None and previous['size'] == entry['size'] \
+                and previous['mtime_ns'] == entry['mtime_ns']:
+            entry['checksum'] = previous['checksum']
+        if previous != entry:
+            self._set(file.public_filepath, entry)
+            self._touch()
+
+    def discard(self, public_file_path: str) -> None:
+        """Remove the entry for a file, if there is one."""
+        if self._pop(public_file_path) is not None:
+            self._touch()
+
+    def discard_tree(self, public_dir: str) -> None:
+        """Remove the entries for all files below a directory."""
+        prefix = public_dir.rstrip('/') + '/'
+        for path in [p for p in self.__entries if p.startswith(prefix)]:
+            self._pop(path)
+            self._touch()
+
+    def move_tree(self, public_dir: str, new_public_dir: str) -> None:
+        """
+        Update the entries for files below a directory that has been moved.
+
+        An empty ``new_public_dir`` moves the files to the top level.
+        """
+        prefix = public_dir.rstrip('/') + '/'
+        new_prefix = new_public_dir.rstrip('/') + '/' if new_public_dir else ''
+        for path in [p for p in self.__entries if p.startswith(prefix)]:
+            self._set(new_prefix + path[len(prefix):], self._pop(path))
+            self._touch()
+
+    def mark_removed(self, public_file_path: str) -> None:
+        """Flag a file as removed during upload processing."""
+        entry = self.__entries.get(public_file_path)
+        if entry is not None and not entry['removed']:
+            entry['removed'] = True
+            self.__total_size -= entry['size']
+            self._touch()
+
+    def clear(self) -> None:
+        """Remove all entries."""
+        self.__entries = {}
+        self.__total_size = 0
+        self._touch()
+
+    def rebuild(self, files: Iterable[File], modified: float = 0.0) -> None:
+        """
+        Replace all entries with entries for ``files``.
+
+        The manifest is taken to have changed when the newest of the files
+        was modified, or at ``modified`` (such as the newest directory
+        modification time, which also reflects removed files) if that is
+        later. Rebuilding the manifest of an unchanged workspace thus does
+        not change its modification time.
+        """
+        previous = self.__modified
+        self.__entries = {}
+        self.__total_size = 0
+        for file in files:
+            self.add(file)
+        newest = max((entry['mtime_ns'] for entry in self.__entries.values()),
+                     default=0)
+        self.__modified = max(previous, modified, newest / 1e9)
+        self.__upload_digest = None
+        self.__dirty = True
+
+    def entry(self, public_file_path: str) -> Optional[dict]:
+        """Return the entry for a file that has not been removed."""
+        entry = self.__entries.get(public_file_path)
+        if entry is None or entry['removed']:
+            return None
+        return entry
+
+    def paths(self, checked: Optional[bool] = None) -> List[str]:
+        """
+        List the files that have not been removed.
+
+        Parameters
+        ----------
+        checked : bool
+            If given, only list files that have (``True``) or have not
+            (``False``) been checked.
+
+        """
+        return [path for path, entry in self.__entries.items()
+                if not entry['removed']
+                and (checked is None or entry['checked'] == checked)]
+
+    def checked(self, file: File) -> Optional[dict]:
+        """
+        Return the entry for ``file`` if it has been checked.
+
+        Returns
+        -------
+        dict
+            The entry, or ``None`` if the file has not been checked or has
+            changed since.
+
+        """
+        entry = self.entry(file.public_filepath)
+        if entry is None or not entry['checked']:
+            return None
+        stat = file.stat
+        if entry['size'] != stat.st_size \
+                or entry['mtime_ns'] != stat.st_mtime_ns:
+            return None
+        return entry
+
+    @property
+    def total_size(self) -> int:
+        """Total size in bytes of files that have not been removed."""
+        return self.__total_size
+
+    def summary(self) -> List[dict]:
+        """
+        Describe the files that have not been removed.
+
+        Returns
+        -------
+        list
+            One dict per file with the same details as reported for
+            :class:`File` objects: name, public_filepath, size, type and
+            modified_datetime.
+
+        """
+        return [_details(path, entry)
+                for path, entry in sorted(self.__entries.items())
+                if not entry['removed']]
+
+    def details(self, public_file_path: str) -> Optional[dict]:
+        """Describe a single file, as in :meth:`summary`."""
+        entry = self.entry(public_file_path)
+        if entry is None:
+            return None
+        return _details(public_file_path, entry)
+
+    def cached_checksum(self, file: File) -> Optional[str]:
+        """Return the checksum remembered for this version of ``file``."""
+        stat = file.stat
+        entry = self.__entries.get(file.public_filepath)
+        if entry is None or entry['size'] != stat.st_size \
+                or entry['mtime_ns'] != stat.st_mtime_ns:
+            return None
+        return entry['checksum']
+
+    def checksum(self, file: File) -> str:
+        """
+        Return the b64-encoded MD5 hash of ``file``.
+
+        The checksum is calculated once per version of the file and
+        remembered in the manifest.
+        """
+        stat = file.stat
+        entry = self.__entries.get(file.public_filepath)
+        if entry is None or entry['size'] != stat.st_size \
+                or entry['mtime_ns'] != stat.st_mtime_ns:
+            self.add(file)
+            entry = self.__entries[file.public_filepath]
+        if entry['checksum'] is None:
+            entry['checksum'] = file_checksum(file.filepath)
+            self.__dirty = True
+        return entry['checksum']
+
+    def save(self) -> None:
+        """Write the manifest to its sidecar file if it has changed."""
+        if not self.__dirty:
+            return
+
+        # Write to a temporary file and rename so that concurrent readers
+        # never see a partially written manifest.
+        tmp_path = f'{self.__manifest_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w') as manifest_file:
+                json.dump({'version': MANIFEST_VERSION,
+                           'source':
+                               _directory_identity(self.__source_directory),
+                           'modified': self.__modified,
+                           'upload_digest': self.__upload_digest,
+                           'entries': self.__entries}, manifest_file)
+            os.replace(tmp_path, self.__manifest_path)
+        except OSError as error:
+            logger.warning('Unable to save manifest %s: %s',
+                           self.__manifest_path, error)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.__dirty = False
+        self.__loaded = True
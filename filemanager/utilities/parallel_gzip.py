@@ -0,0 +1,126 @@
+"""Compress data to gzip format on several threads.
+
+As in pigz, the input is split into blocks that are deflated independently
+by a pool of threads (zlib releases the GIL while it compresses). Each block
+is primed with the last 32 KiB of the block before it as a preset
+dictionary, so compression is nearly as good as for a single deflate
+stream, and ends with a sync flush so that the compressed blocks can simply
+be concatenated. The result is a single standard (RFC 1952) gzip member that
+any gunzip can read.
+
+The output depends on the compression level and block size, but not on the
+number of threads.
+"""
+
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
+
+DEFAULT_BLOCK_SIZE = 128 * 1024
+"""Size of the blocks of input that are compressed independently."""
+
+DICTIONARY_SIZE = 32 * 1024
+"""Size of the deflate window, the most of a preset dictionary zlib uses."""
+
+_GZIP_OS_UNKNOWN = 255
+
+
+def _header(compresslevel: int) -> bytes:
+    """Gzip member header, without name or timestamp."""
+    if compresslevel == 9:
+        extra_flags = 2     # Maximum compression
+    elif compresslevel == 1:
+        extra_flags = 4     # Fastest compression
+    else:
+        extra_flags = 0
+    return struct.pack('<BBBBIBB', 0x1f, 0x8b, zlib.DEFLATED, 0, 0,
+                       extra_flags, _GZIP_OS_UNKNOWN)
+
+
+def _blocks(chunks: Iterable[bytes], block_size: int) -> Iterator[bytes]:
+    """Regroup chunks of input into blocks of ``block_size`` bytes."""
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= block_size:
+            data = bytes(buffer)
+            end = len(data) - len(data) % block_size
+            for start in range(0, end, block_size):
+                yield data[start:start + block_size]
+            del buffer[:end]
+    if buffer:
+        yield bytes(buffer)
+
+
+def _deflate(block: bytes, compresslevel: int, dictionary: bytes) -> bytes:
+    """Deflate a block, ending on a byte boundary."""
+    if dictionary:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED,
+                                      -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED,
+                                      -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def compress(chunks: Iterable[bytes], compresslevel: int = 9,
+             threads: int = 1,
+             block_size: int = DEFAULT_BLOCK_SIZE) -> Iterator[bytes]:
+    """
+    Compress a sequence of chunks to gzip format.
+
+    Parameters
+    ----------
+    chunks : iterable of bytes
+        Data to compress.
+    compresslevel : int
+        Deflate compression level, from 0 (none) to 9 (best).
+    threads : int
+        Number of threads compressing blocks. With one thread, blocks are
+        compressed as they are read.
+    block_size : int
+        Size of the blocks of input that are compressed independently.
+
+    Returns
+    -------
+    iterator of bytes
+        Consecutive pieces of the gzip member.
+
+    """
+    yield _header(compresslevel)
+
+    crc = 0
+    size = 0
+    previous = b''
+    executor = ThreadPoolExecutor(threads) if threads > 1 else None
+    pending: deque = deque()
+    try:
+        for block in _blocks(chunks, block_size):
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            dictionary = previous[-DICTIONARY_SIZE:]
+            previous = block
+            if executor is None:
+                yield _deflate(block, compresslevel, dictionary)
+                continue
+
+            pending.append(executor.submit(_deflate, block, compresslevel,
+                                           dictionary))
+            # Keep a couple of blocks per thread in flight, no more, so
+            # that memory use does not grow with the size of the input.
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        if executor is not None:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    # Empty final block, then the trailer
+    yield zlib.compressobj(compresslevel, zlib.DEFLATED,
+                           -zlib.MAX_WBITS).flush() \
+        + struct.pack('<II', crc, size & 0xffffffff)
@@ -0,0 +1,280 @@
+"""Run untrusted upload processing in a subprocess with resource limits.
+
+Unpacking archives and sniffing the types of the files in them can take a
+long time, or a lot of memory, for a pathological upload. :func:`run` calls
+a function in a worker subprocess, with limits on CPU time, address space
+and the size of the files it writes (see :class:`SandboxLimits`), and kills
+the worker if it runs past a wall-clock deadline.
+
+Each server process keeps a pool of up to ``SANDBOX_WORKERS`` worker
+subprocesses, which run one function at a time each. Workers are started
+from a fork server (rather than forked from a possibly threaded server
+process) and are reused until a function fails or is stopped, so that
+uploads are spread across cores without starting a Python interpreter for
+each one.
+
+The function, its arguments and its return value are sent between
+processes, so they must be picklable: use a module-level function that
+picks up any state it needs (such as a workspace) by itself. The worker
+runs the function with a copy of the caller's application config.
+"""
+
+import math
+import multiprocessing
+import os
+import resource
+import signal
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+from flask import Flask
+
+from arxiv.base import logging
+from arxiv.base.globals import get_application_config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CPU_SECONDS = 120
+"""CPU time (in seconds) a subprocess may use."""
+
+DEFAULT_MEMORY = 2 * 1024 * 1024 * 1024
+"""Address space (in bytes) a subprocess may use."""
+
+DEFAULT_OUTPUT_SIZE = 512 * 1024 * 1024
+"""Largest file (in bytes) a subprocess may write."""
+
+DEFAULT_TIMEOUT = 300
+"""Wall-clock time (in seconds) after which a subprocess is killed."""
+
+_CONFIG_TYPES = (str, int, float, bool, type(None))
+"""Types of the config values that are passed to workers."""
+
+_slots: Optional[threading.BoundedSemaphore] = None
+_slots_lock = threading.Lock()
+
+_idle: List['_Worker'] = []
+"""Workers waiting for a function to run."""
+_idle_lock = threading.Lock()
+
+
+def _get_setting(key: str, default: int) -> int:
+    """Get a limit from the application config (or environment)."""
+    return int(get_application_config().get(key, default))
+
+
+class SandboxError(Exception):
+    """The subprocess failed, or was stopped by a limit."""
+
+    def __init__(self, message: str) -> None:
+        self.message = message
+        super().__init__(message)
+
+
+class SandboxLimits:
+    """
+    Resource limits for a sandboxed subprocess.
+
+    Limits default to the ``SANDBOX_CPU_SECONDS``, ``SANDBOX_MEMORY``,
+    ``SANDBOX_OUTPUT_SIZE`` and ``SANDBOX_TIMEOUT`` settings.
+    """
+
+    def __init__(self, cpu_seconds: Optional[int] = None,
+                 memory: Optional[int] = None,
+                 output_size: Optional[int] = None,
+                 timeout: Optional[float] = None) -> None:
+        if cpu_seconds is None:
+            cpu_seconds = _get_setting('SANDBOX_CPU_SECONDS',
+                                       DEFAULT_CPU_SECONDS)
+        if memory is None:
+            memory = _get_setting('SANDBOX_MEMORY', DEFAULT_MEMORY)
+        if output_size is None:
+            output_size = _get_setting('SANDBOX_OUTPUT_SIZE',
+                                       DEFAULT_OUTPUT_SIZE)
+        if timeout is None:
+            timeout = _get_setting('SANDBOX_TIMEOUT', DEFAULT_TIMEOUT)
+        self.cpu_seconds = cpu_seconds
+        self.memory = memory
+        self.output_size = output_size
+        self.timeout = timeout
+
+    def apply(self) -> None:
+        """
+        Set the limits on the current process.
+
+        Only soft limits are set, so that a worker can set them again for
+        the next function it runs.
+        """
+        # CPU time adds up over the life of the worker. Past the limit the
+        # worker is sent SIGXCPU, which kills it.
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        used = math.ceil(usage.ru_utime + usage.ru_stime)
+        _set_soft_limit(resource.RLIMIT_CPU, used + self.cpu_seconds)
+        _set_soft_limit(resource.RLIMIT_AS, self.memory)
+        # Writing past the limit fails with EFBIG rather than killing the
+        # process.
+        signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+        _set_soft_limit(resource.RLIMIT_FSIZE, self.output_size)
+
+
+def _set_soft_limit(kind: int, limit: int) -> None:
+    """Set a soft resource limit, within the hard limit."""
+    hard = resource.getrlimit(kind)[1]
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(kind, (limit, hard))
+
+
+def _get_slots() -> threading.BoundedSemaphore:
+    """Limit on the number of workers running at a time."""
+    global _slots
+    with _slots_lock:
+        if _slots is None:
+            workers = _get_setting('SANDBOX_WORKERS', os.cpu_count() or 1)
+            _slots = threading.BoundedSemaphore(max(1, workers))
+        return _slots
+
+
+def _get_context() -> Any:
+    """Multiprocessing context that starts workers without forking."""
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def _get_config() -> dict:
+    """Copy of the application config that can be sent to a worker."""
+    return {key: value for key, value in get_application_config().items()
+            if isinstance(key, str) and isinstance(value, _CONFIG_TYPES)}
+
+
+def _call(limits: SandboxLimits, function: Callable, args: tuple,
+          config: dict) -> tuple:
+    """Call ``function`` in a worker, returning the outcome."""
+    try:
+        limits.apply()
+        app = Flask(__name__)
+        app.config.update(config)
+        with app.app_context():
+            return ('result', function(*args))
+    except MemoryError:
+        return ('error', 'ran out of memory')
+    except BaseException as error:
+        return ('error', f'{type(error).__name__}: {error}')
+
+
+def _serve(connection: Any) -> None:
+    """Run functions sent by the server process until the pipe closes."""
+    while True:
+        try:
+            limits, function, args, config = connection.recv()
+        except EOFError:
+            break
+        outcome = _call(limits, function, args, config)
+        try:
+            connection.send(outcome)
+        except Exception as error:
+            connection.send(('error', f'unable to return result: {error}'))
+    connection.close()
+
+
+def _describe_exit(exitcode: Optional[int]) -> str:
+    """Explain why a worker died without sending back an outcome."""
+    if exitcode is not None and exitcode < 0:
+        signum = -exitcode
+        if signum == signal.SIGXCPU:
+            return 'exceeded the CPU time limit'
+        if signum == signal.SIGKILL:
+            return 'was killed (CPU time or memory limit exceeded)'
+        return f'was killed by signal {signal.Signals(signum).name}'
+    return f'exited with status {exitcode}'
+
+
+class _Worker:
+    """A worker subprocess and the pipe to it."""
+
+    def __init__(self) -> None:
+        context = _get_context()
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_serve,
+                                       args=(child_connection,),
+                                       daemon=True)
+        self.process.start()
+        child_connection.close()
+
+    def stop(self) -> None:
+        """Kill the worker."""
+        if self.process.is_alive():
+            # Process.kill() is new in Python 3.7
+            os.kill(self.process.pid, signal.SIGKILL)
+        self.process.join()
+        self.connection.close()
+
+
+def _get_worker() -> _Worker:
+    """Take an idle worker, or start a new one."""
+    with _idle_lock:
+        while _idle:
+            worker = _idle.pop()
+            if worker.process.is_alive():
+                return worker
+            worker.stop()
+    return _Worker()
+
+
+def run(function: Callable, *args: Any,
+        limits: Optional[SandboxLimits] = None) -> Any:
+    """
+    Call ``function(*args)`` in a sandboxed worker subprocess.
+
+    Parameters
+    ----------
+    function : callable
+        Function to call. It is sent to the worker, so it must be picklable
+        (such as a module-level function).
+    args
+        Arguments for the function, which must be picklable.
+    limits : :class:`SandboxLimits`
+        Resource limits, by default from the application config.
+
+    Returns
+    -------
+    object
+        Return value of the function.
+
+    Raises
+    ------
+    :class:`SandboxError`
+        If the function raised an exception, exceeded a limit or did not
+        finish in time.
+
+    """
+    if limits is None:
+        limits = SandboxLimits()
+    config = _get_config()
+
+    with _get_slots():
+        worker = _get_worker()
+        start = time.monotonic()
+        try:
+            worker.connection.send((limits, function, args, config))
+            if not worker.connection.poll(limits.timeout):
+                raise SandboxError(f'did not finish within {limits.timeout}'
+                                   ' seconds')
+            try:
+                kind, value = worker.connection.recv()
+            except EOFError:
+                worker.process.join()
+                raise SandboxError(_describe_exit(worker.process.exitcode))
+        except BaseException:
+            worker.stop()
+            raise
+        logger.debug('Sandboxed %s finished in %.2fs', function.__name__,
+                     time.monotonic() - start)
+        if kind == 'error':
+            # The worker may have been left in a bad state
+            worker.stop()
+            raise SandboxError(value)
+        with _idle_lock:
+            _idle.append(worker)
+    return value
@@ -0,0 +1,190 @@
+"""Persistent per-workspace cache of detected file types.
+
+Type detection reads file content, and the same files are examined many
+times while an upload is processed and again on every later request
+against the workspace. The cache records the detected type for each file
+together with the file's stat identity (device, inode, size and
+modification time in nanoseconds). An entry is only used while that
+identity is unchanged, so any modification of a file invalidates it.
+
+The cache is stored as a JSON sidecar file in the upload workspace, outside
+of the source directory.
+"""
+
+import json
+import os
+from typing import Dict, List, Optional, Set
+
+from arxiv.base import logging
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+"""Bump to discard caches written by older versions of the type detection."""
+
+
+def _identity(stat: os.stat_result) -> List[int]:
+    """Stat fields that identify a particular version of a file."""
+    return [stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+
+class TypeCache:
+    """
+    Map file paths to detected types, validated by stat identity.
+
+    Paths are stored relative to the source directory, so the cache stays
+    valid when the workspace is moved.
+    """
+
+    def __init__(self, cache_path: str, source_directory: str) -> None:
+        """
+        Load the type cache stored at ``cache_path``.
+
+        Parameters
+        ----------
+        cache_path : str
+            Location of the sidecar file. A missing or unreadable file
+            results in an empty cache.
+        source_directory : str
+            Directory that cached paths are relative to.
+
+        """
+        self.__cache_path = cache_path
+        self.__source_directory = source_directory
+        self.__entries: Dict[str, list] = {}
+        self.__seen: Set[str] = set()
+        self.__dirty = False
+        self.load()
+
+    @property
+    def cache_path(self) -> str:
+        """Location of the sidecar file."""
+        return self.__cache_path
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def _key(self, filepath: str) -> str:
+        return os.path.relpath(filepath, self.__source_directory)
+
+    def load(self) -> None:
+        """(Re)load entries from the sidecar file."""
+        self.__entries = {}
+        self.__seen = set()
+        self.__dirty = False
+        try:
+            with open(self.__cache_path, 'r') as cache_file:
+                data = json.load(cache_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as error:
+            logger.warning('Ignoring unreadable type cache %s: %s',
+                           self.__cache_path, error)
+            return
+
+        if not isinstance(data, dict) or data.get('version') != CACHE_VERSION:
+            return
+        entries = data.get('entries')
+        if isinstance(entries, dict):
+            self.__entries = entries
+
+    def get(self, filepath: str,
+            stat: Optional[os.stat_result] = None) -> Optional[str]:
+        """
+        Return the cached type of ``filepath``.
+
+        Parameters
+        ----------
+        filepath : str
+            Absolute path of the file.
+        stat : os.stat_result
+            Current stat of the file, if already known.
+
+        Returns
+        -------
+        str
+            Cached type, or ``None`` when there is no entry or the file has
+            changed since the entry was recorded.
+
+        """
+        key = self._key(filepath)
+        entry = self.__entries.get(key)
+        if entry is None:
+            return None
+        if stat is None:
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                return None
+        if entry[:4] != _identity(stat):
+            return None
+        self.__seen.add(key)
+        return entry[4]
+
+    def set(self, filepath: str, file_type: str,
+            stat: Optional[os.stat_result] = None) -> None:
+        """Record the detected type of ``filepath``."""
+        if stat is None:
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                return
+        key = self._key(filepath)
+        entry = _identity(stat) + [file_type]
+        self.__seen.add(key)
+        if self.__entries.get(key) != entry:
+            self.__entries[key] = entry
+            self.__dirty = True
+
+    def move_tree(self, public_dir: str, new_public_dir: str) -> None:
+        """
+        Update the entries for files below a directory that has been moved.
+
+        Renaming keeps the stat identity of files, so the entries stay
+        valid. An empty ``new_public_dir`` moves the files to the top level.
+        """
+        prefix = public_dir.rstrip('/') + '/'
+        new_prefix = new_public_dir.rstrip('/') + '/' if new_public_dir else ''
+        for key in [k for k in self.__entries if k.startswith(prefix)]:
+            new_key = new_prefix + key[len(prefix):]
+            self.__entries[new_key] = self.__entries.pop(key)
+            if key in self.__seen:
+                self.__seen.discard(key)
+                self.__seen.add(new_key)
+            self.__dirty = True
+
+    def save(self, prune: bool = False) -> None:
+        """
+        Write the cache to its sidecar file if it has changed.
+
+        Parameters
+        ----------
+        prune : bool
+            Drop entries that were not looked up or recorded since the cache
+            was loaded. Use after a walk over the entire source directory.
+
+        """
+        if prune:
+            stale = self.__entries.keys() - self.__seen
+            for key in stale:
+                del self.__entries[key]
+            self.__dirty = self.__dirty or bool(stale)
+
+        if not self.__dirty:
+            return
+
+        # Write to a temporary file and rename so that concurrent readers
+        # never see a partially written cache.
+        tmp_path = f'{self.__cache_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w') as cache_file:
+                json.dump({'version': CACHE_VERSION,
+                           'entries': self.__entries}, cache_file)
+            os.replace(tmp_path, self.__cache_path)
+        except OSError as error:
+            logger.warning('Unable to save type cache %s: %s',
+                           self.__cache_path, error)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.__dirty = False
@@ -4,249 +4,776 @@ Upload archive may contain other tarred/gzipped archives internally.
 
 """
 
-# TODO Compress - Need to implement uncompress for traditional Unix compress .Z files.
-#      Need to figure best way to shell/system out to system uncompress program since
-#      this is not supported directly in Python.
-
+import bz2
+import gzip
+import lzma
 import shutil
 import os.path
+import tempfile
+import zlib
+from base64 import b64encode
+from hashlib import md5
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, List, Optional, Set, Tuple
 
 import tarfile
 import zipfile
 
+from arxiv.base.globals import get_application_config
+
 from filemanager.arxiv.file import File
+from filemanager.utilities.lzw import LZWError, open_lzw
+from filemanager.utilities.upload_size import SizeLimitExceeded
 
 
 ERROR_MSG_PRE = 'There were problems unpacking "'
 ERROR_MSG_SUF = '" -- continuing. Please try again and confirm your files.'
 
+ARCHIVE_TYPES = ('tar', 'gzipped', 'bzip2', 'xz', 'zip', 'compressed')
+"""File types that :func:`unpack_file` may unpack."""
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# gzip.BadGzipFile is new in Python 3.8; earlier versions raise OSError.
+DECOMPRESSION_ERRORS = (EOFError, zlib.error,
+                        getattr(gzip, 'BadGzipFile', OSError), lzma.LZMAError)
+"""Errors raised when reading damaged gzip, bzip2 or xz content."""
+
+
+def _damaged_content(error: Exception) -> bool:
+    """
+    Tell errors in damaged compressed content from failures to read or write.
+
+    Before Python 3.8 :data:`DECOMPRESSION_ERRORS` includes :class:`OSError`,
+    which also catches errors such as a full disk. Those carry an errno,
+    while gzip format errors do not.
+    """
+    return not (isinstance(error, OSError) and error.errno is not None)
+
+_STREAM_DECOMPRESSORS = ((b'\x1f\x8b', gzip.open),
+                         (b'BZh', bz2.open),
+                         (b'\xfd7zXZ\x00', lzma.open))
+"""Magic numbers of compressed streams and the readers that decompress them."""
+
+FILE_MODE = 0o664
+"""Permissions of files unpacked into the source directory."""
+
+DIRECTORY_MODE = 0o775
+"""Permissions of directories unpacked into the source directory."""
+
+SPOOL_SIZE = 8 * 1024 * 1024
+"""Largest member held in memory while it is compared to an existing file."""
+
+DEFAULT_UNZIP_THREADS = min(4, os.cpu_count() or 1)
+"""Default number of threads decompressing the members of a zip archive."""
+
 # TODO Add logging so we are able to capture additional information during
 # debugging - for now deactivate
 DEBUG = 0
 
 
-def unpack_archive(upload: 'Upload') -> None:
+def _within(directory: str, path: str) -> bool:
+    """Whether the normalized ``path`` is ``directory`` or inside it."""
+    return os.path.commonpath([directory, path]) == directory
+
+
+def check_directory(upload: 'Upload', obj: File) -> bool:
+    """
+    Handle special directories found while unpacking.
+
+    Parameters
+    ----------
+    upload : Upload
+        Upload object the directory belongs to.
+    obj : File
+        Directory in the upload source directory.
+
+    Returns
+    -------
+    bool
+        ``False`` if the directory has been removed, ``True`` otherwise.
+
+    """
+    if obj.name == '__MACOSX':
+        upload.add_warning(obj.public_filepath, "Removed '__MACOSX' directory.")
+        # Remove __MACOSX directory
+        if os.path.exists(obj.filepath):
+            shutil.rmtree(obj.filepath)
+        upload.manifest.discard_tree(obj.public_filepath)
+        return False
+    elif obj.name == 'processed':  # and from_paper_id
+        # TODO: Need to investigate what's going on here so we
+        # TODO: understand what needs to be done.
+        #
+        # Deletion of 'processed' directory depends on
+        # from_paper_id also being set.
+        #
+        # This appears to be related to replacing a submission
+        # where files are imported/copied from previous version of paper.
+        #
+        # Legacy action is to delete 'processed' directory when
+        # from_paper_id is set.
+        #
+        # We have not reached the point of implementing this yet so
+        # I will only issue a warning for now.
+        upload.add_warning(obj.public_filepath, "Detected 'processed' directory. Please check.")
+    return True
+
+
+def _with_parents(paths: List[str], top: str) -> List[str]:
+    """
+    Add the directories between ``top`` and each of ``paths``.
+
+    Archives need not contain entries for all of the directories their
+    members are in. Directories are listed before the files they contain.
+    """
+    seen: Set[str] = set()
+    result = []
+    for path in paths:
+        parent = os.path.dirname(path)
+        parents = []
+        while parent.startswith(top + os.sep) and parent not in seen:
+            parents.append(parent)
+            seen.add(parent)
+            parent = os.path.dirname(parent)
+        result.extend(reversed(parents))
+        if path != top and path not in seen:
+            seen.add(path)
+            result.append(path)
+    return result
+
+
+def _unlink(path: str) -> None:
+    """
+    Remove an existing file before it is replaced by an archive member.
+
+    Files may be hard linked from the removed directory, so they must be
+    replaced rather than overwritten.
+    """
+    if os.path.isfile(path) and not os.path.islink(path):
+        os.remove(path)
+
+
+def _make_directory(path: str) -> None:
+    """Create a directory and any missing parents, with :data:`DIRECTORY_MODE`."""
+    if os.path.isdir(path):
+        return
+    _make_directory(os.path.dirname(path))
+    os.mkdir(path)
+    os.chmod(path, DIRECTORY_MODE)  # Whatever the umask
+
+
+def _create_file(path: str) -> BinaryIO:
+    """Create a file to unpack a member into, with :data:`FILE_MODE`."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, FILE_MODE)
+    try:
+        os.fchmod(fd, FILE_MODE)  # Whatever the umask
+    except OSError:
+        os.close(fd)
+        raise
+    return os.fdopen(fd, 'wb')
+
+
+def _existing_checksum(upload: 'Upload', dest: str,
+                       size: int) -> Optional[str]:
+    """
+    Checksum of a file that an archive member of ``size`` bytes may leave
+    unchanged.
+
+    Only files that were checked and have not changed since, according to
+    the manifest, are considered.
+
+    Returns
+    -------
+    str
+        Checksum of the file (as in the manifest), or ``None`` if the member
+        has to be written anyway.
+
+    """
+    if not os.path.isfile(dest) or os.path.islink(dest):
+        return None
+    obj = File(dest, upload.get_source_directory(), upload.type_cache)
+    entry = upload.manifest.checked(obj)
+    if entry is None or entry['size'] != size:
+        return None
+    return upload.manifest.checksum(obj)
+
+
+def _write_member(source: BinaryIO, dest: str,
+                  checksum: Optional[str] = None) -> bool:
+    """
+    Write an archive member to ``dest``.
+
+    If ``checksum`` is given, the member replaces the file at ``dest`` only
+    if its content is different, so that a file re-uploaded unchanged keeps
+    its modification time (and so its earlier check results). The member is
+    held in memory (or a temporary file, if large) until its checksum is
+    known.
+
+    Parameters
+    ----------
+    source : file-like
+        Member content.
+    dest : str
+        Path the member is unpacked to.
+    checksum : str
+        b64-encoded MD5 hash of the existing file at ``dest`` (see
+        :func:`_existing_checksum`).
+
+    Returns
+    -------
+    bool
+        ``False`` if the existing file was left in place.
+
+    """
+    if checksum is None:
+        _unlink(dest)
+        with _create_file(dest) as target:
+            shutil.copyfileobj(source, target)
+        return True
+
+    hash_md5 = md5()
+    with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as spool:
+        for chunk in iter(lambda: source.read(COPY_CHUNK_SIZE), b''):
+            hash_md5.update(chunk)
+            spool.write(chunk)
+        if b64encode(hash_md5.digest()).decode('utf-8') == checksum:
+            return False
+        spool.seek(0)
+        _unlink(dest)
+        with _create_file(dest) as target:
+            shutil.copyfileobj(spool, target, COPY_CHUNK_SIZE)
+    return True
+
+
+def _extract_tar(upload: 'Upload', tar: tarfile.TarFile,
+                 public_filepath: str, target_directory: str) -> List[str]:
     """
-    Uppack specified archive and recursively traverse the source directory
-    and unpack any additional gzipped/tar archives contained within original
-    archive.
+    Extract the files and directories in an open tar archive.
+
+    Other kinds of members are not allowed, and are reported as warnings
+    against the archive. Extraction stops with an error as soon as a member
+    would exceed the size limits of the upload.
+
+    Files and directories are created with their final permissions, and
+    keep their creation time rather than the times stored in the archive.
+    Files that the archive leaves unchanged are not written at all.
 
     Parameters
     ----------
     upload : Upload
-        Upload object with files to be unpacks.
+        Upload object the archive belongs to.
+    tar : :class:`tarfile.TarFile`
+        Open archive, which may be read as a stream.
+    public_filepath : str
+        Public path of the archive, for warnings.
+    target_directory : str
+        Directory to extract members into.
 
     Returns
     -------
-    None
+    list
+        Paths of the files and directories extracted.
 
-    Notes
-    -----
-    Originates from Upload.pm (Perl).
     """
+    source_directory = upload.get_source_directory()
+    extracted = []
+
+    try:
+        for tarinfo in tar:
+            # print("Tar name: " + tarinfo.name() + '\n')
+            # print("**" + tarinfo.name, "is", tarinfo.size,
+            #     "bytes in size and is", end="")
+
+            # TODO: Need to think about this a little more.
+            # Don't really want to flatten directory structure,
+            # but not sure we can just secure basename.
+            # secure = secure_filename(tarinfo.name)
+            # if (secure != tarinfo.name):
+            #    print("\nFile name not secure: " + tarinfo.name
+            #        + ' (' + secure + ')\n')
+
+            # if tarinfo.name.startswith('.'):
+            # These get handled in checks and logged.
+
+            # Extract files and directories for now
+            dest = os.path.normpath(os.path.join(target_directory,
+                                                 tarinfo.name))
+            # Tarfiles may contain relative paths! We must
+            # ensure that each file is not going to escape the
+            # upload source directory _before_ we extract it.
+            if not _within(source_directory, dest):
+                continue
+
+            if tarinfo.isreg() or tarinfo.isdir():
+                upload.unpack_budget.add_member(tarinfo.name, tarinfo.size
+                                                if tarinfo.isreg() else 0)
+
+            if tarinfo.isreg():
+                # log this? ("Reg File")
+                _make_directory(os.path.dirname(dest))
+                checksum = _existing_checksum(upload, dest, tarinfo.size)
+                source = tar.extractfile(tarinfo)
+                if source is None:
+                    upload.add_warning(public_filepath, "Unable to read '"
+                                       + tarinfo.name + "'. Skipping.")
+                    continue
+                with source:
+                    _write_member(source, dest, checksum)
+                extracted.append(dest)
+            elif tarinfo.isdir():
+                # log this? ("Dir")
+                _make_directory(dest)
+                extracted.append(dest)
+            else:
+                # Warn about entities we don't want to see in
+                # upload archives
+                # We did not check carefully in legacy system
+                # and hard links caused bad things to happen.
+                if tarinfo.issym():  # sym link
+                    upload.add_warning(public_filepath, "Symbolic links are not allowed. Removing '"
+                                       + tarinfo.name + "'.")
+                elif tarinfo.islnk():  # hard link
+                    upload.add_warning(public_filepath, 'Hard links are not allowed. Removing ')
+                elif tarinfo.ischr():
+                    upload.add_warning(public_filepath, 'Character devices are not allowed. Removing ')
+                elif tarinfo.isblk():
+                    upload.add_warning(public_filepath, 'Block devices are not allowed. Removing ')
+                elif tarinfo.isfifo():
+                    upload.add_warning(public_filepath, 'FIFO are not allowed. Removing ')
+                elif tarinfo.isdev():
+                    upload.add_warning(public_filepath, 'Character devices are '
+                                       + 'not allowed. Removing ')
+
+    except tarfile.TarError as error:
+        # TODO: Do something with as error, post to error log
+        # print("Error processing tar file failed!\n")
+        upload.add_warning(public_filepath, ERROR_MSG_PRE + public_filepath + ERROR_MSG_SUF)
+        upload.add_warning(public_filepath, 'Tar error message: ' + error.__str__())
+    except LZWError as error:
+        upload.add_warning(public_filepath, ERROR_MSG_PRE + public_filepath + ERROR_MSG_SUF)
+        upload.add_warning(public_filepath, 'Uncompress error message: ' + error.__str__())
+    except DECOMPRESSION_ERRORS as error:
+        if not _damaged_content(error):
+            raise
+        upload.add_warning(public_filepath, ERROR_MSG_PRE + public_filepath + ERROR_MSG_SUF)
+        upload.add_warning(public_filepath, 'Decompression error message: ' + error.__str__())
+    except SizeLimitExceeded as error:
+        _size_limit_exceeded(upload, public_filepath, error)
+    finally:
+        tar.close()
+    return extracted
+
+
+def _unzip_threads() -> int:
+    """Number of threads used to extract zip archive members."""
+    threads = get_application_config().get('UNZIP_THREADS',
+                                           DEFAULT_UNZIP_THREADS)
+    return max(1, int(threads))
+
+
+def _zip_member_path(info: zipfile.ZipInfo, target_directory: str) -> str:
+    """Path a zip member is extracted to, as by :meth:`ZipFile.extract`."""
+    # Same sanitizing as zipfile: drop empty, '.' and '..' components
+    parts = [part for part in info.filename.split('/')
+             if part not in ('', os.path.curdir, os.path.pardir)]
+    return os.path.normpath(os.path.join(target_directory, *parts))
+
+
+def _extract_zip_member(zip_ref: zipfile.ZipFile, info: zipfile.ZipInfo,
+                        dest: str, checksum: Optional[str]) -> None:
+    """Decompress a zip member to ``dest`` (run in a worker thread)."""
+    # New members are copied as by ZipFile.extract, so damaged members are
+    # left in the same partially written state
+    with zip_ref.open(info) as source:
+        _write_member(source, dest, checksum)
+
+
+def _extract_zip(upload: 'Upload', zip_ref: zipfile.ZipFile,
+                 public_filepath: str, target_directory: str,
+                 extracted: List[str]) -> None:
+    """
+    Extract the files and directories in an open zip archive.
+
+    Members are checked against the upload source directory and the size
+    limits of the upload one at a time, in archive order, and directories
+    are created. The files are then decompressed by a pool of threads (zlib
+    releases the GIL while inflating), each reading its member through the
+    shared archive. Files that the archive leaves unchanged are not written
+    (see :func:`_write_member`), and only the last of several members with
+    the same path is extracted.
 
-    #archive_name = os.path.basename(archive_path)
-    # TODO debug logging ("*******Process upload: " + archive_name + '*****************')
+    Parameters
+    ----------
+    upload : Upload
+        Upload object the archive belongs to.
+    zip_ref : :class:`zipfile.ZipFile`
+        Open archive.
+    public_filepath : str
+        Public path of the archive, for warnings.
+    target_directory : str
+        Directory to extract members into.
+    extracted : list
+        Paths of the files and directories extracted are appended to this
+        list, including files left partially written by a damaged member.
+
+    Raises
+    ------
+    :class:`zipfile.BadZipFile`
+        If a member is damaged. The other members are still extracted.
 
+    """
     source_directory = upload.get_source_directory()
+    # Members to extract by path, in archive order
+    members: Dict[str, Tuple[zipfile.ZipInfo, str, Optional[str]]] = {}
+
+    for info in zip_ref.infolist():
+        dest = _zip_member_path(info, target_directory)
+        # As for tar archives, make sure that no member escapes the
+        # upload source directory _before_ it is extracted.
+        if not _within(source_directory, dest) or dest == target_directory:
+            continue
+        try:
+            upload.unpack_budget.add_member(info.filename,
+                                            0 if info.is_dir()
+                                            else info.file_size)
+        except SizeLimitExceeded as error:
+            _size_limit_exceeded(upload, public_filepath, error)
+            break
+        if info.is_dir():
+            _make_directory(dest)
+            extracted.append(dest)
+        else:
+            _make_directory(os.path.dirname(dest))
+            members.pop(dest, None)
+            members[dest] = (info, dest, _existing_checksum(upload, dest,
+                                                            info.file_size))
+
+    if len(members) > 1 and _unzip_threads() > 1:
+        with ThreadPoolExecutor(max_workers=_unzip_threads()) as executor:
+            futures = [executor.submit(_extract_zip_member, zip_ref, *member)
+                       for member in members.values()]
+        errors = [future.exception() for future in futures]
+    else:
+        errors = []
+        for member in members.values():
+            try:
+                _extract_zip_member(zip_ref, *member)
+            except Exception as error:  # Re-raised below, in order
+                errors.append(error)
+            else:
+                errors.append(None)
+
+    for dest in members:
+        # A damaged member may be left partially written
+        if os.path.lexists(dest):
+            extracted.append(dest)
+    for error in errors:
+        if error is not None:
+            raise error
+
+
+def _size_limit_exceeded(upload: 'Upload', public_filepath: str,
+                         error: SizeLimitExceeded) -> None:
+    """Report that unpacking an archive was stopped."""
+    upload.log(f'Stopped unpacking {public_filepath}: {error.message}')
+    upload.add_error(public_filepath, error.message)
+
+
+class _TeeReader:
+    """Read from a stream, writing everything read to a copy."""
+
+    def __init__(self, stream: BinaryIO, copy: Optional[BinaryIO]) -> None:
+        self.__stream = stream
+        self.__copy = copy
+        self.__peeked = b''
+
+    def _read(self, size: int) -> bytes:
+        data = self.__stream.read(size)
+        if self.__copy is not None:
+            self.__copy.write(data)
+        return data
+
+    def peek(self, size: int) -> bytes:
+        """Return up to ``size`` bytes without consuming them."""
+        if len(self.__peeked) < size:
+            self.__peeked += self._read(size - len(self.__peeked))
+        return self.__peeked[:size]
+
+    def read(self, size: int = -1) -> bytes:
+        if not self.__peeked:
+            return self._read(size)
+        if size < 0:
+            data = self.__peeked + self._read(-1)
+            self.__peeked = b''
+        else:
+            data = self.__peeked[:size]
+            self.__peeked = self.__peeked[size:]
+        return data
+
+
+def _decompressed(reader: _TeeReader) -> BinaryIO:
+    """
+    Decompress a gzip, bzip2 or xz stream; pass anything else through.
+
+    Unlike the stream mode of :mod:`tarfile`, these readers carry on past
+    the end of the first compressed member, so that content compressed as
+    several concatenated members (by parallel compressors, for instance) is
+    read in full.
+    """
+    magic = reader.peek(6)
+    for prefix, decompressor in _STREAM_DECOMPRESSORS:
+        if magic.startswith(prefix):
+            return decompressor(reader)
+    return reader
+
+
+def unpack_stream(upload: 'Upload', stream: BinaryIO, public_filepath: str,
+                  target_directory: str,
+                  copy: Optional[BinaryIO] = None) -> List[str]:
+    """
+    Unpack a tar archive (optionally compressed) as it is read from a stream.
+
+    Members are extracted straight to their final location, so the archive
+    itself is never written to the source directory.
+
+    Parameters
+    ----------
+    upload : Upload
+        Upload object the archive belongs to.
+    stream : file-like
+        Stream positioned at the start of the archive.
+    public_filepath : str
+        Public path the archive would have, for warnings.
+    target_directory : str
+        Directory to extract members into.
+    copy : file-like
+        If given, the entire stream is copied here, e.g. to retain the
+        archive in the removed directory.
+
+    Returns
+    -------
+    list
+        Paths of the files and directories extracted from the archive
+        (directories before their contents).
+
+    """
+    reader = _TeeReader(stream, copy)
+    extracted = []
+    try:
+        tar = tarfile.open(fileobj=_decompressed(reader), mode='r|')
+    except DECOMPRESSION_ERRORS + (tarfile.TarError,) as error:
+        if not _damaged_content(error):
+            raise
+        upload.add_warning(public_filepath, "There were problems opening file '"
+                           + public_filepath + "'")
+        upload.add_warning(public_filepath, 'Tar error message: ' + error.__str__())
+    else:
+        extracted = _extract_tar(upload, tar, public_filepath,
+                                 target_directory)
+
+    if copy is not None:
+        # The copy includes anything following the end of the archive
+        while reader.read(COPY_CHUNK_SIZE):
+            pass
+
+    return _with_parents(extracted, target_directory)
+
+
+def _remove_archive(upload: 'Upload', path: str) -> None:
+    """Move an unpacked archive out of the way to the removed directory."""
     removed_directory = upload.get_removed_directory()
+    file = os.path.basename(path)
+    rfile = os.path.join(removed_directory, file)
+
+    # Maybe can't do this in production if submitter reloads tar.gz
+    if os.path.exists(rfile) and (os.path.getsize(rfile) == os.path.getsize(path)):
+        print("File (same size) saved already! Remove tar file")
+        msg = f"Removed packed file {file}"
+        upload.log(msg)
+        os.remove(path)
+    else:
+        msg = f"Removed packed file {file}"
+        upload.log(msg)
+        # Now move tar file out of way to removed directory
+        shutil.move(path, rfile)
+
+
+def _uncompress(upload: 'Upload', obj: File, stream: BinaryIO,
+                target_directory: str) -> List[str]:
+    """
+    Write the content of a compressed file that is not a tar archive.
 
-    # Recursively scan source directory and uplack all archives until there
-    # are no more gzipped/tar archives.
-    packed_file = 1
-    round = 1
-    while packed_file:
-        # TODO debug logging ("\n*****ROUND " + str(round) + '  Packed: '
-        # + str(packed_file) + '*****\n')
-
-        for root_directory, subdirs, files in os.walk(source_directory):
-            # TODO debug logging (f"---> Dir {root_directory} contains the
-            # directories {b} and the files {c}")
-            # ignoring directories using '_' above
-
-            for dir in subdirs:
-                # create path
-                path = os.path.join(root_directory, dir)
-
-                # wrap in our File encapsulation class
-                obj = File(path, source_directory)
-
-                if obj.name == '__MACOSX':
-                    upload.add_warning(obj.public_filepath, "Removed '__MACOSX' directory.")
-                    # Remove __MACOSX directory
-                    if os.path.exists(path):
-                        shutil.rmtree(path)
-                    # Remove deleted directory from os.walk
-                    subdirs.remove(dir)
-                elif obj.name == 'processed':  # and from_paper_id
-                    # TODO: Need to investigate what's going on here so we
-                    # TODO: understand what needs to be done.
-                    #
-                    # Deletion of 'processed' directory depends on
-                    # from_paper_id also being set.
-                    #
-                    # This appears to be related to replacing a submission
-                    # where files are imported/copied from previous version of paper.
-                    #
-                    # Legacy action is to delete 'processed' directory when
-                    # from_paper_id is set.
-                    #
-                    # We have not reached the point of implementing this yet so
-                    # I will only issue a warning for now.
-                    upload.add_warning(obj.public_filepath, "Detected 'processed' directory. Please check.")
-
-            for file in files:
-
-                # os.walk provides a list of files with the root directory so
-                # we need to build path at each step
-                path = os.path.join(root_directory, file)
-
-                # wrap in our File encapsulation class
-                obj = File(path, source_directory)
-
-                # TODO log something to source log
-                # print("File is : " + file + " Size: " + str(obj.size)
-                # + " File is type: " + obj.type + ":" + obj.type_string + '\n')
-
-                # Tar module is supposed to handle bz2 compressed files (gzip too)
-                if ((obj.type == 'tar' or obj.type == 'gzipped')
-                        and tarfile.is_tarfile(path)) or obj.type == 'bzip2':
-                    # TODO debug logging ("**Found tar  or bzip2 file!**\n")
-
-                    target_directory = os.path.join(source_directory, root_directory)
-
-                    msg = f"***** unpack {obj.type} {file} to dir: {target_directory}"
-                    upload.log(msg)
-
-                    try:
-                        tar = tarfile.open(path)
-                    except tarfile.TarError as error:
-                        # Do something better with as error
-                        upload.add_warning(obj.public_filepath, "There were problems opening file '"
-                                           + obj.public_filepath + "'")
-                        upload.add_warning(obj.public_filepath, 'Tar error message: ' + error.__str__())
-
-                    try:
-                        for tarinfo in tar:
-                            # print("Tar name: " + tarinfo.name() + '\n')
-                            # print("**" + tarinfo.name, "is", tarinfo.size,
-                            #     "bytes in size and is", end="")
-
-                            # TODO: Need to think about this a little more.
-                            # Don't really want to flatten directory structure,
-                            # but not sure we can just secure basename.
-                            # secure = secure_filename(tarinfo.name)
-                            # if (secure != tarinfo.name):
-                            #    print("\nFile name not secure: " + tarinfo.name
-                            #        + ' (' + secure + ')\n')
-
-                            # if tarinfo.name.startswith('.'):
-                            # These get handled in checks and logged.
-
-                            # Extract files and directories for now
-                            dest = os.path.join(target_directory, tarinfo.name)
-                            # Tarfiles may contain relative paths! We must
-                            # ensure that each file is not going to escape the
-                            # upload source directory _before_ we extract it.
-                            if source_directory not in os.path.normpath(dest):
-                                continue
-
-                            if tarinfo.isreg():
-                                # log this? ("Reg File")
-                                tar.extract(tarinfo, target_directory)
-                                # Update access and modified times to now.
-
-                                os.utime(dest)
-                            elif tarinfo.isdir():
-                                # log this? ("Dir")
-                                tar.extract(tarinfo, target_directory)
-                                os.utime(dest)
-                            else:
-                                # Warn about entities we don't want to see in
-                                # upload archives
-                                # We did not check carefully in legacy system
-                                # and hard links caused bad things to happen.
-                                if tarinfo.issym():  # sym link
-                                    upload.add_warning(obj.public_filepath, "Symbolic links are not allowed. Removing '"
-                                                       + tarinfo.name + "'.")
-                                elif tarinfo.islnk():  # hard link
-                                    upload.add_warning(obj.public_filepath, 'Hard links are not allowed. Removing ')
-                                elif tarinfo.ischr():
-                                    upload.add_warning(obj.public_filepath, 'Character devices are not allowed. Removing ')
-                                elif tarinfo.isblk():
-                                    upload.add_warning(obj.public_filepath, 'Block devices are not allowed. Removing ')
-                                elif tarinfo.isfifo():
-                                    upload.add_warning(obj.public_filepath, 'FIFO are not allowed. Removing ')
-                                elif tarinfo.isdev():
-                                    upload.add_warning(obj.public_filepath, 'Character devices are '
-                                                       + 'not allowed. Removing ')
-                        tar.close()
-
-                    except tarfile.TarError as error:
-                        # TODO: Do something with as error, post to error log
-                        # print("Error processing tar file failed!\n")
-                        upload.add_warning(obj.public_filepath, ERROR_MSG_PRE + obj.public_filepath + ERROR_MSG_SUF)
-                        upload.add_warning(obj.public_filepath, 'Tar error message: ' + error.__str__())
-
-                    # Move gzipped file out of way
-                    rfile = os.path.join(removed_directory, os.path.basename(path))
-
-                    # Maybe can't do this in production if submitter reloads tar.gz
-                    if os.path.exists(rfile) and (os.path.getsize(rfile) == os.path.getsize(path)):
-                        print("File (same size) saved already! Remove tar file")
-                        msg = f"Removed packed file {file}"
-                        upload.log(msg)
-                        os.remove(path)
-                    else:
-                        rem_path = os.path.join(removed_directory, os.path.basename(path))
-                        msg = f"Removed packed file {file}"
-                        upload.log(msg)
-                        # Now move tar file out of way to removed directory
-                        shutil.move(path, rem_path)
-                    # Since we are unpacking something we want to make one more pass over files.
-                    packed_file += 1
-                elif obj.type == 'tar' and not tarfile.is_tarfile(path):
-                    print("Package 'tarfile' unable to read this tar file.")
-                    # TODO Throw an error
-
-                # Hanlde .zip files
-                elif obj.type == 'zip' and zipfile.is_zipfile(path):
-                    target_directory = os.path.join(source_directory, root_directory)
-                    print("*******Process zip archive: " + path)
-                    msg = f"***** unpack {obj.type} {file} to dir: {target_directory}"
-                    upload.log(msg)
-                    try:
-                        with zipfile.ZipFile(path, "r") as zip_ref:
-                            zip_ref.extractall(target_directory)
-                            # Now move zip file out of way to removed directory
-                            rem_path = os.path.join(removed_directory, os.path.basename(path))
-                            msg = f"Removed packed file {file}"
-                            upload.log(msg)
-                            shutil.move(path, rem_path)
-                            # Since we are unpacking something we want to make
-                            # one more pass over files.
-                            packed_file += 1
-                    except zipfile.BadZipFile as error:
-                        # TODO: Think about warnings a bit. Tar/zip problems
-                        # currently reported as warnings. Upload warnings allow
-                        # submitter to continue on to process/compile step.
-                        upload.add_warning(obj.public_filepath, ERROR_MSG_PRE + obj.public_filepath + ERROR_MSG_SUF)
-                        upload.add_warning(obj.public_filepath, 'Zip error message: ' + error.__str__())
-
-                # TODO: Add support for compressed files
-                elif obj.type == 'compressed':
-                    print("We can't uncompress .Z files yet.")
-                    msg = f"***** unpack {obj.type} {file} to dir: {source_directory}"
-                    upload.log(msg)
-                    msg = "Unable to uncompress .Z file. Not implemented yet"
-                    upload.log(msg)
-
-                # TODO: Handle 'processed' and __MACOSX directories (removal of/deletion)
-
-                # TODO: Handle encrypted files - need to investigate Crypt and how we are using it.
-
-        round += 1
-        packed_file -= 1
-
-    # Set permissions on all directories and files
-    upload.set_file_permissions()
+    The content is named after the compressed file, without its ``.Z``,
+    ``.xz`` or ``.lzma`` extension (or with an ``.uncompressed`` extension
+    if it has none).
+
+    Returns
+    -------
+    list
+        Path of the uncompressed file, or nothing if unpacking was stopped.
+
+    """
+    name = obj.name
+    if name.endswith(('.Z', '.z')):
+        name = name[:-2]
+    elif name.endswith(('.xz', '.XZ')):
+        name = name[:-3]
+    elif name.endswith('.lzma'):
+        name = name[:-5]
+    elif name.endswith(('.taz', '.txz')):
+        name = name[:-4] + '.tar'
+    else:
+        name = name + '.uncompressed'
+    dest = os.path.join(target_directory, name)
+
+    fd, tmp_path = tempfile.mkstemp(dir=target_directory)
+    size = 0
+    try:
+        os.fchmod(fd, FILE_MODE)
+        with os.fdopen(fd, 'wb') as uncompressed:
+            upload.unpack_budget.add_member(name, 0)
+            for chunk in iter(lambda: stream.read(COPY_CHUNK_SIZE), b''):
+                size += len(chunk)
+                upload.unpack_budget.add_data(name, len(chunk), size)
+                uncompressed.write(chunk)
+    except SizeLimitExceeded as error:
+        os.remove(tmp_path)
+        _size_limit_exceeded(upload, obj.public_filepath, error)
+        return []
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    os.replace(tmp_path, dest)
+    return [os.path.normpath(dest)]
+
+
+def unpack_file(upload: 'Upload', obj: File) -> List[str]:
+    """
+    Unpack a single file if it is an archive.
+
+    Once unpacked, the archive is moved out of the way to the removed
+    directory. Damaged archives stay in place, but may have been partially
+    unpacked.
+
+    Parameters
+    ----------
+    upload : Upload
+        Upload object the file belongs to.
+    obj : File
+        File in the upload source directory.
+
+    Returns
+    -------
+    list
+        Paths of the files and directories extracted from the archive
+        (directories before their contents). Empty if nothing was extracted.
+
+    """
+    source_directory = upload.get_source_directory()
+    removed_directory = upload.get_removed_directory()
+    path = obj.filepath
+    file = obj.name
+    root_directory = os.path.dirname(path)
+    target_directory = os.path.join(source_directory, root_directory)
+    extracted = []
+
+    # TODO log something to source log
+    # print("File is : " + file + " Size: " + str(obj.size)
+    # + " File is type: " + obj.type + ":" + obj.type_string + '\n')
+
+    # Tar module is supposed to handle bz2 compressed files (gzip and xz too)
+    if ((obj.type == 'tar' or obj.type == 'gzipped' or obj.type == 'xz')
+            and tarfile.is_tarfile(path)) or obj.type == 'bzip2':
+        # TODO debug logging ("**Found tar  or bzip2 file!**\n")
+
+        msg = f"***** unpack {obj.type} {file} to dir: {target_directory}"
+        upload.log(msg)
+
+        try:
+            tar = tarfile.open(path)
+        except tarfile.TarError as error:
+            # Do something better with as error
+            upload.add_warning(obj.public_filepath, "There were problems opening file '"
+                               + obj.public_filepath + "'")
+            upload.add_warning(obj.public_filepath, 'Tar error message: ' + error.__str__())
+        else:
+            extracted = _extract_tar(upload, tar, obj.public_filepath,
+                                     target_directory)
+
+        # Move gzipped file out of way
+        _remove_archive(upload, path)
+    elif obj.type == 'tar' and not tarfile.is_tarfile(path):
+        print("Package 'tarfile' unable to read this tar file.")
+        # TODO Throw an error
+
+    # Hanlde .zip files
+    elif obj.type == 'zip' and zipfile.is_zipfile(path):
+        print("*******Process zip archive: " + path)
+        msg = f"***** unpack {obj.type} {file} to dir: {target_directory}"
+        upload.log(msg)
+        try:
+            with zipfile.ZipFile(path, "r") as zip_ref:
+                _extract_zip(upload, zip_ref, obj.public_filepath,
+                             target_directory, extracted)
+                # Now move zip file out of way to removed directory
+                rem_path = os.path.join(removed_directory, os.path.basename(path))
+                msg = f"Removed packed file {file}"
+                upload.log(msg)
+                shutil.move(path, rem_path)
+        except zipfile.BadZipFile as error:
+            # TODO: Think about warnings a bit. Tar/zip problems
+            # currently reported as warnings. Upload warnings allow
+            # submitter to continue on to process/compile step.
+            upload.add_warning(obj.public_filepath, ERROR_MSG_PRE + obj.public_filepath + ERROR_MSG_SUF)
+            upload.add_warning(obj.public_filepath, 'Zip error message: ' + error.__str__())
+
+    # Handle .Z files (Unix compress)
+    elif obj.type == 'compressed':
+        msg = f"***** unpack {obj.type} {file} to dir: {target_directory}"
+        upload.log(msg)
+        try:
+            with open(path, 'rb') as compressed:
+                stream = open_lzw(compressed)
+                if stream.peek(tarfile.BLOCKSIZE)[257:262] == b'ustar':
+                    # Compressed tar archive (.tar.Z)
+                    tar = tarfile.open(fileobj=stream, mode='r|')
+                    extracted = _extract_tar(upload, tar, obj.public_filepath,
+                                             target_directory)
+                else:
+                    extracted = _uncompress(upload, obj, stream,
+                                            target_directory)
+        except (LZWError, tarfile.TarError) as error:
+            upload.add_warning(obj.public_filepath, ERROR_MSG_PRE + obj.public_filepath + ERROR_MSG_SUF)
+            upload.add_warning(obj.public_filepath, 'Uncompress error message: ' + error.__str__())
+        else:
+            _remove_archive(upload, path)
+
+    # Handle .xz files that are not tar archives
+    elif obj.type == 'xz':
+        msg = f"***** unpack {obj.type} {file} to dir: {target_directory}"
+        upload.log(msg)
+        try:
+            with lzma.open(path) as stream:
+                extracted = _uncompress(upload, obj, stream, target_directory)
+        except DECOMPRESSION_ERRORS as error:
+            if not _damaged_content(error):
+                raise
+            upload.add_warning(obj.public_filepath, ERROR_MSG_PRE + obj.public_filepath + ERROR_MSG_SUF)
+            upload.add_warning(obj.public_filepath, 'Uncompress error message: ' + error.__str__())
+        else:
+            _remove_archive(upload, path)
+
+    # TODO: Handle 'processed' and __MACOSX directories (removal of/deletion)
+
+    # TODO: Handle encrypted files - need to investigate Crypt and how we are using it.
+
+    # Record file in workspace manifest (unpacked archives have
+    # been moved out of the source directory)
+    if os.path.exists(path):
+        upload.manifest.add(obj)
+    else:
+        upload.manifest.discard(obj.public_filepath)
+
+    return _with_parents(extracted, target_directory)
@@ -1,19 +1,165 @@
+"""Size limits for uploads and for the content unpacked from them.
 
-def check_upload_file_size_limit(path: str):
+Archives are checked member by member while they are unpacked (see
+:class:`UnpackBudget`), so that an archive that expands to an unreasonable
+size or number of files is stopped before it fills the workspace.
+"""
+
+import os
+from typing import Optional
+
+from arxiv.base.globals import get_application_config
+
+DEFAULT_MAX_UNPACKED_FILE_SIZE = 64 * 1024 * 1024
+"""Largest file (in bytes) that may be unpacked from an archive."""
+
+DEFAULT_MAX_UNPACKED_SIZE = 512 * 1024 * 1024
+"""Largest total size (in bytes) of the content unpacked from an upload."""
+
+DEFAULT_MAX_UNPACKED_MEMBERS = 10000
+"""Largest number of files and directories unpacked from an upload."""
+
+
+def _get_limit(key: str, default: int) -> int:
+    """Get a size limit from the application config (or environment)."""
+    return int(get_application_config().get(key, default))
+
+
+class SizeLimitExceeded(Exception):
+    """Unpacking an archive member would exceed a size limit."""
+
+    def __init__(self, member: str, limit: str, maximum: int) -> None:
+        """
+        Describe the limit that would be exceeded.
+
+        Parameters
+        ----------
+        member : str
+            Name of the archive member.
+        limit : str
+            One of ``'file_size'``, ``'total_size'`` or ``'members'``.
+        maximum : int
+            Value of the limit.
+
+        """
+        self.member = member
+        self.limit = limit
+        self.maximum = maximum
+        super().__init__(self.message)
+
+    @property
+    def message(self) -> str:
+        """User-friendly description of the problem."""
+        if self.limit == 'file_size':
+            return (f"'{self.member}' is larger than the maximum file size"
+                    f" of {self.maximum} bytes.")
+        if self.limit == 'total_size':
+            return (f"Unpacking '{self.member}' would exceed the maximum"
+                    f" total size of {self.maximum} bytes.")
+        return (f"Unpacking '{self.member}' would exceed the maximum number"
+                f" of {self.maximum} files.")
+
+
+class UnpackBudget:
+    """
+    Keep track of the content unpacked from an upload.
+
+    Limits default to the ``MAX_UNPACKED_FILE_SIZE``, ``MAX_UNPACKED_SIZE``
+    and ``MAX_UNPACKED_MEMBERS`` settings.
+    """
+
+    def __init__(self, max_file_size: Optional[int] = None,
+                 max_total_size: Optional[int] = None,
+                 max_members: Optional[int] = None) -> None:
+        if max_file_size is None:
+            max_file_size = _get_limit('MAX_UNPACKED_FILE_SIZE',
+                                       DEFAULT_MAX_UNPACKED_FILE_SIZE)
+        if max_total_size is None:
+            max_total_size = _get_limit('MAX_UNPACKED_SIZE',
+                                        DEFAULT_MAX_UNPACKED_SIZE)
+        if max_members is None:
+            max_members = _get_limit('MAX_UNPACKED_MEMBERS',
+                                     DEFAULT_MAX_UNPACKED_MEMBERS)
+        self.max_file_size = max_file_size
+        self.max_total_size = max_total_size
+        self.max_members = max_members
+        self.total_size = 0
+        self.members = 0
+
+    def add_member(self, member: str, size: int) -> None:
+        """
+        Account for an archive member before it is unpacked.
+
+        Parameters
+        ----------
+        member : str
+            Name of the member.
+        size : int
+            Uncompressed size of the member (0 for directories).
+
+        Raises
+        ------
+        :class:`SizeLimitExceeded`
+            If unpacking the member would exceed a limit. Nothing is
+            accounted for in that case.
+
+        """
+        if size > self.max_file_size:
+            raise SizeLimitExceeded(member, 'file_size', self.max_file_size)
+        if self.total_size + size > self.max_total_size:
+            raise SizeLimitExceeded(member, 'total_size', self.max_total_size)
+        if self.members + 1 > self.max_members:
+            raise SizeLimitExceeded(member, 'members', self.max_members)
+        self.total_size += size
+        self.members += 1
+
+    def add_data(self, member: str, size: int, member_size: int) -> None:
+        """
+        Account for data unpacked to a member whose size was not known.
+
+        Parameters
+        ----------
+        member : str
+            Name of the member, already accounted for by :meth:`add_member`.
+        size : int
+            Number of bytes about to be unpacked.
+        member_size : int
+            Size of the member including these bytes.
+
+        Raises
+        ------
+        :class:`SizeLimitExceeded`
+            If unpacking the data would exceed a limit.
+
+        """
+        if member_size > self.max_file_size:
+            raise SizeLimitExceeded(member, 'file_size', self.max_file_size)
+        if self.total_size + size > self.max_total_size:
+            raise SizeLimitExceeded(member, 'total_size', self.max_total_size)
+        self.total_size += size
+
+
+def check_upload_file_size_limit(path: str) -> bool:
     """Check that upload file size is within limit set for arXiv.
 
     This checks for upload archive files that are too large. These achives may
     be compressed."""
-    # TODO Implement upload file size limit
-    return True
+    config = get_application_config()
+    maximum = config.get('MAX_CONTENT_LENGTH')
+    return maximum is None or os.path.getsize(path) <= int(maximum)
 
 
-def check_individual_file_size_limit (path: str):
+def check_individual_file_size_limit(path: str) -> bool:
     """Make sure individual file size does not exceed limit set for arXiv"""
-    return True
+    return os.path.getsize(path) <= _get_limit('MAX_UNPACKED_FILE_SIZE',
+                                               DEFAULT_MAX_UNPACKED_FILE_SIZE)
+
 
-def check_aggregate_size_limit (upload_id: int):
+def check_aggregate_size_limit(upload_id: int) -> bool:
     """Make sure aggregate size of upload does not exceed limit set for arXiv.
 
     Add up size of all files included in upload and compare to maximum limit."""
-    return True
+    # Imported here since uploads use these limits while unpacking
+    from filemanager.process.upload import UploadView
+    return UploadView(upload_id).total_upload_size \
+        <= _get_limit('MAX_UNPACKED_SIZE', DEFAULT_MAX_UNPACKED_SIZE)
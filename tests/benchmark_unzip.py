@@ -0,0 +1,72 @@
+"""Compare serial and threaded extraction of a zip archive with many members.
+
+Run from the top of the repository::
+
+    python tests/benchmark_unzip.py [members] [member size in KiB]
+
+The archive mimics a submission with many deflated figures. Timings are for
+:func:`filemanager.utilities.unpack.unpack_file` with ``UNZIP_THREADS`` set to
+1 and to the number of CPUs.
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from unittest import mock
+
+from filemanager.arxiv.file import File
+from filemanager.process.upload import Upload
+from filemanager.utilities.unpack import unpack_file
+
+UPLOAD_ID = '9903.1999'
+
+
+def make_archive(path: str, members: int, size: int) -> None:
+    """Write a zip archive of ``members`` compressible files."""
+    rng = random.Random(0)
+    words = [bytes(rng.choices(b'abcdefghijklmnop', k=8)) for _ in range(512)]
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        for i in range(members):
+            data = b' '.join(rng.choices(words, k=size // 9 + 1))[:size]
+            zip_ref.writestr(f'figures/fig{i}.eps', data)
+
+
+def time_unpack(archive: str, threads: int) -> float:
+    """Unpack ``archive`` into a fresh workspace, returning elapsed seconds."""
+    upload = Upload(UPLOAD_ID)
+    shutil.rmtree(upload.get_upload_directory(), ignore_errors=True)
+    upload = Upload(UPLOAD_ID)
+    upload.create_upload_workspace()
+    path = os.path.join(upload.get_source_directory(), 'figures.zip')
+    shutil.copy(archive, path)
+    obj = File(path, upload.get_source_directory())
+
+    with mock.patch.dict(os.environ, {'UNZIP_THREADS': str(threads)}):
+        start = time.perf_counter()
+        unpack_file(upload, obj)
+        elapsed = time.perf_counter() - start
+    shutil.rmtree(upload.get_upload_directory())
+    return elapsed
+
+
+def main() -> None:
+    members = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    size = int(sys.argv[2]) * 1024 if len(sys.argv) > 2 else 256 * 1024
+    cpus = os.cpu_count() or 1
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        archive = os.path.join(tmp_dir, 'figures.zip')
+        make_archive(archive, members, size)
+        print(f'{members} members of {size // 1024} KiB,'
+              f' archive is {os.path.getsize(archive) // 1024} KiB')
+        for threads in sorted({1, cpus}):
+            best = min(time_unpack(archive, threads) for _ in range(3))
+            print(f'{threads:3d} thread(s): {best:.3f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 """Tests specifically focused on security vulnerabilities."""
 
+import io
 import os
+import tarfile
 from unittest import TestCase, mock
 from datetime import datetime
 import tempfile
@@ -33,3 +35,27 @@ class TestRelativePaths(TestCase):
         self.assertNotIn('ir.png', os.listdir(UPLOAD_BASE_DIRECTORY),
                          'File should be prevented from escaping upload'
                          ' workspace.')
+
+    @mock.patch(f'{upload.__name__}._get_base_directory')
+    def test_sibling_path(self, mock_get_base_dir):
+        """Uploaded tarball contains paths into siblings of the source directory."""
+        UPLOAD_BASE_DIRECTORY = tempfile.mkdtemp()
+        mock_get_base_dir.return_value = UPLOAD_BASE_DIRECTORY
+
+        content = io.BytesIO()
+        with tarfile.open(fileobj=content, mode='w:gz') as tar:
+            for name in ('../src2/x.tex', '../src_evil/x.tex', 'main.tex'):
+                info = tarfile.TarInfo(name)
+                info.size = 4
+                tar.addfile(info, io.BytesIO(b'% x\n'))
+        content.seek(0)
+
+        u = upload.Upload(12345)
+        u.process_upload(FileStorage(content, filename='sibling.tar.gz'))
+        workspace = u.get_upload_directory()
+        self.assertFalse(os.path.exists(os.path.join(workspace, 'src2')),
+                         'File should be prevented from escaping source'
+                         ' directory.')
+        self.assertFalse(os.path.exists(os.path.join(workspace, 'src_evil')))
+        self.assertTrue(os.path.exists(os.path.join(u.get_source_directory(),
+                                                    'main.tex')))
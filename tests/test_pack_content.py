@@ -1,6 +1,10 @@
 """Tests related to packing source content for download."""
 
+import gzip
+import io
 import os
+from base64 import b64encode
+from hashlib import md5
 from unittest import TestCase, mock
 from datetime import datetime
 import tempfile
@@ -11,6 +15,7 @@ from werkzeug.utils import secure_filename
 import shutil
 
 from filemanager.process import upload
+from filemanager.utilities import parallel_gzip
 
 TEST_FILES_DIRECTORY = os.path.join(os.getcwd(), 'tests/test_files_upload')
 
@@ -64,6 +69,18 @@ class TestPackContent(TestCase):
         checksum = self.upload.content_checksum()
         self.assertEqual(checksum, self.upload.content_checksum(),
                          'The checksum should remain the same.')
+        with open(self.upload.get_content_path(), 'rb') as content:
+            expected = b64encode(md5(content.read()).digest()).decode('utf-8')
+        self.assertEqual(checksum, expected, 'Checksum of the tarball')
+
+        # Computed while packing, and only read back if the cache is lost
+        self.assertTrue(os.path.exists(self.upload.get_content_checksum_path()))
+        with mock.patch(f'{upload.__name__}.md5') as mock_md5:
+            self.assertEqual(self.upload.content_checksum(), checksum)
+            mock_md5.assert_not_called()
+        os.remove(self.upload.get_content_checksum_path())
+        self.assertEqual(self.upload.content_checksum(), checksum)
+        self.assertTrue(os.path.exists(self.upload.get_content_checksum_path()))
 
 
     @mock.patch(f'{upload.__name__}._get_base_directory')
@@ -72,3 +89,87 @@ class TestPackContent(TestCase):
         mock_get_base_dir.return_value = self.base_directory
         pointer = self.upload.get_content()
         self.assertTrue(hasattr(pointer, 'read'), "Returns an IO")
+
+    @mock.patch(f'{upload.__name__}._get_base_directory')
+    def test_stream_content(self, mock_get_base_dir):
+        """Generate the tarball as it is read, caching its checksum."""
+        mock_get_base_dir.return_value = self.base_directory
+        with mock.patch.dict(os.environ, {'STREAM_CONTENT_PACKAGE': '1'}):
+            self.assertIsNone(self.upload.cached_content_checksum())
+            with self.upload.get_content() as pointer:
+                content = pointer.read()
+            self.assertFalse(self.upload.content_package_exists,
+                             'Content file is not written')
+
+            packed = tarfile.open(self.upload.pack_content())
+            streamed = tarfile.open(fileobj=io.BytesIO(content))
+            self.assertEqual([ti.get_info() for ti in streamed],
+                             [ti.get_info() for ti in packed],
+                             'Same members as the packed tarball')
+
+            with open(self.upload.get_content_path(), 'rb') as packed_content:
+                self.assertEqual(content, packed_content.read(),
+                                 'Streamed and packed tarballs are identical')
+
+            checksum = self.upload.cached_content_checksum()
+            self.assertEqual(checksum, pointer.checksum,
+                             'Checksum is cached once the tarball is read')
+            self.assertEqual(self.upload.content_checksum(), checksum)
+
+            # Checksum is generated again (identically) when out of date
+            os.remove(self.upload.get_content_checksum_path())
+            self.assertEqual(self.upload.content_checksum(), checksum)
+
+    @mock.patch(f'{upload.__name__}._get_base_directory')
+    def test_pack_content_from_cache(self, mock_get_base_dir):
+        """Only files changed since the last packing are compressed again."""
+        mock_get_base_dir.return_value = self.base_directory
+        with open(self.upload.pack_content(), 'rb') as content:
+            expected = gzip.decompress(content.read())
+
+        with mock.patch.dict(os.environ, {'CONTENT_PACKAGE_CACHE': '1'}):
+            with open(self.upload.pack_content(), 'rb') as content:
+                self.assertEqual(gzip.decompress(content.read()), expected,
+                                 'Same tar archive, in several gzip members')
+            cache_directory = self.upload.get_package_cache_directory()
+            cached = os.listdir(cache_directory)
+
+            path = os.path.join(self.upload.get_source_directory(),
+                                'upload5.pdf')
+            with open(path, 'ab') as edited:
+                edited.write(b'%% edited\n')
+            with mock.patch.object(parallel_gzip, 'compress',
+                                   wraps=parallel_gzip.compress) as compress:
+                content_path = self.upload.pack_content()
+            self.assertEqual(compress.call_count, 2,
+                             'Edited file and end of archive are compressed')
+            with tarfile.open(content_path) as tar:
+                member = tar.extractfile('upload5.pdf').read()
+            self.assertTrue(member.endswith(b'%% edited\n'))
+            self.assertEqual(len(os.listdir(cache_directory)), len(cached),
+                             'Member of the unedited file is removed')
+
+    @mock.patch(f'{upload.__name__}._get_base_directory')
+    def test_reproducible_content(self, mock_get_base_dir):
+        """Workspaces with the same files have the same reproducible tarball."""
+        mock_get_base_dir.return_value = self.base_directory
+        file_path = os.path.join(TEST_FILES_DIRECTORY, 'upload5.tar.gz')
+        with open(file_path, 'rb') as fp:
+            other = upload.Upload(self.upload_id + 1)
+            other.process_upload(FileStorage(fp))
+        for filename in os.listdir(other.get_source_directory()):
+            path = os.path.join(other.get_source_directory(), filename)
+            os.utime(path, (0, 12345678))
+            os.chmod(path, 0o600)
+        self.assertNotEqual(self.upload.content_checksum(),
+                            other.content_checksum())
+
+        with mock.patch.dict(os.environ, {'REPRODUCIBLE_CONTENT_PACKAGE': '1',
+                                          'SOURCE_DATE_EPOCH': '1546300800'}):
+            self.assertEqual(self.upload.content_checksum(),
+                             other.content_checksum())
+            with tarfile.open(other.get_content_path()) as tar:
+                for tarinfo in tar:
+                    self.assertEqual(tarinfo.mtime, 1546300800)
+                    self.assertEqual((tarinfo.uid, tarinfo.uname), (0, ''))
+                    self.assertIn(tarinfo.mode, (0o644, 0o755))
@@ -1,16 +1,25 @@
 """Tests for :mod:`zero.process.upload`."""
 
-from unittest import TestCase
+from unittest import TestCase, mock
 from datetime import datetime
 # from filemanager.domain import Upload
 from filemanager.process import upload
 from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
 
+import errno
+import gzip
+import io
+import lzma
 import os.path
 import shutil
+import tarfile
+import threading
+import zipfile
+import zlib
 
-from filemanager.process.upload import Upload
+from filemanager.process.upload import Upload, UploadView
+from filemanager.utilities import unpack
 
 UPLOAD_BASE_DIRECTORY = '/tmp/filemanagment/submissions'
 
@@ -115,6 +124,39 @@ class TestInternalSupportRoutines(TestCase):
         self.assertEqual(src_dir_exists, True, 'Create workspace source directory.')
         self.assertEqual(rem_dir_exists, True, 'Create workspace removed directory.')
 
+    def test_upload_view(self):
+        """A read-only view does not create or modify the workspace."""
+        view = upload.UploadView(12345683)
+        workspace_dir = view.get_upload_directory()
+        if os.path.exists(workspace_dir):
+            shutil.rmtree(workspace_dir)
+
+        view = upload.UploadView(12345683)
+        self.assertFalse(view.source_log_exists, 'No source log')
+        self.assertEqual(view.total_upload_size, 0, 'Empty workspace')
+        self.assertFalse(os.path.exists(workspace_dir),
+                         'Workspace directory was not created.')
+
+        # View an existing workspace
+        filename = os.path.join(TEST_FILES_DIRECTORY, 'upload5.pdf')
+        with open(filename, 'rb') as fp:
+            Upload(12345683).process_upload(FileStorage(fp))
+        view = upload.UploadView(12345683)
+        self.assertTrue(view.source_log_exists, 'Source log exists')
+        self.assertTrue(view.content_file_exists('upload5.pdf'))
+        self.assertEqual(view.content_file_size('upload5.pdf'),
+                         os.path.getsize(filename))
+        self.assertEqual(view.total_upload_size, os.path.getsize(filename))
+
+        # Checksums are calculated, but only saved by Upload
+        manifest_path = os.path.join(workspace_dir, Upload.MANIFEST_FILENAME)
+        saved = os.stat(manifest_path).st_mtime_ns
+        checksum = view.content_file_checksum('upload5.pdf')
+        self.assertEqual(os.stat(manifest_path).st_mtime_ns, saved,
+                         'View does not save the manifest')
+        self.assertEqual(Upload(12345683).content_file_checksum('upload5.pdf'),
+                         checksum)
+
     def test_deposit_upload(self):
         """Test upload file deposit into src directory."""
         tfilename = os.path.join(TEST_FILES_DIRECTORY, '1801.03879-1.tar.gz')
@@ -184,6 +226,504 @@ class TestUpload(TestCase):
         file_to_check = os.path.join(source_directory, 'b', 'c', 'c_level_file.txt')
         self.assertTrue(os.path.exists(file_to_check), 'Test file within subdirectory exists: \'c_level_file.txt\'')
 
+        # Each file is checked once, and no unpacked archive is listed
+        paths = [f.public_filepath for f in upload.get_files()]
+        self.assertEqual(len(paths), len(set(paths)), 'Files are listed once')
+        self.assertEqual(sorted(paths),
+                         sorted(f.public_filepath for f in upload.create_file_list()),
+                         'Checked files match the source directory')
+
+    def test_manifest(self) -> None:
+        """The workspace manifest tracks the files in the source directory."""
+        upload = Upload('9903.1015')
+
+        # For testing purposes, clean out existing workspace directory
+        workspace_dir = upload.create_upload_workspace()
+        if os.path.exists(workspace_dir):
+            shutil.rmtree(workspace_dir)
+
+        filename = os.path.join(TEST_FILES_DIRECTORY, 'upload2.tar.gz')
+        with open(filename, 'rb') as fp:
+            upload = Upload('9903.1015')
+            upload.process_upload(FileStorage(fp))
+
+        file_list = upload.create_file_list()
+        summary = upload.manifest.summary()
+        self.assertEqual([f['public_filepath'] for f in summary],
+                         sorted(f.public_filepath for f in file_list),
+                         'Manifest lists the files in the source directory')
+        self.assertEqual(upload.total_upload_size,
+                         sum(f.size for f in file_list),
+                         'Total size is calculated from the manifest')
+
+        # A new workspace object picks up the saved manifest
+        upload = Upload('9903.1015')
+        self.assertTrue(upload.manifest.loaded, 'Manifest was saved')
+        self.assertEqual(upload.manifest.summary(), summary)
+
+        removed = summary[0]
+        upload.client_remove_file(removed['public_filepath'])
+        upload = Upload('9903.1015')
+        self.assertIsNone(upload.manifest.entry(removed['public_filepath']),
+                          'Deleted file is no longer in manifest')
+        self.assertEqual(upload.total_upload_size,
+                         sum(f.size for f in file_list) - removed['size'])
+
+        # A view of a workspace without a saved manifest only stats the
+        # files, and does not build or save a manifest
+        manifest_path = os.path.join(upload.get_upload_directory(),
+                                     Upload.MANIFEST_FILENAME)
+        os.remove(manifest_path)
+        view = UploadView('9903.1015')
+        with mock.patch('filemanager.process.upload.File.from_dir_entry') as build:
+            self.assertEqual(view.total_upload_size,
+                             sum(f.size for f in file_list) - removed['size'])
+            last_modified = view.last_modified
+            build.assert_not_called()
+        self.assertFalse(view.manifest.loaded)
+        self.assertFalse(os.path.exists(manifest_path),
+                         'View does not save a manifest')
+        self.assertEqual(UploadView('9903.1015').last_modified, last_modified,
+                         'Modification time is stable')
+
+        # Upload rebuilds the manifest, with the same modification time
+        upload = Upload('9903.1015')
+        self.assertTrue(os.path.exists(manifest_path), 'Manifest is rebuilt')
+        view = UploadView('9903.1015')
+        self.assertTrue(view.manifest.loaded)
+        self.assertEqual(view.last_modified, last_modified)
+        self.assertEqual(view.manifest.summary(), upload.manifest.summary())
+
+        # A manifest that is out of date with the source directory (changed
+        # outside of Upload) is not used
+        with open(os.path.join(upload.get_source_directory(), 'extra.tex'), 'w') as extra:
+            extra.write('% Added behind our back\n')
+        view = UploadView('9903.1015')
+        self.assertFalse(view.manifest.loaded, 'Out of date manifest is not loaded')
+        self.assertEqual(view.total_upload_size, upload.total_upload_size + 24)
+        upload = Upload('9903.1015')
+        self.assertIsNotNone(upload.manifest.entry('extra.tex'), 'Manifest is rebuilt')
+        self.assertTrue(UploadView('9903.1015').manifest.loaded)
+
+    def test_workspace_lock(self) -> None:
+        """Requests that change a workspace run one at a time."""
+        upload = Upload('9903.1029')
+
+        # For testing purposes, clean out existing workspace directory
+        workspace_dir = upload.create_upload_workspace()
+        if os.path.exists(workspace_dir):
+            shutil.rmtree(workspace_dir)
+
+        filename = os.path.join(TEST_FILES_DIRECTORY, 'upload2.tar.gz')
+        with open(filename, 'rb') as fp:
+            upload = Upload('9903.1029')
+            upload.process_upload(FileStorage(fp))
+
+        removed = threading.Event()
+
+        def remove() -> None:
+            Upload('9903.1029').client_remove_file('main_a.tex')
+            removed.set()
+
+        with Upload('9903.1029').workspace_lock():
+            thread = threading.Thread(target=remove)
+            thread.start()
+            self.assertFalse(removed.wait(0.5), 'Request waits for the lock')
+        thread.join()
+        self.assertTrue(removed.is_set())
+        self.assertIsNone(Upload('9903.1029').manifest.entry('main_a.tex'))
+
+    def test_incremental_checks(self) -> None:
+        """Only files added by the latest upload are checked."""
+        upload = Upload('9903.1016')
+
+        # For testing purposes, clean out existing workspace directory
+        workspace_dir = upload.create_upload_workspace()
+        if os.path.exists(workspace_dir):
+            shutil.rmtree(workspace_dir)
+
+        filename = os.path.join(TEST_FILES_DIRECTORY, 'upload2.tar.gz')
+        with open(filename, 'rb') as fp:
+            upload = Upload('9903.1016')
+            upload.process_upload(FileStorage(fp))
+        first = sorted(f.public_filepath for f in upload.get_files()
+                       if not f.removed)
+
+        filename = os.path.join(TEST_FILES_DIRECTORY, 'upload5.pdf')
+        with open(filename, 'rb') as fp:
+            upload = Upload('9903.1016')
+            with mock.patch.object(Upload, 'check_file', autospec=True,
+                                   side_effect=Upload.check_file) as check:
+                upload.process_upload(FileStorage(fp))
+
+        checked = [call[0][1].public_filepath for call in check.call_args_list]
+        self.assertEqual(checked, ['upload5.pdf'], 'Only new file is checked')
+        self.assertEqual(sorted(f.public_filepath for f in upload.get_files()),
+                         sorted(first + ['upload5.pdf']),
+                         'Earlier files are still listed')
+
+    def test_single_file_upload(self) -> None:
+        """A single file is checked without visiting the rest of the workspace."""
+        upload = Upload('9903.1017')
+
+        # For testing purposes, clean out existing workspace directory
+        workspace_dir = upload.create_upload_workspace()
+        if os.path.exists(workspace_dir):
+            shutil.rmtree(workspace_dir)
+
+        filename = os.path.join(TEST_FILES_DIRECTORY, 'upload3.tar.gz')
+        with open(filename, 'rb') as fp:
+            upload = Upload('9903.1017')
+            upload.process_upload(FileStorage(fp))
+
+        filename = os.path.join(TEST_FILES_DIRECTORY, 'upload5.pdf')
+        with open(filename, 'rb') as fp:
+            upload = Upload('9903.1017')
+            with mock.patch('filemanager.process.upload._scan_tree') as scan:
+                upload.process_upload(FileStorage(fp))
+                scan.assert_not_called()
+        summary = upload.create_file_upload_summary()
+
+        file_list = Upload('9903.1017').create_file_list()
+        self.assertEqual(sorted(f['public_filepath'] for f in summary),
+                         sorted(f.public_filepath for f in file_list),
+                         'All files in the workspace are listed')
+        self.assertEqual(upload.total_upload_size,
+                         sum(f.size for f in file_list))
+
+    def test_fix_top_level_directory(self) -> None:
+        """Content of a single top-level directory is moved up a level."""
+        upload = Upload('9903.1018')
+
+        # For testing purposes, clean out existing workspace directory
+        workspace_dir = upload.create_upload_workspace()
+        if os.path.exists(workspace_dir):
+            shutil.rmtree(workspace_dir)
+
+        filename = os.path.join(TEST_FILES_DIRECTORY, 'upload7.tar.gz')
+        with open(filename, 'rb') as fp:
+            upload = Upload('9903.1018')
+            upload.process_upload(FileStorage(fp))
+        self.assertTrue(upload.search_warnings('Removing top level directory'))
+
+        # The saved manifest has the new paths
+        file_list = Upload('9903.1018').create_file_list()
+        self.assertEqual([f['public_filepath'] for f in Upload('9903.1018').manifest.summary()],
+                         sorted(f.public_filepath for f in file_list))
+
+        # Original directory is kept in removed directory
+        save_directory = os.path.join(upload.get_removed_directory(), 'move_source')
+        for file in file_list:
+            saved = os.path.join(save_directory, file.public_filepath)
+            self.assertTrue(os.path.samefile(saved, file.filepath),
+                            'Removed directory has a hard link to each file')
+
+    def test_unpack_archive(self) -> None:
+        """Nested archives are unpacked, including a damaged one."""
+        upload = Upload('9903.1019')
+
+        # For testing purposes, clean out existing workspace directory
+        workspace_dir = upload.create_upload_workspace()
+        if os.path.exists(workspace_dir):
+            shutil.rmtree(workspace_dir)
+
+        filename = os.path.join(TEST_FILES_DIRECTORY, 'upload-nested-zip-and-tar.zip')
+        with open(filename, 'rb') as fp:
+            upload = Upload('9903.1019')
+            upload.deposit_upload(FileStorage(fp))
+        upload.process_source_files()
+
+        source_directory = upload.get_source_directory()
+        self.assertTrue(os.path.exists(os.path.join(source_directory, 'dynamics1.eps')),
+                        'Member of nested tar archive is unpacked')
+        self.assertTrue(os.path.exists(os.path.join(source_directory, 'jz_vs_lambda.eps')),
+                        'Member of damaged zip archive is unpacked')
+        self.assertEqual(len(upload.get_warnings()), 2,
+                         'Damaged zip archive is reported once')
+
+    def test_stream_upload(self) -> None:
+        """A tar archive is unpacked as it is read from the upload."""
+        upload = Upload('9903.1020')
+
+        # For testing purposes, clean out existing workspace directory
+        workspace_dir = upload.create_upload_workspace()
+        if os.path.exists(workspace_dir):
+            shutil.rmtree(workspace_dir)
+
+        filename = os.path.join(TEST_FILES_DIRECTORY, 'upload2.tar.gz')
+        with open(filename, 'rb') as fp:
+            upload = Upload('9903.1020')
+            with mock.patch.object(Upload, 'deposit_upload') as deposit:
+                upload.process_upload(FileStorage(fp))
+                deposit.assert_not_called()
+
+        self.assertTrue(os.path.exists(os.path.join(upload.get_source_directory(), 'main_a.tex')))
+        self.assertFalse(os.path.exists(os.path.join(upload.get_source_directory(), 'upload2.tar.gz')))
+        retained = os.path.join(upload.get_removed_directory(), 'upload2.tar.gz')
+        self.assertEqual(os.path.getsize(retained), os.path.getsize(filename),
+                         'Archive is retained in removed directory')
+
+        # Archive need not be retained
+        os.remove(retained)
+        with open(filename, 'rb') as fp:
+            upload = Upload('9903.1020')
+            with mock.patch.dict(os.environ, {'RETAIN_UPLOAD_ARCHIVES': '0'}):
+                upload.process_upload(FileStorage(fp))
+        self.assertFalse(os.path.exists(retained))
+
+    def test_unpack_size_limits(self) -> None:
+        """Unpacking stops when an archive exceeds the size limits."""
+        upload = Upload('9903.1021')
+
+        # For testing purposes, clean out existing workspace directory
+        workspace_dir = upload.create_upload_workspace()
+        if os.path.exists(workspace_dir):
+            shutil.rmtree(workspace_dir)
+
+        filename = os.path.join(TEST_FILES_DIRECTORY, 'upload2.tar.gz')
+        with mock.patch.dict(os.environ, {'MAX_UNPACKED_FILE_SIZE': '1024'}):
+            with open(filename, 'rb') as fp:
+                upload = Upload('9903.1021')
+                upload.process_upload(FileStorage(fp))
+        self.assertTrue(upload.search_errors(r".* is larger than the maximum file size of 1024 bytes"))
+
+        shutil.rmtree(workspace_dir)
+        filename = os.path.join(TEST_FILES_DIRECTORY, 'upload-nested-zip-and-tar.zip')
+        with mock.patch.dict(os.environ, {'MAX_UNPACKED_MEMBERS': '2'}):
+            with open(filename, 'rb') as fp:
+                upload = Upload('9903.1021')
+                upload.process_upload(FileStorage(fp))
+        self.assertTrue(upload.search_errors(r".* would exceed the maximum number of 2 files"))
+        self.assertLessEqual(len(os.listdir(upload.get_source_directory())), 2,
+                             'Extraction stopped at the limit')
+
+    def test_process_compressed_upload(self) -> None:
+        """A tar archive compressed with Unix compress is unpacked."""
+        upload = Upload('9903.1022')
+
+        # For testing purposes, clean out existing workspace directory
+        workspace_dir = upload.create_upload_workspace()
+        if os.path.exists(workspace_dir):
+            shutil.rmtree(workspace_dir)
+
+        filename = os.path.join(TEST_FILES_DIRECTORY, 'upload8.tar.Z')
+        with open(filename, 'rb') as fp:
+            upload = Upload('9903.1022')
+            upload.process_upload(FileStorage(fp))
+
+        self.assertFalse(upload.has_warnings(), 'No warnings')
+        self.assertEqual(sorted(os.listdir(upload.get_source_directory())),
+                         ['00README.XXX', 'gtart_a.cls', 'main_a.bbl', 'main_a.tex'])
+        self.assertTrue(os.path.exists(os.path.join(upload.get_removed_directory(),
+                                                    'upload8.tar.Z')))
+
+    def test_unpack_zip_members_in_parallel(self) -> None:
+        """Zip members are extracted by several threads, within the source directory."""
+        upload = Upload('9903.1023')
+
+        # For testing purposes, clean out existing workspace directory
+        workspace_dir = upload.create_upload_workspace()
+        if os.path.exists(workspace_dir):
+            shutil.rmtree(workspace_dir)
+        upload = Upload('9903.1023')
+        upload.create_upload_workspace()
+
+        filename = os.path.join(upload.get_source_directory(), 'figures.zip')
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+            for i in range(20):
+                zip_ref.writestr(f'figures/fig{i}.eps', f'%!PS-Adobe figure {i}\n' * 1000)
+            zip_ref.writestr('../escaped.txt', 'Outside the source directory\n')
+        umask = os.umask(0o077)
+        try:
+            with mock.patch.dict(os.environ, {'UNZIP_THREADS': '4'}):
+                upload.process_source_files()
+        finally:
+            os.umask(umask)
+
+        source_directory = upload.get_source_directory()
+        for i in range(20):
+            with open(os.path.join(source_directory, 'figures', f'fig{i}.eps')) as fig:
+                self.assertEqual(fig.read(), f'%!PS-Adobe figure {i}\n' * 1000)
+        self.assertFalse(os.path.exists(os.path.join(upload.get_upload_directory(), 'escaped.txt')),
+                         'Member does not escape the source directory')
+        self.assertFalse(os.path.exists(filename), 'Zip archive is removed')
+        self.assertEqual(os.stat(os.path.join(source_directory, 'figures')).st_mode & 0o777, 0o775,
+                         'Directory is created with its final permissions')
+        self.assertEqual(os.stat(os.path.join(source_directory, 'figures', 'fig0.eps')).st_mode & 0o777,
+                         0o664, 'File is created with its final permissions')
+
+    def test_repeated_upload(self) -> None:
+        """An upload identical to the last one processed is recognized."""
+        upload = Upload('9903.1024')
+
+        # For testing purposes, clean out existing workspace directory
+        workspace_dir = upload.create_upload_workspace()
+        if os.path.exists(workspace_dir):
+            shutil.rmtree(workspace_dir)
+
+        filename = os.path.join(TEST_FILES_DIRECTORY, 'upload2.tar.gz')
+        with open(filename, 'rb') as fp:
+            upload = Upload('9903.1024')
+            self.assertFalse(upload.is_repeated_upload(FileStorage(fp)), 'New workspace')
+            upload.process_upload(FileStorage(fp))
+
+        with open(filename, 'rb') as fp:
+            upload = Upload('9903.1024')
+            self.assertTrue(upload.is_repeated_upload(FileStorage(fp)), 'Same upload')
+            self.assertFalse(upload.is_repeated_upload(FileStorage(fp), ancillary=True),
+                             'Same upload to ancillary directory')
+            self.assertFalse(upload.is_repeated_upload(FileStorage(fp, filename='other.tar.gz')),
+                             'Same content with another name')
+
+        # Any change to the workspace makes the upload new again
+        upload = Upload('9903.1024')
+        self.assertTrue(upload.client_remove_file('main_a.tex'))
+        with open(filename, 'rb') as fp:
+            upload = Upload('9903.1024')
+            self.assertFalse(upload.is_repeated_upload(FileStorage(fp)), 'Workspace has changed')
+
+    def test_reupload_changed_archive(self) -> None:
+        """Only the members that changed are written when an archive is uploaded again."""
+        upload = Upload('9903.1025')
+
+        # For testing purposes, clean out existing workspace directory
+        workspace_dir = upload.create_upload_workspace()
+        if os.path.exists(workspace_dir):
+            shutil.rmtree(workspace_dir)
+
+        def make_tar(files: dict) -> io.BytesIO:
+            archive = io.BytesIO()
+            with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+                for name, content in files.items():
+                    info = tarfile.TarInfo(name)
+                    info.size = len(content)
+                    tar.addfile(info, io.BytesIO(content))
+            archive.seek(0)
+            return archive
+
+        files = {'main.tex': b'\\documentclass{article}\n', 'intro.tex': b'Introduction\n'}
+        upload = Upload('9903.1025')
+        upload.process_upload(FileStorage(make_tar(files), filename='paper.tar.gz'))
+        upload.pack_content()
+        source_directory = upload.get_source_directory()
+        main_mtime = os.stat(os.path.join(source_directory, 'main.tex')).st_mtime_ns
+        intro_mtime = os.stat(os.path.join(source_directory, 'intro.tex')).st_mtime_ns
+
+        # Same content again: nothing is written, content package stays fresh
+        upload = Upload('9903.1025')
+        upload.process_upload(FileStorage(make_tar(files), filename='paper.tar.gz'))
+        self.assertEqual(os.stat(os.path.join(source_directory, 'main.tex')).st_mtime_ns, main_mtime)
+        self.assertFalse(upload.content_package_stale, 'Content package is still fresh')
+
+        # Edited archive (same size): only the edited member is written
+        files['intro.tex'] = b'Introductiom\n'
+        upload = Upload('9903.1025')
+        upload.process_upload(FileStorage(make_tar(files), filename='paper.tar.gz'))
+        self.assertEqual(os.stat(os.path.join(source_directory, 'main.tex')).st_mtime_ns, main_mtime,
+                         'Unchanged member is not rewritten')
+        self.assertNotEqual(os.stat(os.path.join(source_directory, 'intro.tex')).st_mtime_ns, intro_mtime)
+        with open(os.path.join(source_directory, 'intro.tex'), 'rb') as intro:
+            self.assertEqual(intro.read(), b'Introductiom\n')
+        self.assertTrue(upload.content_package_stale, 'Content package is stale')
+
+    def test_sandboxed_upload(self) -> None:
+        """Uploads may be unpacked and checked in a subprocess with limits."""
+        upload = Upload('9903.1026')
+
+        # For testing purposes, clean out existing workspace directory
+        workspace_dir = upload.create_upload_workspace()
+        if os.path.exists(workspace_dir):
+            shutil.rmtree(workspace_dir)
+
+        filename = os.path.join(TEST_FILES_DIRECTORY, 'upload1.tar.gz')
+        with mock.patch.dict(os.environ, {'SANDBOX_UPLOADS': '1'}):
+            with open(filename, 'rb') as fp:
+                upload = Upload('9903.1026')
+                upload.process_upload(FileStorage(fp))
+        self.assertTrue(upload.search_warnings('espcrc2.sty is empty \\(size is zero\\)'),
+                        'Warnings are reported from the subprocess')
+        self.assertTrue(upload.has_files(), 'Files are listed')
+        self.assertEqual(upload.total_upload_size, upload.manifest.total_size)
+        self.assertTrue(os.path.exists(os.path.join(upload.get_removed_directory(),
+                                                    'upload1.tar.gz')))
+
+        shutil.rmtree(workspace_dir)
+        with mock.patch.dict(os.environ, {'SANDBOX_UPLOADS': '1', 'SANDBOX_TIMEOUT': '0'}):
+            with open(filename, 'rb') as fp:
+                upload = Upload('9903.1026')
+                upload.process_upload(FileStorage(fp))
+        self.assertTrue(upload.search_errors('Processing of the upload was stopped'),
+                        'Upload that takes too long is stopped')
+        self.assertEqual(os.listdir(upload.get_source_directory()), [],
+                         'Unchecked files are moved out of the source directory')
+        self.assertTrue(any(name.startswith('failed-')
+                            for name in os.listdir(upload.get_removed_directory())))
+        self.assertEqual(upload.manifest.summary(), [])
+        self.assertFalse(upload.has_files())
+
+    def test_process_xz_upload(self) -> None:
+        """Tar archives compressed with xz or as several gzip members are unpacked."""
+        upload = Upload('9903.1027')
+
+        # For testing purposes, clean out existing workspace directory
+        workspace_dir = upload.create_upload_workspace()
+        if os.path.exists(workspace_dir):
+            shutil.rmtree(workspace_dir)
+
+        filename = os.path.join(TEST_FILES_DIRECTORY, 'upload9.tar.xz')
+        for stream in ('1', '0'):
+            with mock.patch.dict(os.environ, {'STREAM_UPLOAD_ARCHIVES': stream}):
+                with open(filename, 'rb') as fp:
+                    upload = Upload('9903.1027')
+                    upload.process_upload(FileStorage(fp))
+            self.assertFalse(upload.has_warnings(), 'No warnings')
+            self.assertTrue(os.path.exists(os.path.join(upload.get_source_directory(),
+                                                        'main_a.tex')))
+            self.assertFalse(os.path.exists(os.path.join(upload.get_source_directory(),
+                                                         'upload9.tar.xz')))
+            shutil.rmtree(workspace_dir)
+
+        # Concatenated gzip members decompress to the whole tar archive
+        content = io.BytesIO()
+        with tarfile.open(fileobj=content, mode='w') as tar:
+            for name in ('main.tex', 'appendix.tex'):
+                data = f'% {name}\n'.encode() * 1000
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        content = content.getvalue()
+        half = len(content) // 2
+        archive = gzip.compress(content[:half]) + gzip.compress(content[half:])
+        upload = Upload('9903.1027')
+        upload.process_upload(FileStorage(io.BytesIO(archive), filename='multi.tar.gz'))
+        self.assertFalse(upload.has_warnings(), 'No warnings')
+        self.assertEqual(sorted(os.listdir(upload.get_source_directory())),
+                         ['appendix.tex', 'main.tex'])
+
+    def test_failed_write(self) -> None:
+        """An upload that cannot be written fails, rather than being damaged."""
+        upload = Upload('9903.1028')
+
+        # For testing purposes, clean out existing workspace directory
+        workspace_dir = upload.create_upload_workspace()
+        if os.path.exists(workspace_dir):
+            shutil.rmtree(workspace_dir)
+
+        # Before Python 3.8 damaged gzip content raises a plain OSError
+        errors = (EOFError, zlib.error, OSError, lzma.LZMAError)
+        disk_full = OSError(errno.ENOSPC, 'No space left on device')
+        for filename in ('upload2.tar.gz', 'upload9.tar.xz'):
+            for stream in ('1', '0'):
+                with mock.patch.dict(os.environ, {'STREAM_UPLOAD_ARCHIVES': stream}), \
+                        mock.patch.object(unpack, 'DECOMPRESSION_ERRORS', errors), \
+                        mock.patch.object(unpack, '_write_member',
+                                          side_effect=disk_full), \
+                        open(os.path.join(TEST_FILES_DIRECTORY, filename), 'rb') as fp:
+                    upload = Upload('9903.1028')
+                    with self.assertRaises(OSError):
+                        upload.process_upload(FileStorage(fp))
+                shutil.rmtree(workspace_dir)
+
     def test_process_anc_upload(self) -> None:
         """Process upload with ancillary files in anc directory"""
         upload = Upload(20180226)
@@ -2,6 +2,7 @@ from unittest import TestCase
 from filemanager.arxiv.file import File
 
 import os.path
+import tempfile
 import datetime
 from pytz import UTC
 
@@ -129,3 +130,37 @@ class TestFileClass(TestCase):
         self.assertEquals(file.type, 'directory', "Check type of ancillary directory.")
         self.assertEquals(file.type_string, 'Directory', "Check type_string for ancillary directory")
         self.assertEquals(file.size, 68, "Check size of 'subdirectory' is 68,")
+
+    def test_from_dir_entry(self):
+        """Create :class:`.File` objects from :func:`os.scandir` entries."""
+        cwd = os.getcwd()
+        testfiles_dir = os.path.join(cwd, 'tests/type_test_files')
+        with os.scandir(testfiles_dir) as entries:
+            entry = next(e for e in entries if e.name == 'image.gif')
+        file = File.from_dir_entry(entry, testfiles_dir)
+
+        self.assertEquals(file.filepath, entry.path, "Check filepath() method")
+        self.assertEquals(file.dir, testfiles_dir, "Check dir() method")
+        self.assertEquals(file.size, 495, "Check size of '.gif' is 495")
+        self.assertEquals(file.type, 'image', "Check type() method")
+        self.assertFalse(hasattr(file, '__dict__'), "File uses __slots__")
+
+    def test_rewritten_file(self):
+        """Size and modified time are current after the file is rewritten."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'main.tex')
+            with open(path, 'w') as fp:
+                fp.write('first\n')
+            os.utime(path, (0, 0))
+            file = File(path, tmpdir)
+            self.assertEqual(file.size, 6)
+            self.assertEqual(file.modified_datetime,
+                             datetime.datetime.fromtimestamp(0, tz=UTC).isoformat())
+
+            with open(path, 'w') as fp:
+                fp.write('rewritten\n')
+            os.utime(path, (0, 86400))
+            self.assertEqual(file.size, 10, 'Size is looked up again')
+            self.assertEqual(file.modified_datetime,
+                             datetime.datetime.fromtimestamp(86400, tz=UTC).isoformat(),
+                             'Modified time is looked up again')
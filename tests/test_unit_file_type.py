@@ -1,4 +1,6 @@
-from unittest import TestCase
+from unittest import TestCase, mock
+import tempfile
+from arxiv.base.globals import get_application_config
 from filemanager.arxiv import file_type
 from filemanager.arxiv.file_type import guess_file_type, get_type_priority, is_tex_type, get_type_name, get_type_priority, \
     _is_tex_type, name, guess
@@ -25,6 +27,8 @@ type_tests.append(['gzipped.gz', 'TYPE_GZIPPED'])
 type_tests.append(['short-1.txt.bz2', 'TYPE_BZIP2'])
 type_tests.append(['short-4.txt.bz2', 'TYPE_BZIP2'])
 type_tests.append(['short-9.txt.bz2', 'TYPE_BZIP2'])
+# XZ
+type_tests.append(['short.txt.xz', 'TYPE_XZ'])
 # Tar
 type_tests.append(['testtar.tar', 'TYPE_TAR'])
 
@@ -123,6 +127,57 @@ class TestGuessFileType(TestCase):
 
             self.assertEqual(guessed_type, test_file_type, msg)
 
+    def test_scan_byte_budget(self):
+        """Line scan stops once byte budget is exhausted."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'late_hint.txt')
+            with open(path, 'wb') as fp:
+                fp.write(b'no hints here\n' * 1000)
+                fp.write(b'\\documentclass{article}\n')
+
+            self.assertEqual(guess_file_type(path)[0], 'TYPE_LATEX2e',
+                             'Default budget covers small files')
+            self.assertEqual(guess_file_type(path, byte_budget=1024)[0],
+                             'TYPE_FAILED', 'Hint beyond budget is not seen')
+            self.assertEqual(guess_file_type(path, byte_budget=None)[0],
+                             'TYPE_LATEX2e', 'No budget scans entire file')
+
+            with mock.patch.dict(get_application_config(),
+                                 {'TYPE_SCAN_BYTE_BUDGET': '1024'}):
+                self.assertEqual(file_type.guess(path), 'failed',
+                                 'Budget is taken from the config')
+            with mock.patch.dict(get_application_config(),
+                                 {'TYPE_SCAN_BYTE_BUDGET': '0'}):
+                self.assertEqual(file_type.guess(path), 'latex2e',
+                                 'Zero budget scans entire file')
+
+    def test_long_lines(self):
+        """Very long lines do not hide hints on following lines."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'long_line.txt')
+            with open(path, 'wb') as fp:
+                fp.write(b'x' * (3 * 1024 * 1024) + b'\n')
+                fp.write(b'\\documentstyle{article}\n')
+
+            self.assertEqual(guess_file_type(path)[0], 'TYPE_LATEX',
+                             'Detect LaTeX after long line')
+
+    def test_legacy_tex_comments_and_formats(self):
+        """Comments and %& formats are classified as by the legacy code."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            def guess_content(content: bytes) -> tuple:
+                path = os.path.join(tmpdir, 'paper.txt')
+                with open(path, 'wb') as fp:
+                    fp.write(content)
+                return guess_file_type(path)
+
+            self.assertEqual(guess_content(b'Notes % \\input harvmac\n')[0],
+                             'TYPE_TEX_MAC', 'Command in a comment is a hint')
+            self.assertEqual(guess_content(b'text % beginchar(\n')[0],
+                             'TYPE_MF')
+            self.assertEqual(guess_content(b'%&latex\n\\begin{document}\n')[:2],
+                             ('TYPE_TEX_MAC', "b'latex'"))
+
     def test_get_type_name(self):
         """Test human readable type name lookup."""
         self.assertEqual(get_type_name('TYPE_LATEX'), 'LaTeX', 'Lookup type name')
@@ -0,0 +1,35 @@
+"""Tests for :mod:`filemanager.utilities.lzw`."""
+
+import gzip
+import io
+import os
+from unittest import TestCase
+
+from filemanager.utilities.lzw import LZWError, open_lzw
+
+TEST_FILES_DIRECTORY = os.path.join(os.getcwd(), 'tests/test_files_upload')
+
+
+class TestLZW(TestCase):
+    """Test decompression of files made by Unix compress."""
+
+    def test_decompress(self):
+        """Decompressed content matches the original."""
+        with gzip.open(os.path.join(TEST_FILES_DIRECTORY, 'upload2.tar.gz')) as f:
+            expected = f.read()
+        with open(os.path.join(TEST_FILES_DIRECTORY, 'upload8.tar.Z'), 'rb') as f:
+            stream = open_lzw(f)
+            self.assertEqual(stream.read(100), expected[:100],
+                             'Content can be read in pieces')
+            self.assertEqual(stream.read(), expected[100:])
+
+    def test_bad_header(self):
+        """Content without the compress header is rejected."""
+        with self.assertRaises(LZWError):
+            open_lzw(io.BytesIO(b'\x1f\x8b\x08\x00'))
+
+    def test_corrupt(self):
+        """An invalid code is an error."""
+        # Header, then 9-bit code 300 before any string has been added
+        with self.assertRaises(LZWError):
+            open_lzw(io.BytesIO(b'\x1f\x9d\x90' + b'\x41\x58\x02')).read()
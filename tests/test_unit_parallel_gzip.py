@@ -0,0 +1,48 @@
+"""Tests for :mod:`filemanager.utilities.parallel_gzip`."""
+
+import gzip
+import os
+import random
+import zlib
+from unittest import TestCase
+
+from filemanager.utilities.parallel_gzip import compress
+
+
+def _chunks(data: bytes, size: int = 5000) -> list:
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestParallelGzip(TestCase):
+    """Test compressing to gzip format in blocks."""
+
+    def setUp(self):
+        rng = random.Random(0)
+        words = [bytes(rng.choices(b'abcdefghijklmnop', k=8))
+                 for _ in range(512)]
+        self.data = b' '.join(rng.choices(words, k=100000)) + os.urandom(1000)
+
+    def test_gunzip(self):
+        """The output is a standard gzip stream of the input."""
+        for data in (b'', b'x', self.data):
+            for threads in (1, 3):
+                compressed = b''.join(compress(_chunks(data), threads=threads,
+                                               block_size=64 * 1024))
+                self.assertEqual(gzip.decompress(compressed), data)
+                self.assertEqual(zlib.decompress(compressed,
+                                                 16 + zlib.MAX_WBITS), data)
+
+    def test_threads(self):
+        """The output does not depend on the number of threads."""
+        outputs = {b''.join(compress(_chunks(self.data), threads=threads,
+                                     block_size=16 * 1024))
+                   for threads in (1, 2, 5)}
+        self.assertEqual(len(outputs), 1)
+
+    def test_level(self):
+        """Blocks are compressed at the given level, nearly as well as gzip."""
+        best = b''.join(compress([self.data], compresslevel=9))
+        fast = b''.join(compress([self.data], compresslevel=1))
+        self.assertLess(len(best), len(fast))
+        self.assertLess(len(best), len(gzip.compress(self.data, 9)) * 1.01)
+        self.assertEqual(gzip.decompress(fast), self.data)
@@ -0,0 +1,81 @@
+"""Tests for :mod:`filemanager.utilities.sandbox`."""
+
+import os
+import tempfile
+import time
+from unittest import TestCase, mock
+
+from arxiv.base.globals import get_application_config
+
+from filemanager.utilities import sandbox
+from filemanager.utilities.sandbox import SandboxError, SandboxLimits
+
+
+def _fail() -> None:
+    raise ValueError('bad archive')
+
+
+def _allocate() -> int:
+    return len(bytearray(512 * 1024 * 1024))
+
+
+def _spin() -> None:
+    while True:
+        pass
+
+
+def _setting(key: str) -> str:
+    return get_application_config().get(key)
+
+
+def _write(path: str) -> None:
+    with open(path, 'wb') as f:
+        f.write(bytes(2 * 1024 * 1024))
+
+
+class TestSandbox(TestCase):
+    """Test running functions in a sandboxed subprocess."""
+
+    def test_result(self):
+        """The return value is sent back from the subprocess."""
+        self.assertNotEqual(sandbox.run(os.getpid), os.getpid())
+        self.assertEqual(sandbox.run(sorted, [3, 1, 2]), [1, 2, 3])
+
+    def test_workers(self):
+        """Workers are reused until a function fails."""
+        pid = sandbox.run(os.getpid)
+        self.assertEqual(sandbox.run(os.getpid), pid, 'Worker is reused')
+        with self.assertRaises(SandboxError):
+            sandbox.run(_fail)
+        self.assertNotEqual(sandbox.run(os.getpid), pid,
+                            'Worker that failed is replaced')
+
+    def test_config(self):
+        """Functions run with the caller's application config."""
+        with mock.patch.dict(get_application_config(),
+                             {'SANDBOX_TEST_SETTING': 'on'}):
+            self.assertEqual(sandbox.run(_setting, 'SANDBOX_TEST_SETTING'),
+                             'on')
+
+    def test_exception(self):
+        """Exceptions raised in the subprocess are reported."""
+        with self.assertRaisesRegex(SandboxError, 'ValueError: bad archive'):
+            sandbox.run(_fail)
+
+    def test_limits(self):
+        """Subprocesses are stopped by their limits."""
+        limits = SandboxLimits(cpu_seconds=1, memory=256 * 1024 * 1024,
+                               output_size=1024 * 1024, timeout=10)
+        with self.assertRaisesRegex(SandboxError, 'memory'):
+            sandbox.run(_allocate, limits=limits)
+        with self.assertRaisesRegex(SandboxError, 'CPU time'):
+            sandbox.run(_spin, limits=limits)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with self.assertRaisesRegex(SandboxError, 'File too large'):
+                sandbox.run(_write, os.path.join(tmp_dir, 'big'), limits=limits)
+
+    def test_timeout(self):
+        """Subprocesses are killed after the wall-clock deadline."""
+        limits = SandboxLimits(timeout=0.5)
+        with self.assertRaisesRegex(SandboxError, 'did not finish'):
+            sandbox.run(time.sleep, 60, limits=limits)
@@ -0,0 +1,75 @@
+"""Tests for :mod:`filemanager.utilities.type_cache`."""
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from filemanager.arxiv.file import File
+from filemanager.utilities.type_cache import TypeCache
+
+
+class TestTypeCache(TestCase):
+    """Test the persistent file type cache."""
+
+    def setUp(self):
+        """Create a source directory with a single TeX file."""
+        self.workspace = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.workspace, 'src')
+        os.makedirs(self.source_dir)
+        self.cache_path = os.path.join(self.workspace, 'type_cache.json')
+        self.file_path = os.path.join(self.source_dir, 'main.tex')
+        with open(self.file_path, 'w') as f:
+            f.write('\\documentclass{article}\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
+    def test_cache_is_persisted(self):
+        """Types recorded by one cache instance are seen by the next."""
+        cache = TypeCache(self.cache_path, self.source_dir)
+        file = File(self.file_path, self.source_dir, cache)
+        self.assertEqual(file.type, 'latex2e')
+        cache.save()
+
+        cache = TypeCache(self.cache_path, self.source_dir)
+        self.assertEqual(len(cache), 1)
+        with mock.patch('filemanager.arxiv.file.guess') as mock_guess:
+            file = File(self.file_path, self.source_dir, cache)
+            self.assertEqual(file.type, 'latex2e', "Type comes from cache")
+            mock_guess.assert_not_called()
+
+    def test_changed_file_is_detected_again(self):
+        """Modifying a file invalidates its cache entry."""
+        cache = TypeCache(self.cache_path, self.source_dir)
+        File(self.file_path, self.source_dir, cache)
+
+        with open(self.file_path, 'w') as f:
+            f.write('\\documentstyle{article}\n')
+        # Guarantee a different mtime on filesystems with coarse timestamps.
+        stat = os.stat(self.file_path)
+        os.utime(self.file_path, ns=(stat.st_atime_ns,
+                                     stat.st_mtime_ns + 1000000000))
+
+        self.assertIsNone(cache.get(self.file_path))
+        file = File(self.file_path, self.source_dir, cache)
+        self.assertEqual(file.type, 'latex')
+
+    def test_prune(self):
+        """Entries not visited since loading are dropped on a pruning save."""
+        cache = TypeCache(self.cache_path, self.source_dir)
+        File(self.file_path, self.source_dir, cache)
+        cache.save()
+
+        cache = TypeCache(self.cache_path, self.source_dir)
+        cache.save(prune=True)
+        self.assertEqual(len(TypeCache(self.cache_path, self.source_dir)), 0)
+
+    def test_unreadable_cache(self):
+        """A corrupt sidecar file is ignored."""
+        with open(self.cache_path, 'w') as f:
+            f.write('{not json')
+        cache = TypeCache(self.cache_path, self.source_dir)
+        self.assertEqual(len(cache), 0)
+        file = File(self.file_path, self.source_dir, cache)
+        self.assertEqual(file.type, 'latex2e')